@@ -0,0 +1,193 @@
+'''
+Concurrency limits of the WSGI build against the ASGI entry point.
+
+The quiz and page routes are driven at rising numbers of concurrent
+clients with an artificial delay on every database statement, standing in
+for a slow or distant database. The WSGI app gets --workers threads, like
+a threaded server; the ASGI app runs on one event loop with up to
+--async-pool database connections. Prints throughput and latency
+percentiles per build and concurrency as JSON.
+
+    python -m benchmarks.bench_asgi --db-latency 20 --workers 8
+    python -m benchmarks.bench_asgi --concurrency 8 64 256 --requests 2000
+
+Needs aiosqlite (or asyncpg with --database-url). Requests run in process,
+so neither figure includes an HTTP server.
+'''
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import CATEGORIES, make_app, percentile, seed
+from benchmarks.load import Scenario
+
+ROUTES = [
+  ('POST /quizzes', 50),
+  ('GET /questions', 25),
+  ('GET /categories/<id>/questions', 25),
+]
+
+
+def requests_for(scenario, count, seed_value=0):
+  rng = random.Random(seed_value)
+  names = [name for name, _ in ROUTES]
+  weights = [weight for _, weight in ROUTES]
+  return [scenario.build(rng.choices(names, weights)[0]) for _ in range(count)]
+
+
+def slow_sync_engine(engine, latency):
+  from sqlalchemy import event
+
+  @event.listens_for(engine, 'before_cursor_execute')
+  def delay(*args):
+    time.sleep(latency)
+
+
+def slow_async_database(database, latency):
+  '''The delay holds one of the pool_size connections, as a slow query would.'''
+  fetch = database.fetch
+  connections = asyncio.Semaphore(database.pool_size)
+
+  async def delayed(sql, *params):
+    async with connections:
+      await asyncio.sleep(latency)
+      return await fetch(sql, *params)
+  database.fetch = delayed
+
+
+def run_wsgi(app, requests, concurrency, workers):
+  '''`concurrency` clients sharing a server with `workers` threads.'''
+  server = threading.Semaphore(workers)
+  local = threading.local()
+  queue = iter(list(requests))
+  lock = threading.Lock()
+  samples = []
+
+  def client(_):
+    if not hasattr(local, 'client'):
+      local.client = app.test_client()
+    while True:
+      with lock:
+        request = next(queue, None)
+      if request is None:
+        return
+      method, path, body = request
+      start = time.perf_counter()
+      with server:
+        local.client.open(path, method=method, json=body)
+      samples.append((time.perf_counter() - start) * 1000)
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    list(pool.map(client, range(concurrency)))
+  return samples, time.perf_counter() - started
+
+
+async def asgi_call(app, method, path, body):
+  path, _, query = path.partition('?')
+  headers = []
+  data = b''
+  if body is not None:
+    data = json.dumps(body).encode()
+    headers.append((b'content-type', b'application/json'))
+  scope = {'type': 'http', 'method': method, 'path': path,
+           'query_string': query.encode(), 'headers': headers}
+
+  async def receive():
+    return {'type': 'http.request', 'body': data}
+
+  async def send(message):
+    pass
+  await app(scope, receive, send)
+
+
+async def run_asgi(app, requests, concurrency):
+  queue = iter(list(requests))
+  samples = []
+
+  async def client():
+    for method, path, body in queue:
+      start = time.perf_counter()
+      await asgi_call(app, method, path, body)
+      samples.append((time.perf_counter() - start) * 1000)
+
+  started = time.perf_counter()
+  await asyncio.gather(*[client() for _ in range(concurrency)])
+  return samples, time.perf_counter() - started
+
+
+def stats(samples, wall):
+  return {
+    'requests': len(samples),
+    'throughput_rps': round(len(samples) / wall, 2),
+    'p50_ms': round(percentile(samples, 50), 3),
+    'p99_ms': round(percentile(samples, 99), 3)
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--questions', type=int, default=10000)
+  parser.add_argument('--concurrency', type=int, nargs='+',
+                      default=[8, 32, 128])
+  parser.add_argument('--requests', type=int, default=1000,
+                      help='requests per concurrency level')
+  parser.add_argument('--workers', type=int, default=8,
+                      help='WSGI worker threads (and ASGI_THREADS)')
+  parser.add_argument('--async-pool', type=int, default=32,
+                      help='ASYNC_DB_POOL_SIZE for the ASGI build')
+  parser.add_argument('--db-latency', type=float, default=20.0,
+                      help='milliseconds added to every statement')
+  parser.add_argument('--database-url')
+  args = parser.parse_args()
+
+  from flaskr.asgi import AsgiApp
+  from models import db
+
+  app, _ = make_app(args.database_url)
+  app.config['ASGI_THREADS'] = args.workers
+  app.config['ASYNC_DB_POOL_SIZE'] = args.async_pool
+  seed(app, args.questions)
+  latency = args.db_latency / 1000.0
+  with app.app_context():
+    slow_sync_engine(db.engine, latency)
+
+  scenario = Scenario(args.questions, len(CATEGORIES), random.Random(0))
+  results = []
+  for concurrency in args.concurrency:
+    requests = requests_for(scenario, args.requests, concurrency)
+
+    samples, wall = run_wsgi(app, requests, concurrency, args.workers)
+    results.append(dict(stats(samples, wall), build='wsgi',
+                        concurrency=concurrency))
+
+    async def measure():
+      asgi = AsgiApp(app)
+      slow_async_database(asgi.db, latency)
+      try:
+        return await run_asgi(asgi, requests, concurrency)
+      finally:
+        await asgi.close()
+    samples, wall = asyncio.run(measure())
+    results.append(dict(stats(samples, wall), build='asgi',
+                        concurrency=concurrency))
+
+  print(json.dumps({
+    'config': {
+      'questions': args.questions,
+      'workers': args.workers,
+      'async_pool': args.async_pool,
+      'db_latency_ms': args.db_latency,
+      'target': args.database_url or 'sqlite (temporary)'
+    },
+    'results': results
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,131 @@
+'''
+Bandwidth against CPU for response compression.
+
+Every encoding available here (gzip always, br and zstd with brotli or
+brotlicffi and zstandard installed) is run at a range of levels over
+real response bodies: a page of questions, a 100 question cursor page,
+/bootstrap and a search page. For each it prints the compressed size and
+ratio plus the time to compress and decompress one body. The app is
+then driven through the test client without compression, compressing
+every response and serving the precompressed variants from the cache.
+
+    python -m benchmarks.bench_compression --questions 10000
+    python -m benchmarks.bench_compression --repeat 500 --encodings gzip br
+'''
+import argparse
+import gzip
+import json
+
+from benchmarks.common import make_app, seed, summary, timed
+
+PAYLOADS = (
+  '/questions?page=1',
+  '/questions?after=&limit=100',
+  '/bootstrap',
+  ('POST', '/questions', {'searchTerm': 'the'}),
+)
+LEVEL_RANGE = {'gzip': (1, 5, 6, 9), 'br': (1, 4, 5, 6, 9, 10, 11),
+               'zstd': (1, 3, 6, 9, 12, 19)}
+
+
+def decompressor(encoding):
+  if encoding == 'gzip':
+    return gzip.decompress
+  if encoding == 'br':
+    from flaskr.compression import brotli
+    return brotli.decompress
+  import zstandard
+  return zstandard.ZstdDecompressor().decompress
+
+
+def fetch(client, payload):
+  method, path, body = payload if isinstance(payload, tuple) \
+    else ('GET', payload, None)
+  return method, path, body, client.open(path, method=method, json=body).data
+
+
+def measure_levels(bodies, encodings, repeat):
+  from flaskr.compression import ENCODERS, LEVELS
+  results = []
+  for path, data in bodies:
+    for encoding in encodings:
+      decompress = decompressor(encoding)
+      for level in LEVEL_RANGE[encoding]:
+        compressed = ENCODERS[encoding](data, level)
+        results.append({
+          'path': path,
+          'encoding': encoding,
+          'level': level,
+          'used_for': [use for use, tuned in zip(('request', 'cache'),
+                                                 LEVELS[encoding])
+                       if tuned == level],
+          'bytes': len(data),
+          'compressed_bytes': len(compressed),
+          'ratio': round(len(data) / len(compressed), 2),
+          'compress_ms': round(min(timed(
+            lambda: ENCODERS[encoding](data, level), repeat)), 4),
+          'decompress_ms': round(min(timed(
+            lambda: decompress(compressed), repeat)), 4)
+        })
+  return results
+
+
+def measure_requests(database_url, questions, encodings, repeat):
+  '''Latency and bytes on the wire per response through the whole app.'''
+  variants = [('none', None, {})]
+  for encoding in encodings:
+    variants.append((encoding, encoding, {'COMPRESS_CACHE_SIZE': 0}))
+    variants.append((encoding + ' cached', encoding, {}))
+
+  results = []
+  for name, encoding, config in variants:
+    from flaskr import create_app
+    app = create_app(dict(config, SQLALCHEMY_DATABASE_URI=database_url))
+    client = app.test_client()
+    headers = {'Accept-Encoding': encoding} if encoding else {}
+    for payload in PAYLOADS:
+      method, path, body = payload if isinstance(payload, tuple) \
+        else ('GET', payload, None)
+      size = len(client.open(path, method=method, json=body,
+                             headers=headers).data)
+      samples = timed(lambda: client.open(path, method=method, json=body,
+                                          headers=headers), repeat)
+      results.append(dict(summary(samples), variant=name, path=path,
+                          bytes=size))
+  return results
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--questions', type=int, default=10000)
+  parser.add_argument('--repeat', type=int, default=200)
+  parser.add_argument('--encodings', nargs='+')
+  parser.add_argument('--database-url')
+  args = parser.parse_args()
+
+  from flaskr.compression import ENCODERS
+  encodings = [encoding for encoding in ENCODERS
+               if not args.encodings or encoding in args.encodings]
+
+  app, database_url = make_app(args.database_url)
+  seed(app, args.questions)
+  client = app.test_client()
+  bodies = [(path, data) for _, path, _, data
+            in (fetch(client, payload) for payload in PAYLOADS)]
+
+  print(json.dumps({
+    'config': {
+      'questions': args.questions,
+      'repeat': args.repeat,
+      'encodings': encodings,
+      'target': args.database_url or 'sqlite (temporary)'
+    },
+    'levels': measure_levels(bodies, encodings, args.repeat),
+    'requests': measure_requests(database_url, args.questions, encodings,
+                                 args.repeat)
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,144 @@
+'''
+Grading throughput: the matcher on its own and POST /quizzes/answer.
+
+The matcher is timed three ways over the same guesses (a mix of exact,
+misspelt, reordered and wrong answers): against the stored normalized
+answers with the banded edit distance, normalizing the answer on every
+grade as a client-side grader would, and with a full Levenshtein matrix
+instead of the bounded one. The endpoint is timed answering a round of
+--round questions one request at a time and as one batch request.
+
+    python -m benchmarks.bench_grading --guesses 50000
+    python -m benchmarks.bench_grading --rounds 500 --round 10
+'''
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import WORDS, make_app, seed
+
+
+def full_distance(a, b, limit):
+  '''Levenshtein over the whole matrix, for comparison with the band.'''
+  previous = list(range(len(b) + 1))
+  for i, char in enumerate(a, 1):
+    current = [i]
+    for j, other in enumerate(b, 1):
+      current.append(min(previous[j - 1] + (char != other),
+                         previous[j] + 1, current[j - 1] + 1))
+    previous = current
+  return previous[-1] <= limit
+
+
+def misspell(word, rng):
+  index = rng.randrange(len(word))
+  return word[:index] + rng.choice('aeiourst') + word[index + 1:]
+
+
+def make_guesses(answers, count, rng):
+  '''(guess, answer) pairs: a quarter each exact, misspelt, reordered, wrong.'''
+  pairs = []
+  for number in range(count):
+    answer = rng.choice(answers)
+    words = answer.split()
+    kind = number % 4
+    if kind == 0:
+      guess = answer.upper()
+    elif kind == 1:
+      guess = ' '.join(misspell(word, rng) for word in words)
+    elif kind == 2:
+      guess = 'the ' + ' '.join(reversed(words))
+    else:
+      guess = ' '.join(rng.sample(WORDS, 2))
+    pairs.append((guess, answer))
+  return pairs
+
+
+def time_matcher(pairs, normalized, grade):
+  start = time.perf_counter()
+  correct = sum(grade(guess, normalized(answer)) for guess, answer in pairs)
+  elapsed = time.perf_counter() - start
+  return {
+    'grades_per_second': round(len(pairs) / elapsed),
+    'correct': correct
+  }
+
+
+def time_endpoint(client, rounds, batch):
+  start = time.perf_counter()
+  for round_answers in rounds:
+    if batch:
+      client.post('/quizzes/answer', json={'answers': round_answers})
+    else:
+      for item in round_answers:
+        client.post('/quizzes/answer', json=item)
+  elapsed = time.perf_counter() - start
+  answers = sum(len(round_answers) for round_answers in rounds)
+  return {
+    'answers_per_second': round(answers / elapsed),
+    'ms_per_round': round(elapsed * 1000 / len(rounds), 3)
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--questions', type=int, default=10000)
+  parser.add_argument('--guesses', type=int, default=20000)
+  parser.add_argument('--rounds', type=int, default=200)
+  parser.add_argument('--round', type=int, default=5,
+                      help='questions per quiz round')
+  parser.add_argument('--database-url')
+  args = parser.parse_args()
+
+  from flaskr import grading
+  from models import db, Question, normalize_answer
+
+  app, _ = make_app(args.database_url)
+  seed(app, args.questions)
+  with app.app_context():
+    stored = dict(db.session.query(Question.answer, Question.answer_normalized))
+
+  rng = random.Random(0)
+  pairs = make_guesses(sorted(stored), args.guesses, rng)
+  results = {
+    'stored_normalized': time_matcher(pairs, stored.get, grading.grade),
+    'normalize_per_grade': time_matcher(pairs, normalize_answer,
+                                        grading.grade)
+  }
+  banded = grading.within_distance
+  grading.within_distance = full_distance
+  try:
+    results['full_levenshtein'] = time_matcher(pairs, stored.get,
+                                               grading.grade)
+  finally:
+    grading.within_distance = banded
+
+  with app.app_context():
+    answers = dict(db.session.query(Question.id, Question.answer))
+  ids = sorted(answers)
+  rounds = []
+  for _ in range(args.rounds):
+    picked = rng.sample(ids, args.round)
+    rounds.append([{'question_id': question_id,
+                    'answer': misspell(answers[question_id], rng)}
+                   for question_id in picked])
+  client = app.test_client()
+  results['endpoint_single'] = time_endpoint(client, rounds, batch=False)
+  results['endpoint_batch'] = time_endpoint(client, rounds, batch=True)
+
+  print(json.dumps({
+    'config': {
+      'questions': args.questions,
+      'guesses': args.guesses,
+      'rounds': args.rounds,
+      'round': args.round,
+      'target': args.database_url or 'sqlite (temporary)'
+    },
+    'results': results
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main()
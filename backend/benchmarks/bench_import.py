@@ -0,0 +1,64 @@
+'''
+Bulk import throughput: one Question.insert() (and transaction) per row
+against flaskr.bulk.import_questions at several batch sizes.
+
+    python -m benchmarks.bench_import --rows 50000
+'''
+import argparse
+import json
+import random
+import time
+
+from benchmarks.common import WORDS, make_app, seed
+
+
+def sample_lines(rows, seed_value=2):
+  rng = random.Random(seed_value)
+  for i in range(rows):
+    yield json.dumps({
+      'question': 'Which %s borders the %s? (import %d)' % (
+        rng.choice(WORDS), rng.choice(WORDS), i),
+      'answer': rng.choice(WORDS),
+      'category': rng.randint(1, 6),
+      'difficulty': rng.randint(1, 5)
+    }) + '\n'
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--rows', type=int, default=50000)
+  parser.add_argument('--legacy-rows', type=int, default=2000,
+                      help='rows timed through the one-row-per-commit path')
+  parser.add_argument('--batch-sizes', type=int, nargs='+',
+                      default=[100, 1000, 5000])
+  args = parser.parse_args()
+
+  app, _ = make_app()
+  results = []
+
+  with app.app_context():
+    from models import Question
+    from flaskr.bulk import import_questions
+
+    seed(app, 0)
+    start = time.perf_counter()
+    for line in sample_lines(args.legacy_rows):
+      Question(**json.loads(line)).insert()
+    elapsed = time.perf_counter() - start
+    results.append({'path': 'insert per row', 'rows': args.legacy_rows,
+                    'rows_per_sec': round(args.legacy_rows / elapsed, 1)})
+
+    for batch_size in args.batch_sizes:
+      seed(app, 0)
+      start = time.perf_counter()
+      report = import_questions(sample_lines(args.rows), 'jsonl', batch_size)
+      elapsed = time.perf_counter() - start
+      results.append({'path': 'import_questions', 'batch_size': batch_size,
+                      'rows': report['inserted'],
+                      'rows_per_sec': round(report['inserted'] / elapsed, 1)})
+
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
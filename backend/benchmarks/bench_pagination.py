@@ -0,0 +1,52 @@
+'''
+GET /questions latency as the table grows.
+
+    python -m benchmarks.bench_pagination --sizes 1000 10000 100000
+
+With --legacy the old load-everything-then-slice approach is timed on the
+same data for comparison.
+'''
+import argparse
+import json
+
+from benchmarks.common import make_app, seed, summary, timed
+
+
+def legacy_page(page):
+  from models import Question
+  start = (page-1) * 10
+  return [q.format() for q in Question.query.all()][start:start + 10]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--sizes', type=int, nargs='+',
+                      default=[1000, 10000, 100000])
+  parser.add_argument('--repeat', type=int, default=200)
+  parser.add_argument('--legacy', action='store_true')
+  args = parser.parse_args()
+
+  app, _ = make_app()
+  client = app.test_client()
+  results = []
+
+  for size in args.sizes:
+    seed(app, size)
+    last_page = max(1, size // 10)
+    for page in (1, last_page // 2 or 1, last_page):
+      url = '/questions?page=%d' % page
+      samples = timed(lambda: client.get(url), args.repeat)
+      row = dict(summary(samples), rows=size, page=page, path='paginated')
+      results.append(row)
+
+      if args.legacy:
+        with app.app_context():
+          samples = timed(lambda: legacy_page(page), max(1, args.repeat // 20))
+        results.append(dict(summary(samples), rows=size, page=page,
+                            path='legacy'))
+
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
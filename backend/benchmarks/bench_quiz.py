@@ -0,0 +1,68 @@
+'''
+POST /quizzes latency in a single 10k-question category as the
+previous_questions list grows.
+
+    python -m benchmarks.bench_quiz --questions 10000 --legacy
+
+With --legacy the old load-format-and-redraw loop is timed on the same
+data for comparison.
+'''
+import argparse
+import json
+import random
+
+from benchmarks.common import make_app, seed, summary, timed
+
+
+def legacy_pick(category_id, previous):
+  from models import Question
+  selection = Question.query.filter_by(category=category_id).all()
+  questions = list(map(Question.format, selection))
+
+  def check_if_used(question):
+    used = False
+    for q in previous:
+      if (q == question['id']):
+        used = True
+    return used
+
+  question = random.choice(questions)
+  while (check_if_used(question)):
+    question = random.choice(questions)
+    if (len(previous) == len(questions)):
+      return None
+  return question
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--questions', type=int, default=10000)
+  parser.add_argument('--previous', type=int, nargs='+',
+                      default=[0, 1000, 5000, 9000, 9990])
+  parser.add_argument('--repeat', type=int, default=200)
+  parser.add_argument('--legacy', action='store_true')
+  args = parser.parse_args()
+
+  app, _ = make_app()
+  client = app.test_client()
+  seed(app, args.questions, categories=['Science'])
+  ids = list(range(1, args.questions + 1))
+  results = []
+
+  for size in args.previous:
+    previous = random.sample(ids, min(size, len(ids)))
+    body = {'previous_questions': previous, 'quiz_category': {'id': 1}}
+    samples = timed(lambda: client.post('/quizzes', json=body), args.repeat)
+    results.append(dict(summary(samples), previous=size, path='picker'))
+
+    if args.legacy:
+      with app.app_context():
+        samples = timed(lambda: legacy_pick(1, previous),
+                        max(1, args.repeat // 40))
+      results.append(dict(summary(samples), previous=size, path='legacy'))
+
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+'''
+Question search: the previous ILIKE '%term%' scan against the search
+backend picked by flaskr.search, fetching the first page of 10 results
+with its total. On SQLite that is the in-memory inverted index (path
+"index"); against Postgres, with the search migration applied first, it is
+the tsvector column and its GIN index (path "gin"), and a term made only
+of stop words such as "the" takes its ILIKE fallback.
+
+    python -m benchmarks.bench_search --questions 100000
+    python -m benchmarks.bench_search --questions 100000 \
+      --database-url postgresql://localhost/trivia_bench
+
+The first search after a write pays for the index build (or, on Postgres,
+the first stop-word lookup); that cost is reported separately as
+index_build_ms.
+'''
+import argparse
+import json
+import time
+
+from benchmarks.common import make_app, seed, summary, timed
+
+TERMS = ['12345', 'volcano', 'volcano river', 'sym', 'the']
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--questions', type=int, default=100000)
+  parser.add_argument('--repeat', type=int, default=20)
+  parser.add_argument('--terms', nargs='+', default=TERMS)
+  parser.add_argument('--database-url')
+  args = parser.parse_args()
+
+  from sqlalchemy import text
+  from models import db, Question
+  from flaskr.migrations import upgrade
+  from flaskr.search import PostgresSearch, search_backend
+
+  app, _ = make_app(args.database_url)
+  with app.app_context():
+    # the search column and its trigger come from 0001, before the seed
+    upgrade()
+  seed(app, args.questions)
+  results = []
+
+  with app.app_context():
+    if db.engine.dialect.name == 'postgresql':
+      db.session.execute(text('ANALYZE questions'))
+      db.session.commit()
+
+    backend = search_backend()
+    path = 'gin' if isinstance(backend, PostgresSearch) else 'index'
+    start = time.perf_counter()
+    backend.search('warmup')
+    results.append({
+      'backend': type(backend).__name__,
+      'target': args.database_url or 'sqlite (temporary)',
+      'rows': args.questions,
+      'index_build_ms': round((time.perf_counter() - start) * 1000, 3)
+    })
+
+    for term in args.terms:
+      ilike = Question.query.filter(Question.question.ilike('%' + term + '%'))
+      matches = len(ilike.all())
+      samples = timed(lambda: ilike.all(), args.repeat)
+      results.append(dict(summary(samples), term=term, path='ilike',
+                          matches=matches))
+
+      matches = backend.search(term)[1]
+      samples = timed(lambda: backend.search(term), args.repeat)
+      results.append(dict(summary(samples), term=term, path=path,
+                          matches=matches))
+
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
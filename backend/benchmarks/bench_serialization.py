@@ -0,0 +1,81 @@
+'''
+Building a JSON response for 1k/10k questions: ORM instances +
+Question.format() + jsonify against column tuples + json_response.
+
+    python -m benchmarks.bench_serialization --rows 1000 10000
+
+Each variant runs in its own interpreter so the peak RSS it reports (the
+growth over the seeded baseline) is not polluted by the other variant.
+'''
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks.common import make_app, seed
+
+VARIANTS = ('orm', 'tuples')
+
+
+def build(variant, rows):
+  from flask import jsonify
+  from models import Question
+  from flaskr.serialize import format_rows, json_response, question_rows
+
+  query = Question.query.order_by(Question.id).limit(rows)
+  if variant == 'orm':
+    return jsonify({'questions': [question.format() for question in query]})
+  return json_response({'questions': format_rows(question_rows(query))})
+
+
+def run_variant(variant, rows, seconds):
+  app, _ = make_app()
+  seed(app, rows)
+  with app.test_request_context('/questions'):
+    build(variant, rows)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+      response = build(variant, rows)
+      count += 1
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  from flaskr.serialize import orjson
+  return {
+    'variant': variant,
+    'rows': rows,
+    'encoder': 'orjson' if orjson and variant == 'tuples' else 'json',
+    'responses_per_sec': round(count / elapsed, 2),
+    'peak_rss_growth_kb': peak - baseline,
+    'body_bytes': len(response.get_data())
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+  parser.add_argument('--seconds', type=float, default=3.0)
+  parser.add_argument('--variant', choices=VARIANTS)
+  args = parser.parse_args()
+
+  if args.variant:
+    print(json.dumps(run_variant(args.variant, args.rows[0], args.seconds)))
+    return
+
+  results = []
+  for rows in args.rows:
+    for variant in VARIANTS:
+      output = subprocess.check_output([
+        sys.executable, '-m', 'benchmarks.bench_serialization',
+        '--variant', variant, '--rows', str(rows),
+        '--seconds', str(args.seconds)])
+      results.append(json.loads(output.decode().strip().splitlines()[-1]))
+  print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
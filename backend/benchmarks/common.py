@@ -0,0 +1,117 @@
+'''
+Shared helpers for the benchmark scripts: building an app against a
+throwaway SQLite database (or a given database url), seeding synthetic
+questions and summarising latency samples.
+'''
+import os
+import random
+import tempfile
+import time
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+  __file__))), 'trivia.psql')
+
+WORDS = ('river mountain painter novel planet battle empire element '
+         'composer island treaty cathedral galaxy symphony dynasty '
+         'volcano inventor theorem football olympic desert ocean').split()
+
+
+def load_fixture(path=FIXTURE):
+  '''
+  Reads the rows of the COPY blocks in trivia.psql as
+  {'categories': [[id, type], ...], 'questions': [[id, question, ...], ...]}.
+  '''
+  tables = {}
+  rows = None
+  with open(path, encoding='utf-8') as dump:
+    for line in dump:
+      line = line.rstrip('\n')
+      if line.startswith('COPY public.'):
+        rows = tables.setdefault(line.split()[1].split('.')[1], [])
+      elif line == '\\.':
+        rows = None
+      elif rows is not None:
+        rows.append(line.split('\t'))
+  return tables
+
+
+CATEGORIES = [row[1] for row in load_fixture()['categories']]
+
+
+def make_app(database_url=None):
+  '''
+  Creates the Flask app bound to `database_url`, or to a fresh SQLite file
+  when none is given. Seeding wipes the questions and categories tables,
+  so never point this at a database you care about.
+  '''
+  if database_url is None:
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    os.remove(path)
+    database_url = 'sqlite:///' + path
+
+  from flaskr import create_app
+  app = create_app({'SQLALCHEMY_DATABASE_URI': database_url})
+  return app, database_url
+
+
+def seed(app, questions, categories=CATEGORIES, seed=1, batch=5000):
+  from sqlalchemy import text
+  from models import (db, Question, QuestionCount, Category, commit_writes,
+                      normalize_answer)
+  rng = random.Random(seed)
+
+  with app.app_context():
+    db.session.execute(Question.__table__.delete())
+    db.session.execute(Category.__table__.delete())
+    db.session.execute(Category.__table__.insert(), [
+      {'id': i + 1, 'type': name} for i, name in enumerate(categories)])
+
+    rows = []
+    for i in range(questions):
+      question = 'What %s links the %s and the %s? (#%d)' % (
+        rng.choice(WORDS), rng.choice(WORDS), rng.choice(WORDS), i)
+      answer = ' '.join(rng.sample(WORDS, 2))
+      rows.append({
+        'id': i + 1,
+        'question': question,
+        'answer': answer,
+        'answer_normalized': normalize_answer(answer),
+        'category': rng.randint(1, len(categories)),
+        'difficulty': rng.randint(1, 5)
+      })
+      if len(rows) == batch:
+        db.session.execute(Question.__table__.insert(), rows)
+        rows = []
+    if rows:
+      db.session.execute(Question.__table__.insert(), rows)
+    if db.engine.dialect.name == 'postgresql':
+      for table in ('questions', 'categories'):
+        db.session.execute(text(
+          "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+          "(SELECT max(id) FROM %s))" % (table, table)))
+    commit_writes('questions', 'categories')
+    QuestionCount.rebuild()
+
+
+def timed(fn, repeat):
+  samples = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    samples.append((time.perf_counter() - start) * 1000)
+  return samples
+
+
+def percentile(samples, pct):
+  ordered = sorted(samples)
+  index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+  return ordered[index]
+
+
+def summary(samples):
+  return {
+    'p50_ms': round(percentile(samples, 50), 3),
+    'p99_ms': round(percentile(samples, 99), 3),
+    'requests': len(samples)
+  }
@@ -0,0 +1,205 @@
+'''
+Concurrent load test over every route of create_app().
+
+Seeds a database with synthetic questions, then runs a weighted mix of
+requests from several worker threads for a fixed duration and prints
+throughput and latency percentiles per route as JSON.
+
+    python -m benchmarks.load --questions 100000 --concurrency 8 --duration 30
+    python -m benchmarks.load --database-url postgresql://localhost/trivia_bench
+    python -m benchmarks.load --url http://localhost:5000 --no-seed
+
+Requests run in-process through the WSGI test client unless --url points
+at a running server. Seeding wipes the questions and categories tables.
+'''
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib import error, request as urlrequest
+
+from benchmarks.common import CATEGORIES, WORDS, make_app, percentile, seed
+
+# (name, weight) -- weights roughly follow the frontend's traffic
+ROUTES = [
+  ('GET /categories', 10),
+  ('GET /questions', 20),
+  ('GET /questions cursor', 5),
+  ('POST /questions search', 15),
+  ('GET /categories/<id>/questions', 15),
+  ('POST /quizzes', 25),
+  ('POST /questions/add', 5),
+  ('DELETE /questions/<id>', 5),
+]
+
+
+class Scenario:
+  '''Builds (method, path, json body) for each route from the seeded sizes.'''
+
+  def __init__(self, questions, categories, rng):
+    self.questions = questions
+    self.categories = categories
+    self.rng = rng
+    self._deletable = itertools.count(questions, -1)
+    self._lock = threading.Lock()
+
+  def build(self, route):
+    rng = self.rng
+    pages = max(1, self.questions // 10)
+    category = rng.randint(1, self.categories)
+    if route == 'GET /categories':
+      return 'GET', '/categories', None
+    if route == 'GET /questions':
+      return 'GET', '/questions?page=%d' % rng.randint(1, pages), None
+    if route == 'GET /questions cursor':
+      return 'GET', '/questions?after=&limit=50', None
+    if route == 'POST /questions search':
+      return 'POST', '/questions', {'searchTerm': rng.choice(WORDS)}
+    if route == 'GET /categories/<id>/questions':
+      page = rng.randint(1, max(1, pages // self.categories))
+      return 'GET', '/categories/%d/questions?page=%d' % (category, page), None
+    if route == 'POST /quizzes':
+      previous = [rng.randint(1, self.questions)
+                  for _ in range(rng.randint(0, 20))]
+      return 'POST', '/quizzes', {'previous_questions': previous,
+                                  'quiz_category': {'id': category}}
+    if route == 'POST /questions/add':
+      return 'POST', '/questions/add', {
+        'question': 'Load test question about the %s?' % rng.choice(WORDS),
+        'answer': rng.choice(WORDS), 'category': category,
+        'difficulty': rng.randint(1, 5)}
+    if route == 'DELETE /questions/<id>':
+      with self._lock:
+        return 'DELETE', '/questions/%d' % next(self._deletable), None
+    raise ValueError(route)
+
+
+def in_process_sender(app):
+  local = threading.local()
+
+  def send(method, path, body):
+    if not hasattr(local, 'client'):
+      local.client = app.test_client()
+    response = local.client.open(path, method=method, json=body)
+    return response.status_code
+  return send
+
+
+def http_sender(base_url):
+  def send(method, path, body):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urlrequest.Request(base_url.rstrip('/') + path, data=data,
+                             method=method)
+    if data is not None:
+      req.add_header('Content-Type', 'application/json')
+    try:
+      with urlrequest.urlopen(req) as response:
+        response.read()
+        return response.status
+    except error.HTTPError as exc:
+      return exc.code
+  return send
+
+
+def run(send, scenario, routes, concurrency, duration):
+  names = [name for name, _ in routes]
+  weights = [weight for _, weight in routes]
+  samples = defaultdict(list)
+  errors = defaultdict(int)
+  deadline = time.perf_counter() + duration
+
+  def worker(seed_value):
+    rng = random.Random(seed_value)
+    while time.perf_counter() < deadline:
+      route = rng.choices(names, weights)[0]
+      method, path, body = scenario.build(route)
+      start = time.perf_counter()
+      try:
+        status = send(method, path, body)
+      except Exception:
+        status = None
+      elapsed = (time.perf_counter() - start) * 1000
+      samples[route].append(elapsed)
+      if status is None or status >= 500:
+        errors[route] += 1
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as pool:
+    list(pool.map(worker, range(concurrency)))
+  wall = time.perf_counter() - started
+
+  report = {}
+  for route in names:
+    times = samples.get(route)
+    if not times:
+      continue
+    report[route] = stats(times, wall, errors[route])
+  everything = [t for times in samples.values() for t in times]
+  report['total'] = stats(everything, wall, sum(errors.values()))
+  return report
+
+
+def stats(times, wall, errors):
+  return {
+    'requests': len(times),
+    'errors': errors,
+    'throughput_rps': round(len(times) / wall, 2),
+    'p50_ms': round(percentile(times, 50), 3),
+    'p90_ms': round(percentile(times, 90), 3),
+    'p99_ms': round(percentile(times, 99), 3),
+    'max_ms': round(max(times), 3)
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--questions', type=int, default=10000)
+  parser.add_argument('--concurrency', type=int, default=4)
+  parser.add_argument('--duration', type=float, default=10.0)
+  parser.add_argument('--database-url')
+  parser.add_argument('--url', help='drive a running server instead')
+  parser.add_argument('--no-seed', action='store_true')
+  parser.add_argument('--routes', nargs='+', metavar='ROUTE',
+                      help='only run routes whose name contains one of these')
+  parser.add_argument('--output', help='write the JSON report to this file')
+  args = parser.parse_args()
+
+  routes = ROUTES
+  if args.routes:
+    routes = [route for route in ROUTES
+              if any(part in route[0] for part in args.routes)]
+
+  categories = len(CATEGORIES)
+  if args.url:
+    send = http_sender(args.url)
+  else:
+    app, _ = make_app(args.database_url)
+    if not args.no_seed:
+      seed(app, args.questions)
+    send = in_process_sender(app)
+
+  scenario = Scenario(args.questions, categories, random.Random(0))
+  report = {
+    'config': {
+      'questions': args.questions,
+      'concurrency': args.concurrency,
+      'duration_s': args.duration,
+      'target': args.url or args.database_url or 'sqlite (temporary)'
+    },
+    'routes': run(send, scenario, routes, args.concurrency, args.duration)
+  }
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, 'w') as handle:
+      handle.write(output + '\n')
+  print(output)
+
+
+if __name__ == '__main__':
+  main()
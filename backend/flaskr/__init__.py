@@ -1,25 +1,49 @@
+import io
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, Response, request, abort, jsonify, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
-
-
-def paginate(request, selection):
-  page = request.args.get('page', 1, type=int)
-  start = (page-1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
-  questions = [question.format() for question in selection]
-  return questions[start:end]
+from models import setup_db, setting, pool_stats, read_only, Question
+from .pagination import page_size, paginate, paginate_after
+from .quiz import (SESSION_QUESTIONS, new_session_id, question_ids,
+                   question_picker, session_store)
+from .cache import (bootstrap_payload, category_cache, question_stats,
+                    question_summary)
+from .search import search_backend
+from .serialize import format_rows, json_response
+from .http_cache import conditional
+from .bulk import (EXPORT_FORMATS, bulk_delete, bulk_update, export_rows,
+                   import_questions, question_criteria, questions_cli,
+                   stats_cli, update_values)
+from .migrations import db_cli, stamp
+from .grading import MAX_BATCH, grade_answers, read_submission
+from .batch import batch_response, dispatch, read_requests
+from .metrics import init_metrics, metrics
+from .queries import init_query_tracker
+from .compression import init_compression
 
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  if test_config:
+    app.config.update(test_config)
+  if setup_db(app):
+    stamp()
+
+  quiz_sessions = session_store(app)
+  session_questions = setting(app, 'QUIZ_SESSION_QUESTIONS', SESSION_QUESTIONS)
+  batch_limit = setting(app, 'BATCH_MAX_REQUESTS', 20)
+  app.extensions['quiz_sessions'] = quiz_sessions
+  app.cli.add_command(questions_cli)
+  app.cli.add_command(stats_cli)
+  app.cli.add_command(db_cli)
+  # first, so its after_request hook runs last and times the others too
+  init_metrics(app)
+  init_query_tracker(app)
+  # after_request hooks run in reverse, so this compresses the body once
+  # the CORS hooks below are done and before the metrics measure it
+  init_compression(app)
 
   cors = CORS(app, resources={"*": {"origin": "*"}})
 
@@ -32,34 +56,41 @@ def create_app(test_config=None):
       return response
 
   @app.route('/categories', methods=['GET'])
+  @read_only
+  @conditional('categories', max_age=60)
   def get_categories():
-    cats = Category.query.all()
-    if cats is None:
-      abort(404)
-    else:
-      categories = {category.id:category.type for category in cats}
+    categories = category_cache.types()
 
-      return jsonify({
-        'categories': categories
-      })
+    return json_response({
+      'categories': categories
+    })
 
   @app.route('/questions', methods=['GET'])
+  @read_only
+  @conditional('questions', 'categories')
   def get_question():
-    selection = Question.query.all()
-    current_questions = paginate(request, selection)
-    cats = Category.query.all()
-    categories = [category.format() for category in cats]
+    total_questions = question_stats.total()
+    if 'after' in request.args:
+      current_questions, next_cursor = paginate_after(request, Question.query)
+    else:
+      current_questions = paginate(request, Question.query, total_questions)
+    categories = category_cache.all()
 
     if len(current_questions) == 0:
       abort(404)
 
-    return jsonify({
+    result = {
      'questions': current_questions,
      'categories': categories,
-     'total_questions': len(selection),
-     'current_catgory': "",
-     'page': request.args.get('page', 1, type=int)
-   })
+     'total_questions': total_questions,
+     'current_catgory': ""
+    }
+    if 'after' in request.args:
+      result['next_cursor'] = next_cursor
+    else:
+      result['page'] = request.args.get('page', 1, type=int)
+
+    return json_response(result)
 
 
 
@@ -78,6 +109,30 @@ def create_app(test_config=None):
 
     return jsonify(result)
 
+  @app.route('/questions', methods=['DELETE'])
+  def delete_questions():
+    criteria = question_criteria(request.get_json() or {})
+    if criteria is None:
+      abort(422)
+
+    return jsonify({
+      'success': True,
+      'deleted': bulk_delete(criteria)
+    })
+
+  @app.route('/questions', methods=['PATCH'])
+  def update_questions():
+    body = request.get_json() or {}
+    criteria = question_criteria(body)
+    values = update_values(body.get('set')) if criteria is not None else None
+    if criteria is None or values is None:
+      abort(422)
+
+    return jsonify({
+      'success': True,
+      'updated': bulk_update(criteria, values)
+    })
+
   @app.route('/questions/add', methods=['POST'])
   def add_question():
     data = {
@@ -91,6 +146,15 @@ def create_app(test_config=None):
       or data['difficulty'] == 0 or data['category'] == 0:
       abort(422)
 
+    try:
+      data['category'] = int(data['category'])
+      data['difficulty'] = int(data['difficulty'])
+    except (TypeError, ValueError):
+      abort(422)
+    if category_cache.find(data['category']) is None \
+      or not 1 <= data['difficulty'] <= 5:
+      abort(422)
+
     question = Question(**data)
     question.insert()
     
@@ -100,34 +164,88 @@ def create_app(test_config=None):
 
     return jsonify(result)
 
+  @app.route('/questions/import', methods=['POST'])
+  def import_question_batch():
+    fmt = request.args.get('format') \
+      or ('csv' if request.mimetype == 'text/csv' else 'jsonl')
+    if fmt not in ('jsonl', 'csv'):
+      abort(422)
+
+    lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    report = import_questions(
+      lines, fmt, batch_size=request.args.get('batch_size', 1000, type=int))
+
+    return jsonify({
+      'success': True,
+      'inserted': report['inserted'],
+      'failed': report['failed'],
+      'errors': report['errors']
+    })
+
+  @app.route('/questions/export', methods=['GET'])
+  def export_question_bank():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in EXPORT_FORMATS:
+      abort(422)
+    encode, mimetype = EXPORT_FORMATS[fmt]
+
+    try:
+      category, difficulty = [
+        int(request.args[name]) if name in request.args else None
+        for name in ('category', 'difficulty')]
+    except ValueError:
+      abort(422)
+
+    rows = export_rows(category, difficulty)
+    response = Response(stream_with_context(encode(rows)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+      'attachment; filename=questions.%s' % fmt
+    return response
+
   @app.route('/questions', methods=['POST'])
+  @read_only
   def search_questions():
-    body = request.get_json()
+    body = request.get_json() or {}
     search_term = body.get('searchTerm', None)
 
-    if search_term:
-      search_results = Question.query.filter(
-      Question.question.ilike(f'%{search_term}%')).all()
+    if not search_term or not isinstance(search_term, str):
+      abort(422)
+
+    page = request.args.get('page', 1, type=int)
+    limit = page_size(request)
+    if page < 1:
+      abort(404)
+
+    search_results, total_questions, estimated = search_backend().search(
+      search_term, include_answers=bool(body.get('searchAnswers')),
+      offset=(page-1) * limit, limit=limit)
 
     result = {
       'success': True,
-      'questions': [
-        question.format() for question in search_results
-      ],
-      'total_questions': len(search_results),
+      'questions': format_rows(search_results),
+      'total_questions': total_questions,
+      'total_is_estimate': estimated,
       'current_category': None,
-      'category': request.get_json()['category'],
-      'page': request.args.get('page', 1, type=int)
+      'category': body.get('category'),
+      'page': page
     }
 
-    return jsonify(result)
+    return json_response(result)
 
   @app.route('/categories/<int:category_id>/questions')
+  @read_only
+  @conditional('questions', 'categories')
   def get_questions_category(category_id):
-    categories = Category.query.all()
-    category_type = Category.query.get(category_id).format()['type']
-    selection = Question.query.filter_by(category=category_id).all()
-    current_questions = paginate(request, selection)
+    category = category_cache.get(category_id)
+    if category is None:
+      abort(404)
+    category_type = category['type']
+    selection = Question.query.filter_by(category=category_id)
+    total_questions = question_stats.total(category_id)
+    if 'after' in request.args:
+      current_questions, next_cursor = paginate_after(request, selection)
+    else:
+      current_questions = paginate(request, selection, total_questions)
 
     if len(current_questions) == 0:
       abort(404)
@@ -135,56 +253,171 @@ def create_app(test_config=None):
     result = {
       'success': True,
       'questions': current_questions,
-      'total_questions': len(selection),
-      'current_category': category_type,
-      'page': request.args.get('page', 1, type=int)
+      'total_questions': total_questions,
+      'current_category': category_type
     }
+    if 'after' in request.args:
+      result['next_cursor'] = next_cursor
+    else:
+      result['page'] = request.args.get('page', 1, type=int)
 
-    return jsonify(result)
+    return json_response(result)
  
   
   @app.route('/quizzes', methods=['POST'])
+  @read_only
   def get_questions_for_quiz():
+    body = request.get_json() or {}
+    if not isinstance(body, dict):
+      abort(422)
+    previous = body.get('previous_questions') or []
+    category = body.get('quiz_category') or {}
 
-    body = request.get_json()
-    previous = body.get('previous_questions')
-    category = body.get('quiz_category')
-    
-    if request.get_json()['quiz_category']['id'] == 0:
-      selection = Question.query.all()
-    else:
-      selection = Question.query.filter_by(category=request.get_json()['quiz_category']['id']).all()
-    questions = list(map(Question.format, selection))
-    
-    if len(questions) == 0:
-        question = Question("","",None, None).format()
+    if not isinstance(previous, list):
+      abort(422)
+    try:
+      category_id = int(category.get('id', 0))
+      previous = [int(question_id) for question_id in previous]
+    except (AttributeError, TypeError, ValueError):
+      abort(422)
+
+    question = None
+    question_id = question_picker.pick(category_id or None, previous)
+    if question_id is not None:
+      question = Question.query.get(question_id)
+      if question is None:
+        # deleted by another worker since the id index was cached
+        question_ids.clear()
+        question_id = question_picker.pick(category_id or None, previous)
+        question = question_id and Question.query.get(question_id)
 
-    def check_if_used(question):
-      used = False
-      for q in previous:
-        if (q == question.id):
-          used = True
+    result = {
+      'success': True,
+      'question': question.format() if question else None
+    }
 
-      return used
+    return jsonify(result)
 
-    question = random.choice(questions)
+  @app.route('/quizzes/answer', methods=['POST'])
+  def grade_quiz_answers():
+    body = request.get_json() or {}
+    if not isinstance(body, dict):
+      abort(422)
+    batch = 'answers' in body
+    items = body['answers'] if batch else [body]
+    if not isinstance(items, list) or not items or len(items) > MAX_BATCH:
+      abort(422)
+    submissions = [read_submission(item) for item in items]
+    if None in submissions:
+      abort(422)
 
-    while (check_if_used(question)):
-      question = random.choice(questions)
+    results = grade_answers(submissions)
+    if not batch:
+      if results[0]['answer'] is None:
+        abort(404)
+      return jsonify(dict(results[0], success=True))
 
-      if (len(previous) == len(questions)):
-        return jsonify({
-          'success': True
-        })
+    return jsonify({
+      'success': True,
+      'results': results,
+      'correct': sum(result['correct'] for result in results),
+      'total': len(results)
+    })
+
+  @app.route('/quizzes/sessions', methods=['POST'])
+  def create_quiz_session():
+    body = request.get_json() or {}
+    if not isinstance(body, dict):
+      abort(422)
+    category = body.get('quiz_category') or {}
 
+    try:
+      category_id = int(category.get('id', 0))
+      count = body.get('questions')
+      count = int(count) if count is not None else None
+    except (AttributeError, TypeError, ValueError):
+      abort(422)
+    if count is not None and count < 1:
+      abort(422)
+    count = min(count or session_questions, session_questions)
 
+    sequence = question_picker.sequence(category_id or None, count)
+    session_id = new_session_id()
+    quiz_sessions.create(session_id, sequence)
 
-    result = {
+    return jsonify({
       'success': True,
-      'question': question
-    }
+      'session_id': session_id,
+      'total_questions': len(sequence)
+    })
+
+  @app.route('/quizzes/sessions/<session_id>/next', methods=['GET'])
+  def get_next_session_question(session_id):
+    question = None
+    while True:
+      try:
+        question_id, remaining = quiz_sessions.pop(session_id)
+      except KeyError:
+        abort(404)
+      if question_id is None:
+        break
+      # skip questions deleted since the session was created
+      question = Question.query.get(question_id)
+      if question is not None:
+        break
+
+    response = jsonify({
+      'success': True,
+      'question': question.format() if question else None,
+      'remaining': remaining
+    })
+    response.cache_control.no_store = True
+    return response
+
+  @app.route('/stats', methods=['GET'])
+  @read_only
+  @conditional('questions', 'categories')
+  def get_stats():
+    return json_response(question_summary())
+
+  @app.route('/bootstrap', methods=['GET'])
+  @read_only
+  @conditional('questions', 'categories')
+  def get_bootstrap():
+    return json_response(bootstrap_payload())
+
+  @app.route('/batch', methods=['POST'])
+  def batch_requests():
+    requests = read_requests(request.get_json() or {}, batch_limit)
+    if requests is None:
+      abort(422)
 
-    return jsonify(result)
+    return batch_response([dispatch(app, *sub_request)
+                           for sub_request in requests])
+
+  @app.route('/internal/cache', methods=['GET'])
+  def get_cache_stats():
+    compressor = app.extensions.get('compressor')
+    return jsonify({
+      'success': True,
+      'categories': category_cache.stats(),
+      'question_stats': question_stats.stats(),
+      'compression': compressor.stats() if compressor else None
+    })
+
+  @app.route('/metrics', methods=['GET'])
+  def get_metrics():
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+  @app.route('/internal/pool', methods=['GET'])
+  def get_pool_stats():
+    replicas = app.extensions.get('replicas')
+    return jsonify({
+      'success': True,
+      'pool': pool_stats(),
+      'replicas': replicas.stats() if replicas else []
+    })
 
   @app.errorhandler(400)
   def bad_request(error):
@@ -225,6 +458,14 @@ def create_app(test_config=None):
       'error': 422,
       'message': 'Unprocessable Entity'
     }), 422
+
+  @app.errorhandler(500)
+  def internal_server_error(error):
+    return jsonify({
+      'success': False,
+      'error': 500,
+      'message': 'Internal Server Error'
+    }), 500
   
   return app
 app = create_app
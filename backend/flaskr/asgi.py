@@ -0,0 +1,649 @@
+'''
+ASGI entry point serving the same API as create_app().
+
+The read and quiz routes hit on every page view run as coroutines, with
+their row queries going through an async driver (asyncpg on Postgres,
+aiosqlite on SQLite), so a slow query no longer holds a worker thread.
+Cache reloads and every other route (writes, search, import/export, the
+internal endpoints) run in the Flask app on a small thread pool. Response
+bodies, status codes and headers match the WSGI build.
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+'''
+import asyncio
+import io
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from urllib.parse import parse_qsl
+
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import Headers, MultiDict
+from werkzeug.exceptions import (BadRequest, HTTPException, NotFound,
+                                 UnprocessableEntity)
+from werkzeug.http import HTTP_STATUS_CODES
+
+from models import setting
+from . import create_app
+from .compression import compressible
+from .cache import (bootstrap_payload, bootstrap_stale, category_cache,
+                    question_stats, question_summary)
+from .http_cache import (body_etag, cache_headers, is_fresh, last_modified,
+                         version_validators)
+from .metrics import RequestStats, current_stats, metrics
+from .pagination import (QUESTIONS_PER_PAGE, cursor_page, cursor_position,
+                         page_offset, page_size)
+from .quiz import (SESSION_QUESTIONS, MemorySessionStore, new_session_id,
+                   question_ids, question_picker)
+from .serialize import QUESTION_FIELDS, dumps, format_rows
+
+ASYNC_DRIVERS = {'postgresql': 'asyncpg', 'sqlite': 'aiosqlite'}
+QUESTION_SELECT = 'SELECT %s FROM questions' % ', '.join(QUESTION_FIELDS)
+
+
+def backend_name(url):
+  name = make_url(url).get_backend_name()
+  return 'postgresql' if name == 'postgres' else name
+
+
+class AsyncDatabase:
+  '''
+  Runs SELECTs through the async driver for `url`. Statements are written
+  with ? placeholders, which are renumbered to $1, $2... for asyncpg. At
+  most `pool_size` connections are opened, lazily, on the running loop.
+  '''
+
+  def __init__(self, url, pool_size=10):
+    self.url = url
+    self.dialect = backend_name(url)
+    self.pool_size = pool_size
+    self._pool = None
+    self._lock = None
+    self._idle = None
+    self._connections = []
+
+  async def fetch(self, sql, *params):
+    '''All rows of `sql` as tuples, counted in the request's metrics.'''
+    started = time.perf_counter()
+    try:
+      if self.dialect == 'postgresql':
+        return await self._fetch_postgres(sql, params)
+      return await self._fetch_sqlite(sql, params)
+    finally:
+      stats = current_stats.get()
+      if stats is not None:
+        stats.add_query(time.perf_counter() - started)
+
+  async def _fetch_postgres(self, sql, params):
+    if self._pool is None:
+      if self._lock is None:
+        self._lock = asyncio.Lock()
+      async with self._lock:
+        if self._pool is None:
+          import asyncpg
+          self._pool = await asyncpg.create_pool(
+            'postgresql://' + self.url.split('://', 1)[1],
+            min_size=1, max_size=self.pool_size)
+
+    parts = sql.split('?')
+    sql = parts[0] + ''.join('$%d%s' % (number, part)
+                             for number, part in enumerate(parts[1:], 1))
+    return [tuple(row) for row in await self._pool.fetch(sql, *params)]
+
+  async def _fetch_sqlite(self, sql, params):
+    if self._idle is None:
+      self._idle = asyncio.Queue()
+    if self._idle.empty() and len(self._connections) < self.pool_size:
+      import aiosqlite
+      # reserve the slot before the await so concurrent callers see it
+      self._connections.append(None)
+      try:
+        connection = await aiosqlite.connect(make_url(self.url).database)
+      except Exception:
+        self._connections.remove(None)
+        raise
+      self._connections[self._connections.index(None)] = connection
+    else:
+      connection = await self._idle.get()
+
+    try:
+      async with connection.execute(sql, params) as cursor:
+        return await cursor.fetchall()
+    finally:
+      self._idle.put_nowait(connection)
+
+  async def close(self):
+    if self._pool is not None:
+      await self._pool.close()
+      self._pool = None
+    for connection in self._connections:
+      if connection is not None:
+        await connection.close()
+    self._connections = []
+    self._idle = None
+
+
+class AsgiRequest:
+  '''The parts of an http scope the handlers read, shaped like Flask's.'''
+
+  def __init__(self, scope, body):
+    self.method = scope['method']
+    self.path = scope['path']
+    self.query_string = scope.get('query_string', b'').decode('latin-1')
+    self.args = MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+    self.headers = Headers([(name.decode('latin-1'), value.decode('latin-1'))
+                            for name, value in scope.get('headers', [])])
+    self.body = body
+
+  def get_json(self):
+    '''The JSON body, None for other content types, 400 when malformed.'''
+    mimetype = self.headers.get('Content-Type', '').split(';')[0].strip()
+    if mimetype != 'application/json' and not (
+        mimetype.startswith('application/') and mimetype.endswith('+json')):
+      return None
+    try:
+      return json.loads(self.body.decode('utf-8'))
+    except ValueError:
+      raise BadRequest()
+
+
+async def read_body(receive):
+  chunks = []
+  while True:
+    message = await receive()
+    chunks.append(message.get('body', b''))
+    if not message.get('more_body'):
+      return b''.join(chunks)
+
+
+def wsgi_environ(scope, body):
+  server = scope.get('server') or ('localhost', 80)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+    'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+    'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+    'SERVER_NAME': server[0],
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': io.BytesIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': True,
+    'wsgi.run_once': False
+  }
+  if scope.get('client'):
+    environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = \
+      scope['client'][0], str(scope['client'][1])
+
+  for name, value in scope.get('headers', []):
+    name = name.decode('latin-1').upper().replace('-', '_')
+    value = value.decode('latin-1')
+    if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+      name = 'HTTP_' + name
+    environ[name] = environ[name] + ',' + value if name in environ else value
+  # the body has been read in full, chunked or not
+  environ['CONTENT_LENGTH'] = str(len(body))
+  return environ
+
+
+class AsgiApp:
+  '''
+  ASGI application around a Flask app from create_app(). Routes listed
+  in `routes` are served natively; everything else, including OPTIONS
+  preflights and HEAD, goes to the Flask app on the thread pool.
+
+  ASYNC_DB_POOL_SIZE caps the async driver's connections and ASGI_THREADS
+  the thread pool, both read like the DB_* settings.
+  '''
+
+  def __init__(self, flask_app):
+    self.flask_app = flask_app
+    self.quiz_sessions = flask_app.extensions['quiz_sessions']
+    self.session_questions = setting(flask_app, 'QUIZ_SESSION_QUESTIONS',
+                                     SESSION_QUESTIONS)
+    self.db = AsyncDatabase(flask_app.config['SQLALCHEMY_DATABASE_URI'],
+                            setting(flask_app, 'ASYNC_DB_POOL_SIZE', 10))
+    self.executor = ThreadPoolExecutor(setting(flask_app, 'ASGI_THREADS', 8))
+    self.metrics = setting(flask_app, 'METRICS', True, type=bool)
+    self.server_timing = setting(flask_app, 'SERVER_TIMING', False, type=bool)
+    self.compressor = flask_app.extensions.get('compressor')
+    pages = ('questions', 'categories')
+    # (method, Flask rule, pattern, handler); the rule labels the metrics
+    self.routes = [
+      ('GET', '/categories', re.compile(r'/categories$'),
+       self.conditional(('categories',), max_age=60)(self.get_categories)),
+      ('GET', '/questions', re.compile(r'/questions$'),
+       self.conditional(pages)(self.get_questions)),
+      ('GET', '/categories/<int:category_id>/questions',
+       re.compile(r'/categories/(\d+)/questions$'),
+       self.conditional(pages)(self.get_questions_category)),
+      ('POST', '/quizzes', re.compile(r'/quizzes$'),
+       self.get_questions_for_quiz),
+      ('POST', '/quizzes/sessions', re.compile(r'/quizzes/sessions$'),
+       self.create_quiz_session),
+      ('GET', '/quizzes/sessions/<session_id>/next',
+       re.compile(r'/quizzes/sessions/([^/]+)/next$'),
+       self.get_next_session_question),
+      ('GET', '/stats', re.compile(r'/stats$'),
+       self.conditional(pages)(self.get_stats)),
+      ('GET', '/bootstrap', re.compile(r'/bootstrap$'),
+       self.conditional(pages)(self.get_bootstrap))
+    ]
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      return await self.lifespan(receive, send)
+
+    for method, rule, pattern, handler in self.routes:
+      match = pattern.match(scope['path'])
+      if match and method == scope['method']:
+        break
+    else:
+      return await self.wsgi(scope, receive, send)
+
+    stats = RequestStats()
+    token = current_stats.set(stats)
+    try:
+      request = AsgiRequest(scope, await read_body(receive))
+      try:
+        status, body, headers = await handler(request, *match.groups())
+      except HTTPException as error:
+        status, body, headers = self.error(error.code)
+      except Exception:
+        # what Flask does for an unhandled error in a view
+        self.flask_app.logger.exception(
+          'Exception on %s [%s]', scope['path'], method)
+        status, body, headers = self.error(500)
+    finally:
+      current_stats.reset(token)
+
+    if self.compressor is not None:
+      status, body, headers = self.compress(request, status, body, headers)
+    duration = time.perf_counter() - stats.started
+    if self.metrics:
+      metrics.record(method, rule, status, duration, stats, len(body))
+    if self.metrics and self.server_timing:
+      headers = headers + [('Server-Timing', stats.server_timing(duration))]
+
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                  for name, value in headers + self.cors_headers(request)]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        await self.close()
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  async def close(self):
+    await self.db.close()
+    self.executor.shutdown(wait=False)
+
+  # helpers
+
+  def json(self, payload, headers=(), status=200):
+    body = dumps(payload)
+    return status, body, [('Content-Type', 'application/json'),
+                          ('Content-Length', str(len(body)))] + list(headers)
+
+  def error(self, code):
+    '''The JSON error body the Flask app's error handlers send.'''
+    return self.json({
+      'success': False,
+      'error': code,
+      'message': HTTP_STATUS_CODES[code]
+    }, status=code)
+
+  def compress(self, request, status, body, headers):
+    '''Content-Encoding as init_compression() applies it to Flask responses.'''
+    values = dict(headers)
+    if not compressible(values.get('Content-Type')):
+      return status, body, headers
+    etag = values.get('ETag')
+    path = request.path + '?' + request.query_string
+    body, encoding = self.compressor.encode(
+      status, values.get('Content-Type'), body,
+      request.headers.get('Accept-Encoding'),
+      (path, etag) if etag else None)
+    headers = [(name, value) for name, value in headers
+               if name != 'Content-Length' or encoding is None]
+    headers.append(('Vary', 'Accept-Encoding'))
+    if encoding is not None:
+      headers += [('Content-Length', str(len(body))),
+                  ('Content-Encoding', encoding)]
+    return status, body, headers
+
+  def cors_headers(self, request):
+    '''The headers flask_cors and the after_request hook add.'''
+    origin = request.headers.get('Origin')
+    headers = [
+      ('Access-Control-Allow-Origin', origin or '*'),
+      ('Access-Control-Allow-Headers', 'Content-Type,Authorization,true'),
+      ('Access-Control-Allow-Methods', 'GET,PATCH,POST,DELETE,OPTIONS')
+    ]
+    if origin:
+      headers.append(('Vary', 'Origin'))
+    return headers
+
+  def conditional(self, tables, max_age=0):
+    '''
+    Wraps a handler the way http_cache.conditional() wraps a view: a 304
+    straight from the shared data_versions rows when they match the
+    request's validators, otherwise the handler's 200 with the validators
+    added, falling back to a body hash while a table has no row.
+    '''
+    placeholders = ', '.join('?' * len(tables))
+
+    def decorator(handler):
+      @wraps(handler)
+      async def wrapper(request, *args):
+        rows = await self.db.fetch(
+          'SELECT name, version, modified FROM data_versions '
+          'WHERE name IN (%s)' % placeholders, *tables)
+        validators = version_validators(tables, {
+          name: (version, modified) for name, version, modified in rows})
+        if validators is not None and is_fresh(*validators, request.headers):
+          return 304, b'', cache_headers(*validators, max_age)
+
+        status, body, headers = await handler(request, *args)
+        if status != 200:
+          return status, body, headers
+        if validators is None:
+          validators = (body_etag(body), last_modified(tables))
+          if is_fresh(*validators, request.headers):
+            return 304, b'', cache_headers(*validators, max_age)
+        return status, body, headers + cache_headers(*validators, max_age)
+      return wrapper
+    return decorator
+
+  async def blocking(self, fn, *args):
+    '''Runs fn(*args) on the thread pool inside a Flask app context.'''
+    def run():
+      with self.flask_app.app_context():
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+  async def cached(self, stale, fn, *args):
+    '''
+    Calls fn(*args), which reads a process-local cache, on the loop when the
+    cache is warm and on the thread pool when `stale` says it will reload.
+    '''
+    if stale:
+      return await self.blocking(fn, *args)
+    with self.flask_app.app_context():
+      return fn(*args)
+
+  async def session_call(self, fn, *args):
+    if isinstance(self.quiz_sessions, MemorySessionStore):
+      return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(
+      self.executor, lambda: fn(*args))
+
+  async def question(self, question_id):
+    rows = await self.db.fetch(QUESTION_SELECT + ' WHERE id = ?', question_id)
+    return format_rows(rows)[0] if rows else None
+
+  async def question_page(self, request, total, category_id=None):
+    '''(formatted rows, next cursor), the same pages as paginate*().'''
+    where, params = [], []
+    if category_id is not None:
+      where.append('category = ?')
+      params.append(category_id)
+
+    if 'after' in request.args:
+      limit = page_size(request)
+      after = cursor_position(request)
+      if after is not None:
+        where.append('id > ?')
+        params.append(after)
+      params.append(limit + 1)
+      sql = ' ORDER BY id LIMIT ?'
+    else:
+      start = page_offset(request, total)
+      if start is None:
+        return [], None
+      params.extend([QUESTIONS_PER_PAGE, start])
+      sql = ' ORDER BY id LIMIT ? OFFSET ?'
+
+    if where:
+      sql = ' WHERE ' + ' AND '.join(where) + sql
+    rows = await self.db.fetch(QUESTION_SELECT + sql, *params)
+    if 'after' in request.args:
+      rows, next_cursor = cursor_page(rows, limit)
+      return format_rows(rows), next_cursor
+    return format_rows(rows), None
+
+  # routes
+
+  async def get_categories(self, request):
+    categories = await self.cached(category_cache.stale(),
+                                   category_cache.types)
+    return self.json({'categories': categories})
+
+  async def get_questions(self, request):
+    total_questions = await self.cached(question_stats.stale(),
+                                        question_stats.total)
+    current_questions, next_cursor = \
+      await self.question_page(request, total_questions)
+    categories = await self.cached(category_cache.stale(), category_cache.all)
+
+    if len(current_questions) == 0:
+      raise NotFound()
+
+    result = {
+     'questions': current_questions,
+     'categories': categories,
+     'total_questions': total_questions,
+     'current_catgory': ""
+    }
+    if 'after' in request.args:
+      result['next_cursor'] = next_cursor
+    else:
+      result['page'] = request.args.get('page', 1, type=int)
+
+    return self.json(result)
+
+  async def get_questions_category(self, request, category_id):
+    category_id = int(category_id)
+    category = await self.cached(category_cache.stale(), category_cache.get,
+                                 category_id)
+    if category is None:
+      raise NotFound()
+    total_questions = await self.cached(question_stats.stale(),
+                                        question_stats.total, category_id)
+    current_questions, next_cursor = \
+      await self.question_page(request, total_questions, category_id)
+
+    if len(current_questions) == 0:
+      raise NotFound()
+
+    result = {
+      'success': True,
+      'questions': current_questions,
+      'total_questions': total_questions,
+      'current_category': category['type']
+    }
+    if 'after' in request.args:
+      result['next_cursor'] = next_cursor
+    else:
+      result['page'] = request.args.get('page', 1, type=int)
+
+    return self.json(result)
+
+  async def get_questions_for_quiz(self, request):
+    body = request.get_json() or {}
+    if not isinstance(body, dict):
+      raise UnprocessableEntity()
+    previous = body.get('previous_questions') or []
+    category = body.get('quiz_category') or {}
+
+    if not isinstance(previous, list):
+      raise UnprocessableEntity()
+    try:
+      category_id = int(category.get('id', 0)) or None
+      previous = [int(question_id) for question_id in previous]
+    except (AttributeError, TypeError, ValueError):
+      raise UnprocessableEntity()
+
+    question = None
+    question_id = await self.cached(question_ids.stale(category_id),
+                                    question_picker.pick, category_id, previous)
+    if question_id is not None:
+      question = await self.question(question_id)
+      if question is None:
+        # deleted by another worker since the id index was cached
+        question_ids.clear()
+        question_id = await self.blocking(question_picker.pick, category_id,
+                                          previous)
+        question = question_id and await self.question(question_id)
+
+    return self.json({
+      'success': True,
+      'question': question
+    })
+
+  async def create_quiz_session(self, request):
+    body = request.get_json() or {}
+    if not isinstance(body, dict):
+      raise UnprocessableEntity()
+    category = body.get('quiz_category') or {}
+
+    try:
+      category_id = int(category.get('id', 0)) or None
+      count = body.get('questions')
+      count = int(count) if count is not None else None
+    except (AttributeError, TypeError, ValueError):
+      raise UnprocessableEntity()
+    if count is not None and count < 1:
+      raise UnprocessableEntity()
+    count = min(count or self.session_questions, self.session_questions)
+
+    sequence = await self.cached(question_ids.stale(category_id),
+                                 question_picker.sequence, category_id, count)
+    session_id = new_session_id()
+    await self.session_call(self.quiz_sessions.create, session_id, sequence)
+
+    return self.json({
+      'success': True,
+      'session_id': session_id,
+      'total_questions': len(sequence)
+    })
+
+  async def get_next_session_question(self, request, session_id):
+    question = None
+    while True:
+      try:
+        question_id, remaining = await self.session_call(
+          self.quiz_sessions.pop, session_id)
+      except KeyError:
+        raise NotFound()
+      if question_id is None:
+        break
+      # skip questions deleted since the session was created
+      question = await self.question(question_id)
+      if question is not None:
+        break
+
+    return self.json({
+      'success': True,
+      'question': question,
+      'remaining': remaining
+    }, [('Cache-Control', 'no-store')])
+
+  async def get_stats(self, request):
+    summary = await self.cached(
+      category_cache.stale() or question_stats.stale(), question_summary)
+    return self.json(summary)
+
+  async def get_bootstrap(self, request):
+    payload = await self.cached(bootstrap_stale(), bootstrap_payload)
+    return self.json(payload)
+
+  # everything else
+
+  async def wsgi(self, scope, receive, send):
+    '''
+    Serves the request with the Flask app on the thread pool. The response
+    is handed back chunk by chunk through a small queue, so streamed
+    exports keep their flat memory use and a slow client holds back the
+    producer instead of the buffer growing.
+    '''
+    environ = wsgi_environ(scope, await read_body(receive))
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=8)
+    cancelled = threading.Event()
+
+    def put(item):
+      if cancelled.is_set():
+        raise ConnectionError('client disconnected')
+      asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def run():
+      response = {}
+
+      def start_response(status, headers, exc_info=None):
+        response['start'] = (int(status.split(' ', 1)[0]), headers)
+
+      try:
+        result = self.flask_app(environ, start_response)
+        try:
+          for chunk in result:
+            if chunk:
+              if 'start' in response:
+                put(('start', response.pop('start')))
+              put(('body', chunk))
+          if 'start' in response:
+            put(('start', response.pop('start')))
+        finally:
+          if hasattr(result, 'close'):
+            result.close()
+      finally:
+        if not cancelled.is_set():
+          put(('end', None))
+
+    future = loop.run_in_executor(self.executor, run)
+    try:
+      while True:
+        kind, value = await queue.get()
+        if kind == 'end':
+          break
+        if kind == 'start':
+          status, headers = value
+          await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'),
+                         value.encode('latin-1')) for name, value in headers]
+          })
+        else:
+          await send({'type': 'http.response.body', 'body': value,
+                      'more_body': True})
+    except BaseException:
+      # unblock the producer so it can see the cancellation and stop
+      cancelled.set()
+      while not queue.empty():
+        queue.get_nowait()
+      raise
+    await future
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def create_asgi_app(test_config=None):
+  return AsgiApp(create_app(test_config))
+
+app = create_asgi_app
@@ -0,0 +1,96 @@
+from flask import current_app
+
+from models import db
+from .serialize import dumps
+
+BATCH_METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+# sub-response headers that only describe the batch response as a whole
+SKIPPED_HEADERS = ('content-length', 'vary', 'access-control-')
+
+
+def read_requests(body, limit):
+  '''
+  [(method, path, json body, headers)] from a POST /batch body, or None
+  when it is malformed, empty, longer than `limit` or tries to nest
+  another batch.
+  '''
+  items = body.get('requests') if isinstance(body, dict) else None
+  if not isinstance(items, list) or not items or len(items) > limit:
+    return None
+
+  requests = []
+  for item in items:
+    if not isinstance(item, dict):
+      return None
+    method = str(item.get('method', 'GET')).upper()
+    path = item.get('path')
+    headers = item.get('headers') or {}
+    if method not in BATCH_METHODS or not isinstance(path, str) \
+      or not path.startswith('/') or path.split('?')[0].rstrip('/') == '/batch':
+      return None
+    if not isinstance(headers, dict) \
+      or not all(isinstance(value, str) for value in headers.values()):
+      return None
+    requests.append((method, path, item.get('body'), headers))
+  return requests
+
+
+def dispatch(app, method, path, body, headers):
+  '''
+  Runs one sub-request through the app's full dispatch: before/after
+  request hooks, conditional GETs and the JSON error handlers all apply.
+  It is pushed inside the current app context, so it shares the batch's
+  database session and g. Returns the Response.
+  '''
+  # the batch response is compressed as a whole, not each entry
+  headers = {name: value for name, value in headers.items()
+             if name.lower() != 'accept-encoding'}
+  with app.test_request_context(path, method=method, headers=headers,
+                                json=body):
+    try:
+      return app.full_dispatch_request()
+    except Exception:
+      if app.propagate_exceptions:
+        raise
+      db.session.rollback()
+      app.logger.exception('batched %s %s failed', method, path)
+      return error_response(500, 'Internal Server Error')
+
+
+def error_response(status, message):
+  return current_app.response_class(dumps({
+    'success': False,
+    'error': status,
+    'message': message
+  }), status=status, mimetype='application/json')
+
+
+def encode(response):
+  '''
+  One entry of the batch response as JSON bytes. A JSON body is spliced in
+  as it is, without being decoded and encoded again; other bodies become
+  a string and empty ones null.
+  '''
+  if response.is_streamed:
+    response.close()
+    response = error_response(422, 'Streamed responses cannot be batched')
+
+  headers = {name: value for name, value in response.headers
+             if not name.lower().startswith(SKIPPED_HEADERS)}
+  data = response.get_data()
+  if not data:
+    body = b'null'
+  elif response.mimetype == 'application/json':
+    body = data.strip()
+  else:
+    body = dumps(data.decode('utf-8', 'replace'))
+  return b'{"status":%d,"headers":%s,"body":%s}' % (
+    response.status_code, dumps(headers), body)
+
+
+def batch_response(responses):
+  '''The POST /batch response: the sub-responses in request order.'''
+  return current_app.response_class(
+    b'{"success":true,"responses":[%s]}'
+    % b','.join(encode(response) for response in responses),
+    mimetype='application/json')
@@ -0,0 +1,352 @@
+import csv
+import io
+import json
+from collections import Counter
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, select
+from sqlalchemy.exc import DBAPIError
+
+from models import (db, DataVersion, Question, QuestionCount, bump_version,
+                    commit_writes, count_key, normalize_answer)
+from .cache import category_cache
+from .grading import normalize_missing
+from .serialize import QUESTION_FIELDS, dumps, question_rows
+
+IMPORT_FIELDS = ('question', 'answer', 'category', 'difficulty')
+INSERT_FIELDS = IMPORT_FIELDS + ('answer_normalized',)
+MAX_REPORTED_ERRORS = 100
+EXPORT_BATCH = 1000
+
+
+def read_rows(lines, fmt):
+  '''
+  Yields (line number, raw row) from an iterable of text lines, where the
+  raw row is a dict or, for lines that cannot be parsed, an error string.
+  '''
+  if fmt == 'csv':
+    reader = csv.DictReader(lines)
+    for row in reader:
+      yield reader.line_num, row
+    return
+
+  for number, line in enumerate(lines, 1):
+    if not line.strip():
+      continue
+    try:
+      row = json.loads(line)
+    except ValueError as error:
+      yield number, 'invalid JSON: %s' % error
+      continue
+    yield number, row if isinstance(row, dict) else 'expected a JSON object'
+
+
+def validate(raw, categories):
+  '''Returns (row, None) for a valid question or (None, error message).'''
+  if not isinstance(raw, dict):
+    return None, raw
+  question = str(raw.get('question') or '').strip()
+  answer = str(raw.get('answer') or '').strip()
+  if not question or not answer:
+    return None, 'question and answer are required'
+  try:
+    category = int(raw.get('category'))
+    difficulty = int(raw.get('difficulty'))
+  except (TypeError, ValueError):
+    return None, 'category and difficulty must be integers'
+  if category not in categories:
+    return None, 'unknown category %d' % category
+  if not 1 <= difficulty <= 5:
+    return None, 'difficulty must be between 1 and 5'
+  return {'question': question, 'answer': answer, 'category': category,
+          'difficulty': difficulty,
+          'answer_normalized': normalize_answer(answer)}, None
+
+
+def copy_rows(rows):
+  '''Postgres fast path: streams the batch through COPY ... FROM STDIN.'''
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  for row in rows:
+    writer.writerow([row[field] for field in INSERT_FIELDS])
+  buffer.seek(0)
+  cursor = db.session.connection().connection.cursor()
+  cursor.copy_expert(
+    'COPY questions (%s) FROM STDIN WITH (FORMAT csv)'
+    % ', '.join(INSERT_FIELDS), buffer)
+
+
+def insert_batch(rows):
+  '''
+  Inserts one batch in a single transaction: COPY on Postgres, one
+  executemany INSERT elsewhere, plus the matching question_counts update.
+  '''
+  if db.engine.dialect.name == 'postgresql':
+    copy_rows(rows)
+  else:
+    db.session.execute(Question.__table__.insert(), rows)
+  QuestionCount.adjust(QuestionCount.tally(rows))
+  DataVersion.bump('questions')
+  db.session.commit()
+
+
+def import_questions(lines, fmt='jsonl', batch_size=1000, progress=None):
+  '''
+  Streams questions from `lines` (JSON lines or CSV with a header row)
+  into the database. Rows are validated and inserted in batches of
+  `batch_size`, each in its own transaction. If a batch is rejected by
+  the database, its rows are retried one by one so only the bad rows
+  are lost. `progress`, when given, is called with the running report
+  after every batch.
+  '''
+  categories = set(category_cache.types())
+  report = {'inserted': 0, 'failed': 0, 'errors': []}
+
+  def fail(number, message):
+    report['failed'] += 1
+    if len(report['errors']) < MAX_REPORTED_ERRORS:
+      report['errors'].append({'line': number, 'error': message})
+
+  def flush(batch):
+    try:
+      insert_batch([row for _, row in batch])
+      report['inserted'] += len(batch)
+    except DBAPIError:
+      db.session.rollback()
+      for number, row in batch:
+        try:
+          insert_batch([row])
+          report['inserted'] += 1
+        except DBAPIError as error:
+          db.session.rollback()
+          fail(number, str(error.orig))
+    if progress:
+      progress(report)
+
+  batch = []
+  try:
+    for number, raw in read_rows(lines, fmt):
+      row, error = validate(raw, categories)
+      if error:
+        fail(number, error)
+        continue
+      batch.append((number, row))
+      if len(batch) >= batch_size:
+        flush(batch)
+        batch = []
+    if batch:
+      flush(batch)
+  finally:
+    if report['inserted']:
+      bump_version('questions')
+
+  return report
+
+
+def export_rows(category=None, difficulty=None, batch_size=EXPORT_BATCH):
+  '''
+  Iterates over matching questions as column tuples in id order, fetching
+  `batch_size` rows at a time. yield_per streams the results, which on
+  Postgres uses a server-side (named) cursor, so memory stays flat
+  however large the table is.
+  '''
+  query = Question.query
+  if category is not None:
+    query = query.filter_by(category=category)
+  if difficulty is not None:
+    query = query.filter_by(difficulty=difficulty)
+  return question_rows(query.order_by(Question.id)).yield_per(batch_size)
+
+
+def iter_ndjson(rows, batch_size=EXPORT_BATCH):
+  chunk = []
+  for row in rows:
+    chunk.append(dumps(dict(zip(QUESTION_FIELDS, row))))
+    if len(chunk) >= batch_size:
+      yield b'\n'.join(chunk) + b'\n'
+      chunk = []
+  if chunk:
+    yield b'\n'.join(chunk) + b'\n'
+
+
+def iter_csv(rows, batch_size=EXPORT_BATCH):
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  writer.writerow(QUESTION_FIELDS)
+  for number, row in enumerate(rows, 1):
+    writer.writerow(row)
+    if number % batch_size == 0:
+      yield buffer.getvalue().encode('utf-8')
+      buffer.seek(0)
+      buffer.truncate()
+  yield buffer.getvalue().encode('utf-8')
+
+
+EXPORT_FORMATS = {
+  'ndjson': (iter_ndjson, 'application/x-ndjson'),
+  'csv': (iter_csv, 'text/csv')
+}
+
+
+def question_criteria(body):
+  '''
+  Builds WHERE criteria from a bulk request body: any of `ids` (a list of
+  question ids), `category` and `difficulty`. Returns None when the body
+  selects nothing or is malformed, so a bulk call can never touch the
+  whole table by accident.
+  '''
+  if not isinstance(body, dict):
+    return None
+  criteria = []
+  try:
+    if body.get('ids') is not None:
+      ids = body['ids']
+      if not isinstance(ids, list) or not ids:
+        return None
+      criteria.append(Question.id.in_([int(i) for i in ids]))
+    if body.get('category') is not None:
+      criteria.append(Question.category == int(body['category']))
+    if body.get('difficulty') is not None:
+      criteria.append(Question.difficulty == int(body['difficulty']))
+  except (TypeError, ValueError):
+    return None
+  return criteria or None
+
+
+def update_values(changes):
+  '''Validates the `set` part of a bulk update: category and/or difficulty.'''
+  if not isinstance(changes, dict) or not changes:
+    return None
+  values = {}
+  try:
+    for field, value in changes.items():
+      if field == 'category' and category_cache.find(int(value)):
+        values['category'] = int(value)
+      elif field == 'difficulty' and 1 <= int(value) <= 5:
+        values['difficulty'] = int(value)
+      else:
+        return None
+  except (TypeError, ValueError):
+    return None
+  return values
+
+
+def locked_keys(criteria):
+  '''
+  count_key() of every question matching `criteria`, read with SELECT ...
+  FOR UPDATE so the rows cannot change before the caller's write.
+  '''
+  return [count_key(category, difficulty) for category, difficulty
+          in db.session.query(Question.category, Question.difficulty)
+          .filter(*criteria).with_for_update()]
+
+
+def bulk_delete(criteria):
+  '''
+  Deletes every matching question with one DELETE in one transaction,
+  which also carries the question_counts adjustment. The adjustment is
+  taken from the rows actually deleted (DELETE ... RETURNING on Postgres,
+  locked rows elsewhere), so a concurrent write cannot make it drift.
+  '''
+  table = Question.__table__
+  if db.engine.dialect.name == 'postgresql':
+    keys = [count_key(category, difficulty) for category, difficulty
+            in db.session.execute(table.delete().where(and_(*criteria))
+                                  .returning(table.c.category,
+                                             table.c.difficulty))]
+  else:
+    keys = locked_keys(criteria)
+    db.session.execute(table.delete().where(and_(*criteria)))
+
+  deltas = Counter()
+  for key in keys:
+    deltas[key] -= 1
+  QuestionCount.adjust(deltas)
+  commit_writes('questions')
+  return len(keys)
+
+
+def bulk_update(criteria, values):
+  '''
+  Updates every matching question with one UPDATE in one transaction,
+  which also moves their counts in question_counts. On Postgres the old
+  and new keys come back from the UPDATE itself, the old ones through a
+  FOR UPDATE subquery; elsewhere the rows are locked first.
+  '''
+  table = Question.__table__
+  if db.engine.dialect.name == 'postgresql':
+    old = select([table.c.id, table.c.category, table.c.difficulty]) \
+      .where(and_(*criteria)).with_for_update().alias('old')
+    changes = [(count_key(category, difficulty), count_key(*after))
+               for category, difficulty, *after in db.session.execute(
+                 table.update().where(table.c.id == old.c.id).values(values)
+                 .returning(old.c.category, old.c.difficulty,
+                            table.c.category, table.c.difficulty))]
+  else:
+    changes = [(before, count_key(values.get('category', before[0]),
+                                  values.get('difficulty', before[1])))
+               for before in locked_keys(criteria)]
+    db.session.execute(table.update().where(and_(*criteria)).values(values))
+
+  deltas = Counter()
+  for before, after in changes:
+    deltas[before] -= 1
+    deltas[after] += 1
+  QuestionCount.adjust(deltas)
+  commit_writes('questions')
+  return len(changes)
+
+
+questions_cli = AppGroup('questions', help='Bulk question operations.')
+
+
+@questions_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              help='Defaults to the file extension.')
+@click.option('--batch-size', default=1000, show_default=True)
+def import_command(path, fmt, batch_size):
+  '''Import questions from a JSON lines or CSV file.'''
+  fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+
+  def progress(report):
+    click.echo('inserted %(inserted)d, failed %(failed)d' % report, err=True)
+
+  with open(path, newline='', encoding='utf-8') as handle:
+    report = import_questions(handle, fmt, batch_size, progress)
+
+  for error in report['errors']:
+    click.echo('line %(line)d: %(error)s' % error, err=True)
+  click.echo(json.dumps({'inserted': report['inserted'],
+                         'failed': report['failed']}))
+
+
+@questions_cli.command('export')
+@click.argument('path', required=False, type=click.Path(dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(sorted(EXPORT_FORMATS)),
+              default='ndjson', show_default=True)
+@click.option('--category', type=int)
+@click.option('--difficulty', type=int)
+def export_command(path, fmt, category, difficulty):
+  '''Export questions as JSON lines or CSV to PATH (default stdout).'''
+  encode = EXPORT_FORMATS[fmt][0]
+  with click.open_file(path or '-', 'wb') as handle:
+    for chunk in encode(export_rows(category, difficulty)):
+      handle.write(chunk)
+
+
+@questions_cli.command('normalize')
+def normalize_command():
+  '''Fill in normalized answers missing since migration 0004.'''
+  click.echo('%d answer(s) normalized' % normalize_missing())
+
+
+stats_cli = AppGroup('stats', help='Question count aggregates.')
+
+
+@stats_cli.command('rebuild')
+def rebuild_stats_command():
+  '''Recompute question_counts from the questions table.'''
+  QuestionCount.rebuild()
+  click.echo('question counts rebuilt')
@@ -0,0 +1,203 @@
+import time
+from threading import Lock
+
+from models import Category, Question, QuestionCount, table_versions
+from .http_cache import payload_version
+from .pagination import QUESTIONS_PER_PAGE
+from .serialize import format_rows, question_rows
+
+
+class TableCache:
+  '''
+  Process-local snapshot of a small table shared by every handler.
+
+  The snapshot is reloaded when the table version moves (the model write
+  methods bump it), when `invalidate()` is called, or once the TTL has
+  passed, which bounds staleness from writes made by other workers. Hit
+  and miss counters are available from `stats()`.
+  '''
+
+  table = None
+
+  def __init__(self, ttl=300):
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self._snapshot = None
+    self._lock = Lock()
+
+  def fetch(self):
+    raise NotImplementedError
+
+  def stale(self):
+    '''True when the next read will reload from the database.'''
+    snapshot = self._snapshot
+    return snapshot is None or snapshot[0] != table_versions[self.table] \
+      or snapshot[1] <= time.monotonic()
+
+  def _load(self):
+    version = table_versions[self.table]
+    now = time.monotonic()
+    snapshot = self._snapshot
+    if snapshot is not None and snapshot[0] == version and snapshot[1] > now:
+      self.hits += 1
+      return snapshot[2]
+
+    self.misses += 1
+    data = self.fetch()
+    with self._lock:
+      self._snapshot = (version, now + self.ttl, data)
+    return data
+
+  def invalidate(self):
+    with self._lock:
+      self._snapshot = None
+      self.invalidations += 1
+
+  def stats(self):
+    return {
+      'hits': self.hits,
+      'misses': self.misses,
+      'invalidations': self.invalidations,
+      'size': len(self._snapshot[2]) if self._snapshot else 0,
+      'ttl': self.ttl
+    }
+
+
+class CategoryCache(TableCache):
+  '''The categories table as a list of Category.format() dicts.'''
+
+  table = 'categories'
+
+  def fetch(self):
+    return [category.format()
+            for category in Category.query.order_by(Category.id)]
+
+  def all(self):
+    return self._load()
+
+  def types(self):
+    return {category['id']: category['type'] for category in self._load()}
+
+  def get(self, category_id):
+    for category in self._load():
+      if category['id'] == category_id:
+        return category
+    return None
+
+  def find(self, category_id):
+    '''
+    get() for validating writes: a miss is checked against the database,
+    so a category added by another worker or through psql is accepted
+    before the TTL runs out, and the snapshot reloads on the next read.
+    '''
+    category = self.get(category_id)
+    if category is None:
+      record = Category.query.get(category_id)
+      if record is not None:
+        self.invalidate()
+        category = record.format()
+    return category
+
+
+class QuestionStatsCache(TableCache):
+  '''
+  The question_counts aggregate as {category: {difficulty: total}}. The
+  aggregate has one row per (category, difficulty), so a reload is cheap
+  and every lookup is constant time however large the bank grows.
+  '''
+
+  table = 'questions'
+
+  def fetch(self):
+    counts = {}
+    for row in QuestionCount.query.filter(QuestionCount.total > 0):
+      counts.setdefault(row.category, {})[row.difficulty] = row.total
+    return counts
+
+  def by_category(self):
+    return self._load()
+
+  def total(self, category_id=None):
+    counts = self._load()
+    if category_id is not None:
+      return sum(counts.get(category_id, {}).values())
+    return sum(sum(difficulties.values()) for difficulties in counts.values())
+
+  def by_difficulty(self):
+    totals = {}
+    for difficulties in self._load().values():
+      for difficulty, total in difficulties.items():
+        totals[difficulty] = totals.get(difficulty, 0) + total
+    return totals
+
+
+class FirstPageCache(TableCache):
+  '''
+  The first page of questions in id order, formatted, which every cold
+  load of the question list starts from.
+  '''
+
+  table = 'questions'
+
+  def fetch(self):
+    query = Question.query.order_by(Question.id).limit(QUESTIONS_PER_PAGE)
+    return format_rows(question_rows(query))
+
+  def questions(self):
+    return self._load()
+
+
+category_cache = CategoryCache()
+question_stats = QuestionStatsCache(ttl=30)
+first_page = FirstPageCache(ttl=30)
+
+
+def question_summary():
+  '''The GET /stats payload, built from the two caches.'''
+  categories = {}
+  counts = question_stats.by_category()
+  for category in category_cache.all():
+    difficulties = counts.get(category['id'], {})
+    categories[category['id']] = {
+      'type': category['type'],
+      'total_questions': sum(difficulties.values()),
+      'difficulties': difficulties
+    }
+
+  return {
+    'success': True,
+    'total_questions': question_stats.total(),
+    'categories': categories,
+    'difficulties': question_stats.by_difficulty()
+  }
+
+
+def bootstrap_stale():
+  return category_cache.stale() or question_stats.stale() \
+    or first_page.stale()
+
+
+def bootstrap_payload():
+  '''
+  The GET /bootstrap payload: everything the frontend needs for its first
+  render, from the three caches. Only the caches that went stale query
+  the database, so a write to questions costs two queries and a warm load
+  none.
+  '''
+  counts = question_stats.by_category()
+  categories = category_cache.all()
+  payload = {
+    'success': True,
+    'categories': categories,
+    'questions': first_page.questions(),
+    'page': 1,
+    'total_questions': question_stats.total(),
+    'category_counts': {
+      category['id']: sum(counts.get(category['id'], {}).values())
+      for category in categories
+    }
+  }
+  payload['version'] = payload_version(payload)
+  return payload
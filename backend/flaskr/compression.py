@@ -0,0 +1,182 @@
+import zlib
+from collections import OrderedDict
+from threading import Lock
+
+from flask import request
+from werkzeug.http import parse_accept_header
+
+from models import setting
+
+try:
+  import brotli
+except ImportError:
+  try:
+    import brotlicffi as brotli
+  except ImportError:
+    brotli = None
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/')
+
+# (level per request, level for a variant served again from the cache),
+# picked with benchmarks.bench_compression on a 13 kB page: per request the
+# level past which the ratio stops paying for the time (br 5: 6.7x in
+# 0.12 ms), for repeat hits a slow level whose cost is spread over the
+# hits that follow (br 10: 7.4x, 5 ms)
+LEVELS = {
+  'br': (5, 10),
+  'zstd': (3, 19),
+  'gzip': (6, 9)
+}
+
+
+def gzip_compress(data, level):
+  # zlib with a gzip header and a zero mtime, so equal bodies compress to
+  # equal bytes
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+  return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data, level):
+  return brotli.compress(data, quality=level)
+
+
+def zstd_compress(data, level):
+  return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+# in order of preference when the client accepts several equally
+ENCODERS = OrderedDict((name, encode) for name, encode, available in (
+  ('br', brotli_compress, brotli is not None),
+  ('zstd', zstd_compress, zstandard is not None),
+  ('gzip', gzip_compress, True)
+) if available)
+
+
+def compressible(content_type):
+  return (content_type or '').startswith(COMPRESSIBLE)
+
+
+class Compressor:
+  '''
+  Negotiates a Content-Encoding and compresses response bodies of at
+  least `min_size` bytes.
+
+  Bodies of responses with an ETag (the conditional GET routes) are kept
+  compressed in an LRU of `cache_size` variants, keyed by path, ETag,
+  encoding and a CRC of the body, so repeat hits are served without
+  compressing again. A variant is first compressed at the per-request
+  level, like any response: most keys (a cursor walk, say) are never
+  asked for twice. Only the first repeat hit recompresses it at the
+  slower, tighter level in LEVELS, for the hits after it.
+  '''
+
+  def __init__(self, min_size=1024, cache_size=256):
+    self.min_size = min_size
+    self.cache_size = cache_size
+    self.hits = 0
+    self.misses = 0
+    self.upgrades = 0
+    self._variants = OrderedDict()
+    self._lock = Lock()
+
+  def choose(self, accept_encoding):
+    '''The encoding to use for an Accept-Encoding header, or None.'''
+    accepted = parse_accept_header(accept_encoding)
+    best, best_quality = None, 0
+    for name in ENCODERS:
+      quality = accepted.quality(name)
+      if quality > best_quality:
+        best, best_quality = name, quality
+    return best
+
+  def compress(self, data, encoding, key=None):
+    per_request, repeated = LEVELS[encoding]
+    if key is None or not self.cache_size:
+      return ENCODERS[encoding](data, per_request)
+
+    key = key + (encoding, len(data), zlib.crc32(data))
+    variant = self._variants.get(key)
+    if variant is None:
+      body = ENCODERS[encoding](data, per_request)
+      with self._lock:
+        self.misses += 1
+        self._variants[key] = (body, False)
+        while len(self._variants) > self.cache_size:
+          self._variants.popitem(last=False)
+      return body
+
+    body, tight = variant
+    if not tight:
+      body = ENCODERS[encoding](data, repeated)
+    with self._lock:
+      self.hits += 1
+      if not tight:
+        self.upgrades += 1
+      if key in self._variants:
+        self._variants[key] = (body, True)
+        self._variants.move_to_end(key)
+    return body
+
+  def encode(self, status, content_type, data, accept_encoding, key=None):
+    '''
+    (body, encoding) for a response: the body compressed for the client,
+    or unchanged with a None encoding when it is not a compressible 200
+    of at least min_size bytes or the client accepts no known encoding.
+    '''
+    if status != 200 or len(data) < self.min_size \
+      or not compressible(content_type):
+      return data, None
+    encoding = self.choose(accept_encoding)
+    if encoding is None:
+      return data, None
+    return self.compress(data, encoding, key), encoding
+
+  def stats(self):
+    return {
+      'encodings': list(ENCODERS),
+      'hits': self.hits,
+      'misses': self.misses,
+      'upgrades': self.upgrades,
+      'size': len(self._variants),
+      'bytes': sum(len(body) for body, _ in list(self._variants.values()))
+    }
+
+
+def init_compression(app):
+  '''
+  Compresses the responses of `app` with the best encoding the client
+  accepts: br and zstd when brotli (or brotlicffi) and zstandard are
+  installed, gzip always. COMPRESS=false turns it off, COMPRESS_MIN_SIZE
+  (1024) is the smallest body compressed and COMPRESS_CACHE_SIZE (256) the
+  number of precompressed variants kept. Streamed responses are left
+  alone.
+  '''
+  if not setting(app, 'COMPRESS', True, type=bool):
+    return
+  compressor = Compressor(setting(app, 'COMPRESS_MIN_SIZE', 1024),
+                          setting(app, 'COMPRESS_CACHE_SIZE', 256))
+  app.extensions['compressor'] = compressor
+
+  @app.after_request
+  def compress_response(response):
+    if not compressible(response.mimetype):
+      return response
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed or response.direct_passthrough \
+      or 'Content-Encoding' in response.headers:
+      return response
+
+    etag = response.headers.get('ETag')
+    body, encoding = compressor.encode(
+      response.status_code, response.mimetype, response.get_data(),
+      request.headers.get('Accept-Encoding'),
+      (request.full_path, etag) if etag else None)
+    if encoding is not None:
+      response.set_data(body)
+      response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,143 @@
+from sqlalchemy import bindparam
+
+from models import db, Question, normalize_answer
+
+# at most this many answers are graded per batch request
+MAX_BATCH = 100
+# a guess may carry this many words beyond the answer's own, so listing
+# every word one can think of does not pass
+MAX_EXTRA_TOKENS = 3
+
+
+def typo_budget(token):
+  '''Edits forgiven in an answer token: none for short words and numbers.'''
+  if len(token) < 4 or any(char.isdigit() for char in token):
+    return 0
+  return 1 if len(token) < 8 else 2
+
+
+def within_distance(a, b, limit):
+  '''
+  True when the Levenshtein distance between a and b is at most `limit`.
+  Only the diagonal band of width 2 * limit + 1 is computed, and the scan
+  stops as soon as a whole row is over the limit, so a comparison costs
+  O(limit * len) instead of O(len(a) * len(b)).
+  '''
+  if a == b:
+    return True
+  if abs(len(a) - len(b)) > limit:
+    return False
+  if limit == 0:
+    return False
+
+  over = limit + 1
+  previous = [j if j <= limit else over for j in range(len(b) + 1)]
+  for i in range(1, len(a) + 1):
+    low = max(1, i - limit)
+    high = min(len(b), i + limit)
+    current = [over] * (len(b) + 1)
+    current[0] = i if i <= limit else over
+    best = current[0]
+    char = a[i - 1]
+    for j in range(low, high + 1):
+      cost = previous[j - 1] + (char != b[j - 1])
+      cost = min(cost, previous[j] + 1, current[j - 1] + 1)
+      current[j] = cost if cost <= limit else over
+      best = min(best, current[j])
+    if best > limit:
+      return False
+    previous = current
+  return previous[len(b)] <= limit
+
+
+def grade(guess, expected):
+  '''
+  Grades a player's guess against a normalized answer (see
+  models.normalize_answer). Correct when the normalized forms are equal,
+  when every answer word appears in the guess give or take typo_budget()
+  edits, or when the two match with the spaces taken out
+  ("spider man" for "Spiderman").
+  '''
+  guess = normalize_answer(guess)
+  if not guess or not expected:
+    return False
+  if guess == expected:
+    return True
+
+  answer_tokens = expected.split()
+  guess_tokens = guess.split()
+  if len(guess_tokens) > len(answer_tokens) + MAX_EXTRA_TOKENS:
+    return False
+
+  joined = expected.replace(' ', '')
+  if within_distance(guess.replace(' ', ''), joined, typo_budget(joined)):
+    return True
+
+  for token in answer_tokens:
+    limit = typo_budget(token)
+    if not any(within_distance(candidate, token, limit)
+               for candidate in guess_tokens):
+      return False
+  return True
+
+
+def grade_answers(submissions):
+  '''
+  Grades [(question id, guess)] with one query for all their answers.
+  Returns a result dict per submission, in order; questions that no longer
+  exist are graded as wrong with a None answer.
+  '''
+  ids = {question_id for question_id, _ in submissions}
+  answers = {
+    question_id: (answer, normalized if normalized is not None
+                  else normalize_answer(answer))
+    for question_id, answer, normalized in db.session.query(
+      Question.id, Question.answer, Question.answer_normalized)
+    .filter(Question.id.in_(ids))
+  } if ids else {}
+
+  results = []
+  for question_id, guess in submissions:
+    answer, normalized = answers.get(question_id, (None, None))
+    results.append({
+      'question_id': question_id,
+      'correct': answer is not None and grade(guess, normalized),
+      'answer': answer
+    })
+  return results
+
+
+def read_submission(item):
+  '''(question id, guess) from a request item, or None when malformed.'''
+  if not isinstance(item, dict):
+    return None
+  try:
+    question_id = int(item.get('question_id'))
+  except (TypeError, ValueError):
+    return None
+  guess = item.get('answer')
+  if not isinstance(guess, str):
+    return None
+  return question_id, guess
+
+
+def normalize_missing(batch_size=1000):
+  '''
+  Fills in answer_normalized where it is NULL, e.g. for rows that existed
+  before migration 0004, one batch per transaction. Returns the count.
+  '''
+  updated = 0
+  while True:
+    rows = db.session.query(Question.id, Question.answer) \
+      .filter(Question.answer_normalized.is_(None)) \
+      .order_by(Question.id).limit(batch_size).all()
+    if not rows:
+      return updated
+    db.session.execute(
+      Question.__table__.update()
+      .where(Question.id == bindparam('row_id'))
+      .values(answer_normalized=bindparam('normalized')),
+      [{'row_id': row_id, 'normalized': normalize_answer(answer)}
+       for row_id, answer in rows])
+    db.session.commit()
+    updated += len(rows)
@@ -0,0 +1,113 @@
+import hashlib
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, make_response, request
+from werkzeug.http import http_date, parse_date, parse_etags
+
+from models import DataVersion, observe_versions, table_modified
+from .serialize import dumps
+
+# Without shared versions (a table not written since the data_versions rows
+# were added) Last-Modified falls back to the per-process modification
+# times, bucketed: a worker that missed another worker's write stops
+# answering 304 to If-Modified-Since once the bucket rolls over.
+STALE_AFTER = 30
+
+
+def body_etag(data):
+  '''
+  The ETag of a response body: a hash of its bytes, so every worker, and a
+  restarted one, issues the same validator for the same data.
+  '''
+  return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def payload_version(payload):
+  '''A version string that changes exactly when `payload` does.'''
+  return body_etag(dumps(payload))
+
+
+def version_validators(tables, versions):
+  '''
+  (etag, modified) from the shared {table: (version, modified)} of
+  `tables`, or None when one of them has no row yet. Also refreshes the
+  process caches of any table another worker has written since.
+  '''
+  if any(table not in versions for table in tables):
+    return None
+  observe_versions({table: versions[table][0] for table in tables})
+  etag = body_etag(' '.join('%s:%d:%r' % (table, version, modified)
+                            for table, (version, modified)
+                            in sorted(versions.items())).encode('utf-8'))
+  modified = max(modified for _, modified in versions.values())
+  return etag, datetime.utcfromtimestamp(int(modified))
+
+
+def shared_validators(tables):
+  '''version_validators() for `tables`, read with one primary key lookup.'''
+  return version_validators(tables, DataVersion.read(tables))
+
+
+def last_modified(tables):
+  bucket_start = time.time() // STALE_AFTER * STALE_AFTER
+  latest = max([bucket_start] + [table_modified[table] for table in tables])
+  return datetime.utcfromtimestamp(int(latest))
+
+
+def is_fresh(etag, modified, headers=None):
+  '''
+  Whether the request's If-None-Match / If-Modified-Since match. `headers`
+  defaults to the current Flask request's.
+  '''
+  headers = request.headers if headers is None else headers
+  if_none_match = headers.get('If-None-Match')
+  if if_none_match:
+    return parse_etags(if_none_match).contains_weak(etag)
+  if_modified_since = parse_date(headers.get('If-Modified-Since'))
+  if if_modified_since:
+    return if_modified_since.replace(tzinfo=None) >= modified
+  return False
+
+
+def cache_headers(etag, modified, max_age=0):
+  cache_control = 'public, max-age=%d' % max_age
+  if not max_age:
+    cache_control += ', no-cache'
+  return [
+    ('ETag', 'W/"%s"' % etag),
+    ('Last-Modified', http_date(modified)),
+    ('Cache-Control', cache_control)
+  ]
+
+
+def conditional(*tables, max_age=0):
+  '''
+  Conditional GET support for read endpoints whose body only depends on
+  the given tables. The ETag and Last-Modified come from the tables' rows
+  in data_versions, which every worker shares, so a matching
+  If-None-Match / If-Modified-Since is answered with an empty 304 before
+  the view runs. Until a table has a row, the ETag is a hash of the body
+  the view produced.
+  '''
+  def decorator(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+      validators = shared_validators(tables)
+      if validators is not None and is_fresh(*validators):
+        response = current_app.response_class(status=304)
+      else:
+        response = make_response(view(*args, **kwargs))
+        if response.status_code != 200 or response.is_streamed:
+          return response
+        if validators is None:
+          validators = (body_etag(response.get_data()), last_modified(tables))
+          if is_fresh(*validators):
+            response = current_app.response_class(status=304)
+
+      for name, value in cache_headers(*validators, max_age):
+        response.headers[name] = value
+      return response
+    return wrapper
+  return decorator
@@ -0,0 +1,207 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import setting
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+# the RequestStats of the request running in this thread or task
+current_stats = ContextVar('request_stats', default=None)
+# the queries.QueryLog collecting statements in this thread or task, if any
+current_queries = ContextVar('query_log', default=None)
+
+
+class RequestStats:
+  '''Per-request counters filled in by the cursor hooks.'''
+
+  __slots__ = ('started', 'queries', 'db_time')
+
+  def __init__(self):
+    self.started = time.perf_counter()
+    self.queries = 0
+    self.db_time = 0.0
+
+  def add_query(self, elapsed):
+    self.queries += 1
+    self.db_time += elapsed
+
+  def server_timing(self, duration):
+    '''Server-Timing header value, durations in milliseconds.'''
+    return 'db;dur=%.2f;desc="%d queries", app;dur=%.2f' % (
+      self.db_time * 1000, self.queries, duration * 1000)
+
+
+class Histogram:
+  '''Bucket counts, sum and count in the shape Prometheus exposes.'''
+
+  __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+  def __init__(self, buckets):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)
+    self.sum = 0
+    self.count = 0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def samples(self):
+    cumulative = 0
+    for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+      cumulative += count
+      yield str(bound), cumulative
+
+
+class Metrics:
+  '''
+  Process-wide request metrics per (method, route), where the route is the
+  URL rule rather than the path so ids do not multiply the series. One
+  lock round trip per request; rendering copies nothing it does not print.
+  '''
+
+  HISTOGRAMS = (
+    ('trivia_request_duration_seconds', 'Request latency.', LATENCY_BUCKETS),
+    ('trivia_request_db_queries', 'Database statements per request.',
+     QUERY_BUCKETS),
+    ('trivia_request_db_seconds', 'Time spent in the database per request.',
+     LATENCY_BUCKETS),
+    ('trivia_response_size_bytes', 'Response body size.', SIZE_BUCKETS),
+  )
+
+  def __init__(self):
+    self._lock = Lock()
+    self._routes = {}
+    self._responses = {}
+
+  def record(self, method, route, status, duration, stats, size=None):
+    with self._lock:
+      histograms = self._routes.get((method, route))
+      if histograms is None:
+        histograms = self._routes[(method, route)] = [
+          Histogram(buckets) for _, _, buckets in self.HISTOGRAMS]
+      key = (method, route, status)
+      self._responses[key] = self._responses.get(key, 0) + 1
+      histograms[0].observe(duration)
+      histograms[1].observe(stats.queries)
+      histograms[2].observe(stats.db_time)
+      if size is not None:
+        histograms[3].observe(size)
+
+  def reset(self):
+    with self._lock:
+      self._routes.clear()
+      self._responses.clear()
+
+  def render(self):
+    '''The Prometheus text exposition format (version 0.0.4).'''
+    lines = [
+      '# HELP trivia_requests_total Requests by route and status.',
+      '# TYPE trivia_requests_total counter'
+    ]
+    with self._lock:
+      for (method, route, status), total in sorted(self._responses.items()):
+        lines.append('trivia_requests_total{%s,status="%d"} %d'
+                     % (labels(method, route), status, total))
+
+      for index, (name, description, _) in enumerate(self.HISTOGRAMS):
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s histogram' % name)
+        for (method, route), histograms in sorted(self._routes.items()):
+          histogram = histograms[index]
+          route_labels = labels(method, route)
+          for bound, count in histogram.samples():
+            lines.append('%s_bucket{%s,le="%s"} %d'
+                         % (name, route_labels, bound, count))
+          lines.append('%s_sum{%s} %r' % (name, route_labels,
+                                          float(histogram.sum)))
+          lines.append('%s_count{%s} %d' % (name, route_labels,
+                                            histogram.count))
+    return '\n'.join(lines) + '\n'
+
+
+def labels(method, route):
+  route = route.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return 'method="%s",route="%s"' % (method, route)
+
+
+metrics = Metrics()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+  if context is not None and (current_stats.get() is not None
+                              or current_queries.get() is not None):
+    context._metrics_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+  started = getattr(context, '_metrics_started', None)
+  if started is None:
+    return
+  elapsed = time.perf_counter() - started
+  stats = current_stats.get()
+  if stats is not None:
+    stats.add_query(elapsed)
+  log = current_queries.get()
+  if log is not None:
+    log.add(statement, parameters, elapsed)
+
+
+def install_cursor_hooks():
+  '''Times statements on every engine for the current stats and query log.'''
+  if not event.contains(Engine, 'before_cursor_execute', before_cursor_execute):
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def init_metrics(app):
+  '''
+  Records every request of `app` into `metrics`: latency, database
+  statements and time (through cursor events on every engine) and
+  response size. With SERVER_TIMING on, the numbers are also sent back in
+  a Server-Timing header for the browser devtools. METRICS=false turns
+  the hooks off.
+  '''
+  if not setting(app, 'METRICS', True, type=bool):
+    return
+  server_timing = setting(app, 'SERVER_TIMING', False, type=bool)
+
+  install_cursor_hooks()
+
+  @app.before_request
+  def start_request_metrics():
+    # a stack, since POST /batch dispatches requests within a request
+    g.setdefault('request_metrics', []).append(
+      current_stats.set(RequestStats()))
+
+  @app.after_request
+  def record_request_metrics(response):
+    stats = current_stats.get()
+    if stats is None:
+      return response
+    duration = time.perf_counter() - stats.started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.record(request.method, route, response.status_code, duration,
+                   stats, None if response.is_streamed
+                   else response.calculate_content_length())
+    if server_timing:
+      response.headers['Server-Timing'] = stats.server_timing(duration)
+    return response
+
+  @app.teardown_request
+  def end_request_metrics(error=None):
+    tokens = g.get('request_metrics')
+    if tokens:
+      current_stats.reset(tokens.pop())
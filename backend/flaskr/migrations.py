@@ -0,0 +1,167 @@
+import os
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from models import db
+
+MIGRATIONS_DIR = os.path.join(
+  os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'migrations')
+
+# 0002_question_indexes.sql runs everywhere,
+# 0003_question_category_fk.sqlite.sql only on SQLite
+FILENAME = re.compile(r'^(\d+)_(\w+?)(?:\.(\w+))?\.sql$')
+
+# versions whose changes the models declare themselves (indexes, the
+# integer category key, answer_normalized, question_counts, data_versions),
+# so a schema create_all() has just built already has them. 0001's search
+# column and trigger are not in the models and still run on a new database.
+IN_MODELS = ('0002', '0003', '0004', '0005', '0006')
+
+
+def available(dialect, directory=MIGRATIONS_DIR):
+  '''
+  Returns [(version, name, path)] of the migrations for `dialect` in
+  version order. A dialect-specific file wins over a generic one with the
+  same version; files for other dialects are skipped.
+  '''
+  found = {}
+  for filename in sorted(os.listdir(directory)):
+    match = FILENAME.match(filename)
+    if not match:
+      continue
+    version, name, target = match.groups()
+    if target not in (None, dialect):
+      continue
+    if target is None and version in found:
+      continue
+    found[version] = (version, name, os.path.join(directory, filename))
+  return [found[version] for version in sorted(found)]
+
+
+def applied():
+  db.session.execute(text(
+    'CREATE TABLE IF NOT EXISTS schema_migrations ('
+    'version VARCHAR(32) PRIMARY KEY, name VARCHAR(255) NOT NULL, '
+    'applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)'))
+  db.session.commit()
+  return {row[0] for row
+          in db.session.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def pending():
+  done = applied()
+  return [migration for migration in available(db.engine.dialect.name)
+          if migration[0] not in done]
+
+
+def apply(version, name, path):
+  '''
+  Runs one migration script and records it in schema_migrations in the
+  same transaction.
+  '''
+  with open(path, encoding='utf-8') as script:
+    sql = script.read()
+
+  connection = db.engine.raw_connection()
+  try:
+    if db.engine.dialect.name == 'sqlite':
+      # executescript commits on its own, so the transaction is spelled out
+      connection.executescript(
+        'BEGIN;\n%s\n;INSERT INTO schema_migrations (version, name) '
+        "VALUES ('%s', '%s');\nCOMMIT;" % (sql, version, name))
+    else:
+      cursor = connection.cursor()
+      cursor.execute(sql)
+      cursor.execute(
+        'INSERT INTO schema_migrations (version, name) VALUES (%s, %s)',
+        (version, name))
+      connection.commit()
+  except Exception:
+    connection.rollback()
+    raise
+  finally:
+    connection.close()
+
+
+def stamp(versions=IN_MODELS):
+  '''
+  Records `versions` as applied without running them, for a schema that
+  setup_db() has just created from the models. Running 0003 there would
+  rebuild the questions table without the columns added since.
+  '''
+  done = applied()
+  rows = [{'version': version, 'name': name}
+          for version, name, _ in available(db.engine.dialect.name)
+          if version in versions and version not in done]
+  try:
+    if rows:
+      db.session.execute(text(
+        'INSERT INTO schema_migrations (version, name) '
+        'VALUES (:version, :name)'), rows)
+      db.session.commit()
+  except IntegrityError:
+    # another worker created the schema at the same time and stamped it
+    db.session.rollback()
+  finally:
+    # this ran outside any request; without this its session, pinned to
+    # the primary, would be reused by the first request
+    db.session.remove()
+
+
+def upgrade(echo=None):
+  '''Applies every pending migration in order; returns their versions.'''
+  done = []
+  for version, name, path in pending():
+    if echo:
+      echo('applying %s_%s' % (version, name))
+    apply(version, name, path)
+    done.append(version)
+  return done
+
+
+def orphaned_questions():
+  '''
+  Ids of questions whose category is not in the categories table. The
+  comparison is done on text so it also runs before the category column
+  has been migrated to an integer.
+  '''
+  return [row[0] for row in db.session.execute(text(
+    'SELECT q.id FROM questions q LEFT JOIN categories c '
+    'ON CAST(c.id AS VARCHAR) = CAST(q.category AS VARCHAR) '
+    "WHERE q.category IS NOT NULL AND CAST(q.category AS VARCHAR) <> '' "
+    'AND c.id IS NULL ORDER BY q.id'))]
+
+
+db_cli = AppGroup('db', help='Schema migrations.')
+
+
+@db_cli.command('upgrade')
+def upgrade_command():
+  '''Apply all pending migrations.'''
+  done = upgrade(echo=click.echo)
+  click.echo('%d migration(s) applied' % len(done))
+
+
+@db_cli.command('status')
+def status_command():
+  '''List migrations and whether they have been applied.'''
+  done = applied()
+  for version, name, _ in available(db.engine.dialect.name):
+    click.echo('%s %s_%s' % ('applied' if version in done else 'pending',
+                             version, name))
+
+
+@db_cli.command('check')
+@click.pass_context
+def check_command(context):
+  '''Report questions that reference a missing category.'''
+  orphans = orphaned_questions()
+  if orphans:
+    click.echo('questions with a missing category: %s'
+               % ', '.join(str(question_id) for question_id in orphans))
+    context.exit(1)
+  click.echo('ok')
@@ -0,0 +1,90 @@
+import base64
+import binascii
+
+from flask import abort
+
+from models import Question
+from .serialize import format_rows, question_rows
+
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+
+
+def page_size(request):
+  limit = request.args.get('limit', QUESTIONS_PER_PAGE, type=int)
+  return max(1, min(limit, MAX_QUESTIONS_PER_PAGE))
+
+
+def page_offset(request, total):
+  '''Row offset of the requested page, or None when it is out of range.'''
+  page = request.args.get('page', 1, type=int)
+  start = (page-1) * QUESTIONS_PER_PAGE
+
+  if page < 1 or start >= total:
+    return None
+  return start
+
+
+def paginate(request, query, total):
+  '''
+  Returns the formatted questions for the requested page of `query`, whose
+  row count `total` the caller already knows. Only one page of column
+  tuples is loaded and LIMIT/OFFSET run in SQL.
+  '''
+  start = page_offset(request, total)
+  if start is None:
+    return []
+
+  rows = question_rows(query.order_by(Question.id)) \
+    .offset(start).limit(QUESTIONS_PER_PAGE).all()
+  return format_rows(rows)
+
+
+def encode_cursor(question_id):
+  token = ('q:%d' % question_id).encode()
+  return base64.urlsafe_b64encode(token).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+  padded = cursor + '=' * (-len(cursor) % 4)
+  try:
+    prefix, question_id = base64.urlsafe_b64decode(padded).decode().split(':')
+    if prefix != 'q':
+      raise ValueError(cursor)
+    return int(question_id)
+  except (binascii.Error, UnicodeDecodeError, ValueError):
+    abort(400)
+
+
+def cursor_position(request):
+  '''The id to seek past for `?after=<cursor>`; None for an empty cursor.'''
+  cursor = request.args.get('after', '')
+  return decode_cursor(cursor) if cursor else None
+
+
+def cursor_page(rows, limit):
+  '''
+  Trims a `limit + 1` row fetch to one page and returns it with the cursor
+  for the next call (None on the last page).
+  '''
+  if len(rows) > limit:
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][0])
+  return rows, None
+
+
+def paginate_after(request, query):
+  '''
+  Keyset pagination: seeks past the id encoded in `?after=<cursor>` and
+  returns up to `?limit=N` questions plus the cursor for the next call
+  (None on the last page). The cost does not grow with the depth walked.
+  An empty `after` starts from the beginning.
+  '''
+  limit = page_size(request)
+  after = cursor_position(request)
+  if after is not None:
+    query = query.filter(Question.id > after)
+
+  rows = question_rows(query.order_by(Question.id)).limit(limit + 1).all()
+  rows, next_cursor = cursor_page(rows, limit)
+  return format_rows(rows), next_cursor
@@ -0,0 +1,120 @@
+from contextlib import contextmanager
+
+from flask import g, request
+
+from models import setting
+from .metrics import current_queries, install_cursor_hooks
+
+# statements run this many times with different parameters in one request
+# look like a loop issuing one query per item
+N_PLUS_ONE_THRESHOLD = 3
+
+
+class QueryLog:
+  '''
+  Statements run while tracking, as (statement, parameters, seconds).
+  Every statement is also added to `parent`, so a request logged inside a
+  test's assertMaxQueries() block counts towards both.
+  '''
+
+  def __init__(self, parent=None):
+    self.parent = parent
+    self.queries = []
+
+  def add(self, statement, parameters, elapsed):
+    self.queries.append((statement, repr(parameters), elapsed))
+    if self.parent is not None:
+      self.parent.add(statement, parameters, elapsed)
+
+  def __len__(self):
+    return len(self.queries)
+
+  def duplicates(self):
+    '''[(statement, times)] for statements repeated with the same parameters.'''
+    counts = {}
+    for statement, parameters, _ in self.queries:
+      key = (statement, parameters)
+      counts[key] = counts.get(key, 0) + 1
+    return [(statement, times)
+            for (statement, _), times in counts.items() if times > 1]
+
+  def repeated(self, threshold=N_PLUS_ONE_THRESHOLD):
+    '''[(statement, times)] for statements run `threshold` or more times.'''
+    counts = {}
+    for statement, _, _ in self.queries:
+      counts[statement] = counts.get(statement, 0) + 1
+    return [(statement, times)
+            for statement, times in counts.items() if times >= threshold]
+
+  def slow(self, threshold):
+    '''[(statement, seconds)] for statements slower than `threshold` seconds.'''
+    return [(statement, elapsed) for statement, _, elapsed in self.queries
+            if elapsed > threshold]
+
+  def report(self):
+    return '\n'.join('%8.2f ms  %s' % (elapsed * 1000,
+                                      ' '.join(statement.split()))
+                     for statement, _, elapsed in self.queries)
+
+
+@contextmanager
+def track_queries():
+  '''Collects the statements run in this thread into a QueryLog.'''
+  install_cursor_hooks()
+  log = QueryLog(current_queries.get())
+  token = current_queries.set(log)
+  try:
+    yield log
+  finally:
+    current_queries.reset(token)
+
+
+class QueryAssertions:
+  '''unittest.TestCase mixin for statement budgets.'''
+
+  @contextmanager
+  def assertMaxQueries(self, n):
+    with track_queries() as log:
+      yield log
+    if len(log) > n:
+      self.fail('%d queries run, expected at most %d:\n%s'
+                % (len(log), n, log.report()))
+
+
+def init_query_tracker(app):
+  '''
+  With QUERY_TRACKER on (the default in debug mode), logs a warning naming
+  the route for every request that repeats a statement with the same
+  parameters, runs one statement N_PLUS_ONE_THRESHOLD or more times, or
+  has a statement slower than SLOW_QUERY_MS (100) milliseconds.
+  '''
+  if not setting(app, 'QUERY_TRACKER', app.debug, type=bool):
+    return
+  slow_after = setting(app, 'SLOW_QUERY_MS', 100, type=float) / 1000.0
+
+  install_cursor_hooks()
+
+  @app.before_request
+  def start_query_log():
+    g.setdefault('query_log', []).append(
+      current_queries.set(QueryLog(current_queries.get())))
+
+  @app.teardown_request
+  def end_query_log(error=None):
+    tokens = g.get('query_log')
+    if not tokens:
+      return
+    log = current_queries.get()
+    current_queries.reset(tokens.pop())
+
+    rule = request.url_rule.rule if request.url_rule else request.path
+    route = '%s %s' % (request.method, rule)
+    for statement, times in log.duplicates():
+      app.logger.warning('duplicate query on %s, run %d times: %s',
+                         route, times, statement)
+    for statement, times in log.repeated():
+      app.logger.warning('possible N+1 on %s, run %d times: %s',
+                         route, times, statement)
+    for statement, elapsed in log.slow(slow_after):
+      app.logger.warning('slow query on %s, %.1f ms: %s',
+                         route, elapsed * 1000, statement)
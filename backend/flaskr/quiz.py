@@ -0,0 +1,191 @@
+import random
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from models import db, setting, Question, table_versions
+
+# questions in a quiz session unless QUIZ_SESSION_QUESTIONS says otherwise;
+# also the most one can ask for, which bounds what every session stores
+SESSION_QUESTIONS = 100
+
+
+class QuestionIdIndex:
+  '''
+  Sorted question ids per category (None for every category), cached until
+  the questions table version changes in this process or the TTL expires.
+  '''
+
+  def __init__(self, ttl=60):
+    self.ttl = ttl
+    self._entries = {}
+    self._lock = Lock()
+
+  def stale(self, category_id):
+    '''True when the next ids(category_id) will query the database.'''
+    entry = self._entries.get(category_id)
+    return entry is None or entry[0] != table_versions['questions'] \
+      or entry[1] <= time.monotonic()
+
+  def ids(self, category_id):
+    version = table_versions['questions']
+    now = time.monotonic()
+    entry = self._entries.get(category_id)
+    if entry is not None and entry[0] == version and entry[1] > now:
+      return entry[2]
+
+    query = db.session.query(Question.id)
+    if category_id is not None:
+      query = query.filter_by(category=category_id)
+    ids = [row[0] for row in query.order_by(Question.id)]
+    with self._lock:
+      self._entries[category_id] = (version, now + self.ttl, ids)
+    return ids
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+
+class QuestionPicker:
+  '''
+  Picks a random question id the player has not seen yet.
+
+  A few random draws from the cached id index are tried first, which is
+  O(1) while most of the category is unused. After that the unused ids are
+  computed once with a set difference, so exhaustion is detected
+  deterministically instead of by drawing until something sticks.
+  '''
+
+  def __init__(self, index, draws=8, rng=random):
+    self.index = index
+    self.draws = draws
+    self.rng = rng
+
+  def pick(self, category_id, previous):
+    ids = self.index.ids(category_id)
+    used = set(previous)
+    if len(used) < len(ids):
+      for _ in range(self.draws):
+        question_id = self.rng.choice(ids)
+        if question_id not in used:
+          return question_id
+
+    unused = [question_id for question_id in ids if question_id not in used]
+    return self.rng.choice(unused) if unused else None
+
+  def sequence(self, category_id, count=None):
+    '''
+    A shuffled run of `count` (default: all) distinct question ids, fewer
+    when the category has fewer.
+    '''
+    ids = self.index.ids(category_id)
+    if count is None or count > len(ids):
+      count = len(ids)
+    return self.rng.sample(ids, count)
+
+
+question_ids = QuestionIdIndex()
+question_picker = QuestionPicker(question_ids)
+
+
+class MemorySessionStore:
+  '''
+  Quiz sessions kept in process: an LRU of at most `max_sessions` entries,
+  each expiring `ttl` seconds after its last use. A session is the
+  remaining question ids stored reversed, so taking the next one is a
+  list pop from the end.
+  '''
+
+  def __init__(self, max_sessions=10000, ttl=3600):
+    self.max_sessions = max_sessions
+    self.ttl = ttl
+    self._sessions = OrderedDict()
+    self._lock = Lock()
+
+  def create(self, session_id, question_ids):
+    with self._lock:
+      self._sessions[session_id] = (time.monotonic() + self.ttl,
+                                    list(reversed(question_ids)))
+      while len(self._sessions) > self.max_sessions:
+        self._sessions.popitem(last=False)
+
+  def pop(self, session_id):
+    '''
+    Returns (next question id or None when exhausted, ids left). Raises
+    KeyError for unknown or expired sessions.
+    '''
+    with self._lock:
+      expires, remaining = self._sessions[session_id]
+      if expires < time.monotonic():
+        del self._sessions[session_id]
+        raise KeyError(session_id)
+      self._sessions[session_id] = (time.monotonic() + self.ttl, remaining)
+      self._sessions.move_to_end(session_id)
+      question_id = remaining.pop() if remaining else None
+      return question_id, len(remaining)
+
+  def delete(self, session_id):
+    with self._lock:
+      self._sessions.pop(session_id, None)
+
+
+class RedisSessionStore:
+  '''
+  Quiz sessions in Redis, or anything speaking its protocol, so every
+  worker sees the same sessions. `client` is a redis-py compatible client.
+  Each session is a list of ids plus a marker key that tells an exhausted
+  session apart from a missing one; both expire `ttl` seconds after last
+  use.
+  '''
+
+  def __init__(self, client, ttl=3600, prefix='quiz:'):
+    self.client = client
+    self.ttl = ttl
+    self.prefix = prefix
+
+  def create(self, session_id, question_ids):
+    key = self.prefix + session_id
+    pipe = self.client.pipeline()
+    pipe.set(key, 1, ex=self.ttl)
+    for start in range(0, len(question_ids), 1000):
+      pipe.rpush(key + ':ids', *question_ids[start:start + 1000])
+    pipe.expire(key + ':ids', self.ttl)
+    pipe.execute()
+
+  def pop(self, session_id):
+    key = self.prefix + session_id
+    pipe = self.client.pipeline()
+    pipe.expire(key, self.ttl)
+    pipe.lpop(key + ':ids')
+    pipe.llen(key + ':ids')
+    pipe.expire(key + ':ids', self.ttl)
+    exists, question_id, remaining, _ = pipe.execute()
+    if not exists:
+      raise KeyError(session_id)
+    return (int(question_id) if question_id is not None else None), remaining
+
+  def delete(self, session_id):
+    key = self.prefix + session_id
+    self.client.delete(key, key + ':ids')
+
+
+def session_store(app):
+  '''
+  Builds the store named by QUIZ_SESSION_STORE: 'memory' (the default) or
+  a redis:// url, which needs the optional `redis` package. Like the DB_*
+  settings these come from the app config or the environment, e.g.
+  quiz_session_store for create_app() under gunicorn.
+  '''
+  url = setting(app, 'QUIZ_SESSION_STORE', 'memory', str)
+  ttl = setting(app, 'QUIZ_SESSION_TTL', 3600)
+  if url == 'memory':
+    return MemorySessionStore(setting(app, 'QUIZ_SESSION_MAX', 10000), ttl)
+
+  import redis
+  return RedisSessionStore(redis.Redis.from_url(url), ttl)
+
+
+def new_session_id():
+  return secrets.token_urlsafe(16)
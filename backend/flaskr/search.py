@@ -0,0 +1,234 @@
+import bisect
+import heapq
+import re
+import time
+from collections import defaultdict
+from threading import Lock
+
+from sqlalchemy import and_, func, inspect, literal_column, or_
+
+from models import db, Question, table_versions
+from .serialize import question_rows
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+QUESTION_WEIGHT = 1.0
+ANSWER_WEIGHT = 0.5
+
+# matches are counted exactly up to this many, past it the total is the
+# planner's estimate
+EXACT_COUNT_LIMIT = 1000
+# tokens remembered as being (or not being) english stop words
+STOP_WORD_CACHE_SIZE = 10000
+
+
+def tokenize(text):
+  return TOKEN.findall((text or '').casefold())
+
+
+class PostgresSearch:
+  '''
+  Ranked full-text search over the `search_document` tsvector column added
+  by migrations/0001_question_search.postgresql.sql. Every search token is
+  matched as a prefix so partial words typed into the frontend still hit.
+  Question text carries weight A and answers weight B, so question-only
+  searches restrict the tsquery to A lexemes and still use the GIN index.
+
+  The english configuration leaves stop words out of both the document and
+  the query, so a term made only of stop words ("what", "the") would match
+  nothing; those fall back to a substring match, as InvertedIndexSearch
+  finds them.
+  '''
+
+  document = literal_column('questions.search_document')
+  config = literal_column("'english'::regconfig")
+
+  def __init__(self):
+    self._stop_words = {}
+
+  def tsquery(self, tokens, include_answers):
+    weights = 'AB' if include_answers else 'A'
+    return func.to_tsquery(
+      self.config, ' & '.join('%s:*%s' % (token, weights) for token in tokens))
+
+  def stop_words(self, tokens):
+    '''The tokens the english configuration drops, asked once per token.'''
+    unknown = [token for token in set(tokens) if token not in self._stop_words]
+    if unknown:
+      nodes = db.session.query(*[
+        func.numnode(func.to_tsquery(self.config, token)) for token in unknown
+      ]).one()
+      if len(self._stop_words) > STOP_WORD_CACHE_SIZE:
+        self._stop_words.clear()
+      self._stop_words.update(zip(unknown, (count == 0 for count in nodes)))
+    return {token for token in tokens if self._stop_words.get(token)}
+
+  def substring_filter(self, tokens, include_answers):
+    '''Every token in the question (or answer) text, case-insensitively.'''
+    criteria = []
+    for token in tokens:
+      # tokens are \w+, so _ is the only wildcard they can hold
+      pattern = '%%%s%%' % token.replace('_', '/_')
+      match = Question.question.ilike(pattern, escape='/')
+      if include_answers:
+        match = or_(match, Question.answer.ilike(pattern, escape='/'))
+      criteria.append(match)
+    return and_(*criteria)
+
+  def search(self, term, include_answers=False, offset=0, limit=10):
+    '''
+    Returns (rows, total, estimated) for one page of results, rows being
+    Question column tuples. The total is exact up to EXACT_COUNT_LIMIT;
+    past that it comes from the planner's row estimate so broad terms
+    never count every match.
+    '''
+    tokens = tokenize(term)
+    if not tokens:
+      return [], 0, False
+
+    if len(self.stop_words(tokens)) == len(set(tokens)):
+      matches = Question.query.filter(
+        self.substring_filter(tokens, include_answers))
+      ordered = matches.order_by(Question.id)
+    else:
+      query = self.tsquery(tokens, include_answers)
+      rank = func.ts_rank(self.document, query)
+      matches = Question.query.filter(self.document.op('@@')(query))
+      ordered = matches.order_by(rank.desc(), Question.id)
+    questions = question_rows(ordered).offset(offset).limit(limit).all()
+
+    capped = matches.with_entities(Question.id) \
+      .limit(EXACT_COUNT_LIMIT + 1).subquery()
+    total = db.session.query(func.count()).select_from(capped).scalar()
+    if total <= EXACT_COUNT_LIMIT:
+      return questions, total, False
+    return questions, max(total, self.estimate(matches)), True
+
+  def estimate(self, query):
+    statement = query.with_entities(Question.id).statement
+    compiled = statement.compile(dialect=db.engine.dialect)
+    plan = db.session.connection().execute(
+      'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class InvertedIndexSearch:
+  '''
+  In-memory inverted index used where the Postgres search column is not
+  available (SQLite test setups, unmigrated databases). Postings map each
+  token to {question id: weighted term frequency}; a sorted vocabulary
+  gives prefix matches through bisect. The index is rebuilt when the
+  questions table version changes in this process or the TTL runs out.
+  '''
+
+  def __init__(self, ttl=60):
+    self.ttl = ttl
+    self._index = None
+    self._lock = Lock()
+
+  def _build(self):
+    questions = defaultdict(dict)
+    answers = defaultdict(dict)
+    rows = db.session.query(Question.id, Question.question, Question.answer)
+    for question_id, question, answer in rows:
+      for token in tokenize(question):
+        postings = questions[token]
+        postings[question_id] = postings.get(question_id, 0) + QUESTION_WEIGHT
+      for token in tokenize(answer):
+        postings = answers[token]
+        postings[question_id] = postings.get(question_id, 0) + ANSWER_WEIGHT
+    return {
+      'questions': (sorted(questions), dict(questions)),
+      'answers': (sorted(answers), dict(answers))
+    }
+
+  def _load(self):
+    version = table_versions['questions']
+    now = time.monotonic()
+    index = self._index
+    if index is not None and index[0] == version and index[1] > now:
+      return index[2]
+
+    with self._lock:
+      fields = self._build()
+      self._index = (version, now + self.ttl, fields)
+    return fields
+
+  def _matches(self, field, token, scores):
+    vocabulary, postings = field
+    start = bisect.bisect_left(vocabulary, token)
+    for word in vocabulary[start:]:
+      if not word.startswith(token):
+        break
+      for question_id, weight in postings[word].items():
+        scores[question_id] = scores.get(question_id, 0) + weight
+
+  def scores(self, term, include_answers=False):
+    tokens = tokenize(term)
+    if not tokens:
+      return {}
+
+    fields = self._load()
+    scores = None
+    for token in tokens:
+      token_scores = {}
+      self._matches(fields['questions'], token, token_scores)
+      if include_answers:
+        self._matches(fields['answers'], token, token_scores)
+
+      if scores is None:
+        scores = token_scores
+      else:
+        scores = {question_id: score + token_scores[question_id]
+                  for question_id, score in scores.items()
+                  if question_id in token_scores}
+      if not scores:
+        return {}
+    return scores
+
+  def search(self, term, include_answers=False, offset=0, limit=10):
+    '''
+    Returns (rows, total, estimated) for one page of results. Only
+    the ids up to the end of the requested page are ranked, and only the
+    page itself is loaded from the database; the total is always exact.
+    '''
+    scores = self.scores(term, include_answers)
+    ranked = heapq.nsmallest(
+      offset + limit, scores,
+      key=lambda question_id: (-scores[question_id], question_id))
+    ids = ranked[offset:]
+    if not ids:
+      return [], len(scores), False
+
+    by_id = {row[0]: row for row
+             in question_rows(Question.query.filter(Question.id.in_(ids)))}
+    questions = [by_id[question_id] for question_id in ids
+                 if question_id in by_id]
+    return questions, len(scores), False
+
+  def clear(self):
+    with self._lock:
+      self._index = None
+
+
+_backends = {}
+
+
+def search_backend():
+  '''
+  Returns the search backend for the current engine: Postgres full-text
+  search once the search migration has been applied, otherwise the
+  in-memory inverted index.
+  '''
+  engine = db.engine
+  key = str(engine.url)
+  backend = _backends.get(key)
+  if backend is None:
+    columns = [column['name']
+               for column in inspect(engine).get_columns('questions')]
+    if engine.dialect.name == 'postgresql' and 'search_document' in columns:
+      backend = PostgresSearch()
+    else:
+      backend = InvertedIndexSearch()
+    _backends[key] = backend
+  return backend
@@ -0,0 +1,41 @@
+import json
+
+from flask import current_app
+
+from models import Question
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+QUESTION_COLUMNS = tuple(getattr(Question, field) for field in QUESTION_FIELDS)
+
+
+def question_rows(query):
+  '''
+  Narrows a Question query to plain column tuples, which skips building
+  ORM instances and registering them in the session identity map.
+  '''
+  return query.with_entities(*QUESTION_COLUMNS)
+
+
+def format_rows(rows):
+  '''The Question.format() shape, built straight from column tuples.'''
+  return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+def dumps(payload):
+  if orjson is not None:
+    return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+  return json.dumps(payload, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(payload, status=200):
+  '''
+  Drop-in for jsonify() on list endpoints: encodes with orjson when it is
+  installed and falls back to the stdlib encoder otherwise.
+  '''
+  return current_app.response_class(dumps(payload), status=status,
+                                    mimetype='application/json')
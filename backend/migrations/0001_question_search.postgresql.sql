@@ -0,0 +1,30 @@
+-- Full-text search document for questions.
+--
+-- search_document holds the question text with weight A and the answer with
+-- weight B, so one GIN index serves both question-only searches (prefix
+-- queries restricted to weight A) and question + answer searches.
+
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS search_document tsvector;
+
+CREATE OR REPLACE FUNCTION public.questions_search_document_update()
+RETURNS trigger AS $$
+BEGIN
+  NEW.search_document :=
+    setweight(to_tsvector('english', coalesce(NEW.question, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(NEW.answer, '')), 'B');
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS questions_search_document ON public.questions;
+
+CREATE TRIGGER questions_search_document
+  BEFORE INSERT OR UPDATE OF question, answer ON public.questions
+  FOR EACH ROW EXECUTE PROCEDURE public.questions_search_document_update();
+
+UPDATE public.questions SET search_document =
+  setweight(to_tsvector('english', coalesce(question, '')), 'A') ||
+  setweight(to_tsvector('english', coalesce(answer, '')), 'B');
+
+CREATE INDEX IF NOT EXISTS ix_questions_search_document
+  ON public.questions USING gin (search_document);
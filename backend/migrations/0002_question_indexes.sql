@@ -0,0 +1,15 @@
+-- Secondary indexes for the hot question filters.
+--
+-- (category, id) serves category pages and the quiz id lists, which filter
+-- on category and order by id. (category, difficulty, id) serves exports and
+-- bulk operations filtered on both, and difficulty alone serves the
+-- difficulty-only filters. Written in SQL shared by Postgres and SQLite.
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_id
+  ON questions (category, id);
+
+CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty_id
+  ON questions (category, difficulty, id);
+
+CREATE INDEX IF NOT EXISTS ix_questions_difficulty
+  ON questions (difficulty);
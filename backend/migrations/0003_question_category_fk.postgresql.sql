@@ -0,0 +1,31 @@
+-- questions.category as an integer foreign key to categories.
+--
+-- trivia.psql already declares the column integer with a foreign key, but
+-- databases created from the old model have a varchar column, which made
+-- category filters compare through a cast instead of using the indexes.
+-- Values that are not integers fail the cast, and questions pointing at a
+-- missing category stop the migration; `flask db check` lists them.
+
+ALTER TABLE public.questions
+  ALTER COLUMN category TYPE integer USING NULLIF(category::text, '')::integer;
+
+DO $$
+BEGIN
+  IF EXISTS (
+    SELECT 1 FROM public.questions q
+    WHERE q.category IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM public.categories c WHERE c.id = q.category)
+  ) THEN
+    RAISE EXCEPTION 'questions reference missing categories, see flask db check';
+  END IF;
+
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_constraint
+    WHERE conrelid = 'public.questions'::regclass AND contype = 'f'
+  ) THEN
+    ALTER TABLE public.questions ADD CONSTRAINT category
+      FOREIGN KEY (category) REFERENCES public.categories (id)
+      ON UPDATE CASCADE ON DELETE SET NULL;
+  END IF;
+END
+$$;
@@ -0,0 +1,35 @@
+-- questions.category as an integer foreign key to categories.
+--
+-- SQLite cannot change a column type in place, so the table is rebuilt.
+-- Questions pointing at a missing category fail the CHECK below and stop
+-- the migration; `flask db check` lists them.
+
+CREATE TEMP TABLE category_check (orphans INTEGER CHECK (orphans = 0));
+INSERT INTO category_check
+  SELECT count(*) FROM questions
+  WHERE NULLIF(category, '') IS NOT NULL
+    AND CAST(category AS INTEGER) NOT IN (SELECT id FROM categories);
+DROP TABLE category_check;
+
+CREATE TABLE questions_new (
+  id INTEGER NOT NULL,
+  question VARCHAR,
+  answer VARCHAR,
+  category INTEGER,
+  difficulty INTEGER,
+  PRIMARY KEY (id),
+  FOREIGN KEY (category) REFERENCES categories (id)
+    ON UPDATE CASCADE ON DELETE SET NULL
+);
+
+INSERT INTO questions_new (id, question, answer, category, difficulty)
+  SELECT id, question, answer, CAST(NULLIF(category, '') AS INTEGER), difficulty
+  FROM questions;
+
+DROP TABLE questions;
+ALTER TABLE questions_new RENAME TO questions;
+
+CREATE INDEX ix_questions_category_id ON questions (category, id);
+CREATE INDEX ix_questions_category_difficulty_id
+  ON questions (category, difficulty, id);
+CREATE INDEX ix_questions_difficulty ON questions (difficulty);
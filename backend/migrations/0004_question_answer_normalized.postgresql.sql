@@ -0,0 +1,8 @@
+-- Normalized answers for server-side grading.
+--
+-- answer_normalized holds models.normalize_answer(answer), written by the
+-- application with every insert. Existing rows are left NULL here, since the
+-- normalization lives in Python; the grader normalizes NULL answers on the
+-- fly and `flask questions normalize` fills them in.
+
+ALTER TABLE public.questions ADD COLUMN IF NOT EXISTS answer_normalized VARCHAR;
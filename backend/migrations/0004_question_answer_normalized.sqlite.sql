@@ -0,0 +1,7 @@
+-- Normalized answers for server-side grading.
+--
+-- SQLite has no ADD COLUMN IF NOT EXISTS; the column is always missing here
+-- because 0003 rebuilds the questions table without it. Existing rows are
+-- left NULL, see the Postgres version of this migration.
+
+ALTER TABLE questions ADD COLUMN answer_normalized VARCHAR;
@@ -0,0 +1,22 @@
+-- question_counts filled from questions.
+--
+-- Databases that had questions before the question_counts table existed
+-- start with no counts. The table is locked first, so writers adjusting
+-- counts wait for the fill, and the counts are written as absolute values,
+-- so running it again (or `flask stats rebuild`) cannot double them.
+
+CREATE TABLE IF NOT EXISTS public.question_counts (
+  category INTEGER NOT NULL,
+  difficulty INTEGER NOT NULL,
+  total INTEGER NOT NULL,
+  PRIMARY KEY (category, difficulty)
+);
+
+LOCK TABLE public.question_counts IN EXCLUSIVE MODE;
+
+DELETE FROM public.question_counts;
+
+INSERT INTO public.question_counts (category, difficulty, total)
+  SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*)
+  FROM public.questions
+  GROUP BY coalesce(category, 0), coalesce(difficulty, 0);
@@ -0,0 +1,19 @@
+-- question_counts filled from questions.
+--
+-- SQLite has no LOCK TABLE; the DELETE takes the database write lock, which
+-- holds off other writers until the fill commits. See the Postgres version
+-- of this migration.
+
+CREATE TABLE IF NOT EXISTS question_counts (
+  category INTEGER NOT NULL,
+  difficulty INTEGER NOT NULL,
+  total INTEGER NOT NULL,
+  PRIMARY KEY (category, difficulty)
+);
+
+DELETE FROM question_counts;
+
+INSERT INTO question_counts (category, difficulty, total)
+  SELECT coalesce(category, 0), coalesce(difficulty, 0), count(*)
+  FROM questions
+  GROUP BY coalesce(category, 0), coalesce(difficulty, 0);
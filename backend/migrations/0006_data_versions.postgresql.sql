@@ -0,0 +1,17 @@
+-- Shared table versions for conditional GETs.
+--
+-- Every write bumps the version and modification time of the tables it
+-- touches in its own transaction, so all workers issue the same ETag and
+-- Last-Modified and can answer a revalidation with 304 without reading the
+-- rows. The first rows start at the time of the migration.
+
+CREATE TABLE IF NOT EXISTS public.data_versions (
+  name VARCHAR(64) PRIMARY KEY,
+  version INTEGER NOT NULL,
+  modified DOUBLE PRECISION NOT NULL
+);
+
+INSERT INTO public.data_versions (name, version, modified)
+  VALUES ('questions', 1, extract(epoch FROM now())),
+         ('categories', 1, extract(epoch FROM now()))
+  ON CONFLICT (name) DO NOTHING;
@@ -0,0 +1,15 @@
+-- Shared table versions for conditional GETs.
+--
+-- See the Postgres version of this migration; only the current time is
+-- spelled differently.
+
+CREATE TABLE IF NOT EXISTS data_versions (
+  name VARCHAR(64) PRIMARY KEY,
+  version INTEGER NOT NULL,
+  modified FLOAT NOT NULL
+);
+
+INSERT INTO data_versions (name, version, modified)
+  VALUES ('questions', 1, CAST(strftime('%s', 'now') AS REAL)),
+         ('categories', 1, CAST(strftime('%s', 'now') AS REAL))
+  ON CONFLICT (name) DO NOTHING;
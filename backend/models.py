@@ -1,22 +1,380 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import re
+import time
+import unicodedata
+from contextvars import ContextVar
+from functools import wraps
+from itertools import count
+from threading import Lock
+from collections import Counter
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, create_engine, event, func, inspect, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import backref, relationship, sessionmaker, validates
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import json
 
 database_path=os.getenv("database_url")
 
-db = SQLAlchemy()
+'''
+read-only handlers
+    views wrapped in read_only() may have their statements served by a
+    replica; everything else, and any session that has written, uses the
+    primary
+'''
+reading = ContextVar('read_only', default=False)
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = reading.set(True)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            reading.reset(token)
+    return wrapper
+
+'''
+Replica, ReplicaSet
+    health-aware round robin over the replica engines. A replica is pinged
+    before use once its last check is REPLICA_CHECK_INTERVAL seconds old;
+    one that fails the ping or drops a connection mid-query is skipped for
+    REPLICA_RETRY_AFTER seconds and pinged again before it is reused
+'''
+class Replica:
+  __slots__ = ('name', 'engine', 'healthy', 'checked', 'retry_at',
+               'sessions', 'failures')
+
+  def __init__(self, name, engine):
+    self.name = name
+    self.engine = engine
+    self.healthy = True
+    self.checked = None
+    self.retry_at = 0.0
+    self.sessions = 0
+    self.failures = 0
+
+
+class ReplicaSet:
+  def __init__(self, engines, check_interval=5, retry_after=30):
+    self.replicas = [Replica(name, engine) for name, engine in engines]
+    self.check_interval = check_interval
+    self.retry_after = retry_after
+    self._turn = count()
+    for replica in self.replicas:
+      self._watch(replica)
+
+  def _watch(self, replica):
+    @event.listens_for(replica.engine, 'handle_error')
+    def lost_connection(context):
+      if context.is_disconnect:
+        self.mark_down(replica)
+
+  def choose(self):
+    '''The engine of the next healthy replica, or None when none is.'''
+    for _ in range(len(self.replicas)):
+      replica = self.replicas[next(self._turn) % len(self.replicas)]
+      if self.available(replica):
+        replica.sessions += 1
+        return replica.engine
+    return None
+
+  def available(self, replica):
+    now = time.monotonic()
+    if not replica.healthy:
+      return now >= replica.retry_at and self.check(replica)
+    if replica.checked is None or now - replica.checked >= self.check_interval:
+      return self.check(replica)
+    return True
+
+  def check(self, replica):
+    try:
+      with replica.engine.connect() as connection:
+        connection.execute(text('SELECT 1'))
+    except DBAPIError:
+      self.mark_down(replica)
+      return False
+    replica.healthy = True
+    replica.checked = time.monotonic()
+    return True
+
+  def mark_down(self, replica):
+    replica.healthy = False
+    replica.failures += 1
+    replica.retry_at = time.monotonic() + self.retry_after
+
+  def stats(self):
+    return [{
+      'name': replica.name,
+      'healthy': replica.healthy,
+      'sessions': replica.sessions,
+      'failures': replica.failures
+    } for replica in self.replicas]
+
+'''
+RoutingSession
+    sends the statements of a session opened in a read-only handler to one
+    replica, picked once per session. Writes (flushes and INSERT / UPDATE /
+    DELETE statements) and any statement outside a read-only handler pin
+    the session to the primary, so a request reads its own writes, even
+    across the sub-requests of POST /batch
+'''
+class RoutingSession(SignallingSession):
+  def get_bind(self, mapper=None, clause=None):
+    replicas = self.app.extensions.get('replicas')
+    if replicas is not None and not self.info.get('primary'):
+      if reading.get() and not self._flushing \
+          and not isinstance(clause, UpdateBase):
+        if 'replica' not in self.info:
+          self.info['replica'] = replicas.choose()
+        if self.info['replica'] is not None:
+          return self.info['replica']
+      else:
+        self.info['primary'] = True
+    return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 '''
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service. Without an explicit
+    database_path the app's SQLALCHEMY_DATABASE_URI (e.g. from test_config)
+    is used, then the database_url environment variable. Returns True when
+    it created the questions table, i.e. built a new schema from the models.
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None):
+    database_path = database_path \
+        or app.config.get("SQLALCHEMY_DATABASE_URI") \
+        or globals()["database_path"]
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app, database_path)
+    replicas = replica_urls(app)
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    binds.update(replicas)
+    app.config["SQLALCHEMY_BINDS"] = binds
     db.app = app
     db.init_app(app)
-    db.create_all()
+    created = 'questions' not in inspect(db.engine).get_table_names()
+    # replicas get their schema from the primary
+    db.create_all(bind=None)
+    if created:
+        # a new schema starts with its shared versions in place
+        DataVersion.bump(*table_versions)
+        db.session.commit()
+        db.session.remove()
+    if replicas:
+        app.extensions["replicas"] = ReplicaSet(
+            [(name, db.get_engine(app, name)) for name in sorted(replicas)],
+            setting(app, 'REPLICA_CHECK_INTERVAL', 5, float),
+            setting(app, 'REPLICA_RETRY_AFTER', 30, float))
+    else:
+        app.extensions.pop("replicas", None)
+    return created
+
+'''
+setting(app, name, default, type)
+    reads a database setting from the app config (e.g. test_config), then
+    from the lower-cased environment variable, e.g. DB_POOL_SIZE / db_pool_size
+'''
+def setting(app, name, default, type=int):
+    value = app.config.get(name, os.getenv(name.lower()))
+    if value is None or value == '':
+        return default
+    if type is bool and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return type(value)
+
+'''
+replica_urls(app)
+    {bind key: url} of the read replicas listed, comma separated, in
+    DATABASE_REPLICAS (or the database_replicas environment variable)
+'''
+def replica_urls(app):
+    urls = setting(app, 'DATABASE_REPLICAS', '', str)
+    if isinstance(urls, str):
+        urls = urls.split(',')
+    return {'replica_%d' % number: url.strip()
+            for number, url in enumerate(url for url in urls if url.strip())}
+
+'''
+engine_options(app, database_path)
+    pool sizing, overflow, pre-ping, recycle and statement timeout for the
+    engine. SQLite keeps Flask-SQLAlchemy's own pool choice since its
+    connections cannot be shared between threads.
+'''
+def engine_options(app, database_path):
+    options = {
+        'pool_pre_ping': setting(app, 'DB_POOL_PRE_PING', True, bool)
+    }
+    if (database_path or '').startswith('sqlite'):
+        return options
+
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': setting(app, 'DB_POOL_SIZE', 5),
+        'max_overflow': setting(app, 'DB_MAX_OVERFLOW', 10),
+        'pool_timeout': setting(app, 'DB_POOL_TIMEOUT', 30),
+        'pool_recycle': setting(app, 'DB_POOL_RECYCLE', 1800)
+    })
+    statement_timeout = setting(app, 'DB_STATEMENT_TIMEOUT', 0)
+    if statement_timeout and database_path.startswith('postgres'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout=%d' % statement_timeout
+        }
+    return options
+
+'''
+InstrumentedQueuePool
+    QueuePool that records how long checkouts wait for a free connection
+'''
+class InstrumentedQueuePool(QueuePool):
+  def __init__(self, *args, **kwargs):
+    super(InstrumentedQueuePool, self).__init__(*args, **kwargs)
+    self.checkouts = 0
+    self.timeouts = 0
+    self.wait_total = 0.0
+    self.wait_max = 0.0
+    self._stats_lock = Lock()
+
+  def _do_get(self):
+    start = time.perf_counter()
+    try:
+      return super(InstrumentedQueuePool, self)._do_get()
+    except Exception:
+      with self._stats_lock:
+        self.timeouts += 1
+      raise
+    finally:
+      waited = time.perf_counter() - start
+      with self._stats_lock:
+        self.checkouts += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+'''
+pool_stats()
+    live statistics for the connection pool of the bound engine
+'''
+def pool_stats():
+    pool = db.engine.pool
+    stats = {'pool': type(pool).__name__, 'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        stats.update({
+            'checkouts': pool.checkouts,
+            'timeouts': pool.timeouts,
+            'wait_ms_total': round(pool.wait_total * 1000, 3),
+            'wait_ms_max': round(pool.wait_max * 1000, 3),
+            'wait_ms_avg': round(pool.wait_total * 1000 / pool.checkouts, 3)
+                if pool.checkouts else 0.0
+        })
+    return stats
+
+'''
+table versions
+    process-local counters bumped after every committed write so cached
+    reads (counts, categories, ...) know when to refresh, plus the time of
+    the last bump for Last-Modified headers
+'''
+table_versions = {'questions': 0, 'categories': 0}
+table_modified = dict.fromkeys(table_versions, time.time())
+
+def bump_version(*tables):
+    for table in tables:
+        table_versions[table] += 1
+        table_modified[table] = time.time()
+
+'''
+DataVersion
+    the version and modification time of each table, shared by every
+    worker. Writes bump them in their own transaction through
+    commit_writes(); conditional GETs (flaskr/http_cache.py) validate
+    against them before running the view
+'''
+class DataVersion(db.Model):
+  __tablename__ = 'data_versions'
+
+  name = Column(String(64), primary_key=True)
+  version = Column(Integer, nullable=False, default=0)
+  modified = Column(Float, nullable=False, default=0)
+
+  @staticmethod
+  def bump(*tables):
+    '''Bumps `tables` within the current transaction; the caller commits.'''
+    db.session.execute(text(
+      'INSERT INTO data_versions (name, version, modified) '
+      'VALUES (:name, 1, :modified) '
+      'ON CONFLICT (name) DO UPDATE SET '
+      'version = data_versions.version + 1, modified = excluded.modified'),
+      # in name order, so writers touching several rows lock them alike
+      [{'name': table, 'modified': time.time()} for table in sorted(tables)])
+
+  @staticmethod
+  def read(tables):
+    '''{table: (version, modified)} for those of `tables` that have a row.'''
+    rows = db.session.query(
+      DataVersion.name, DataVersion.version, DataVersion.modified) \
+      .filter(DataVersion.name.in_(tables))
+    return {name: (version, modified) for name, version, modified in rows}
+
+'''
+commit_writes(*tables)
+    commits the session's writes to `tables` with their shared versions
+    bumped in the same transaction, then bumps this process's versions
+'''
+def commit_writes(*tables):
+    DataVersion.bump(*tables)
+    db.session.commit()
+    bump_version(*tables)
+
+'''
+observe_versions(versions)
+    takes {table: version} as read from data_versions. A table whose shared
+    version moved since this process last looked was written, possibly by
+    another worker, so its local version is bumped and the process caches
+    built from it reload
+'''
+seen_versions = {}
+
+def observe_versions(versions):
+    changed = [table for table, version in versions.items()
+               if seen_versions.get(table) != version]
+    seen_versions.update(versions)
+    if changed:
+        bump_version(*changed)
+
+'''
+normalize_answer(answer)
+    the form answers are graded in: accents folded, case-folded,
+    punctuation dropped and the articles a/an/the removed (unless nothing
+    else is left), as space separated tokens. Stored with every question
+    so grading never normalizes the same answer twice.
+'''
+ARTICLES = frozenset(('a', 'an', 'the'))
+APOSTROPHES = re.compile(r"['\u2019]")
+NON_WORD = re.compile(r'[\W_]+', re.UNICODE)
+
+def normalize_answer(answer):
+    text = unicodedata.normalize('NFKD', str(answer or ''))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = NON_WORD.sub(' ', APOSTROPHES.sub('', text.casefold()))
+    tokens = text.split()
+    return ' '.join([token for token in tokens if token not in ARTICLES]
+                    or tokens)
 
 '''
 Question
@@ -24,29 +382,56 @@ Question
 '''
 class Question(db.Model):  
   __tablename__ = 'questions'
+  # kept in step with migrations/0002_question_indexes.sql, which adds them
+  # to databases created before they were declared here
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+    Index('ix_questions_category_difficulty_id', 'category', 'difficulty', 'id'),
+    Index('ix_questions_difficulty', 'difficulty'),
+  )
 
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  # normalize_answer(answer), see migrations/0004_question_answer_normalized.sql
+  answer_normalized = Column(String)
+  category = Column(Integer, ForeignKey(
+    'categories.id', onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
+  category_record = relationship(
+    'Category', backref=backref('questions', lazy='dynamic', passive_deletes=True))
+
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
     self.category = category
     self.difficulty = difficulty
 
+  @validates('answer')
+  def normalize(self, key, answer):
+    self.answer_normalized = normalize_answer(answer)
+    return answer
+
   def insert(self):
     db.session.add(self)
-    db.session.commit()
+    QuestionCount.adjust({count_key(self.category, self.difficulty): 1})
+    commit_writes('questions')
   
   def update(self):
-    db.session.commit()
+    state = inspect(self).attrs
+    old = [state[field].history.deleted or [getattr(self, field)]
+           for field in ('category', 'difficulty')]
+    before = count_key(old[0][0], old[1][0])
+    after = count_key(self.category, self.difficulty)
+    if before != after:
+      QuestionCount.adjust({before: -1, after: 1})
+    commit_writes('questions')
 
   def delete(self):
     db.session.delete(self)
-    db.session.commit()
+    QuestionCount.adjust({count_key(self.category, self.difficulty): -1})
+    commit_writes('questions')
 
   def format(self):
     return {
@@ -70,8 +455,98 @@ class Category(db.Model):
   def __init__(self, type):
     self.type = type
 
+  def insert(self):
+    db.session.add(self)
+    commit_writes('categories')
+
+  def update(self):
+    commit_writes('categories')
+
+  def delete(self):
+    # its questions are kept without a category, as ON DELETE SET NULL
+    # does on Postgres, and their counts move to category 0
+    deltas = {}
+    for row in QuestionCount.query.filter_by(category=self.id):
+      if row.total:
+        deltas[(self.id, row.difficulty)] = -row.total
+        deltas[(0, row.difficulty)] = row.total
+    Question.query.filter_by(category=self.id) \
+      .update({'category': None}, synchronize_session=False)
+    db.session.delete(self)
+    QuestionCount.adjust(deltas)
+    commit_writes('categories', 'questions')
+
   def format(self):
     return {
       'id': self.id,
       'type': self.type
-    }
\ No newline at end of file
+    }
+
+'''
+count_key(category, difficulty)
+    the (category, difficulty) key questions are counted under in
+    question_counts; a question without a category counts under 0
+'''
+def count_key(category, difficulty):
+    category = int(category) if category not in (None, '') else 0
+    return category, int(difficulty or 0)
+
+'''
+QuestionCount
+    number of questions per (category, difficulty), maintained in the same
+    transaction as every write so counts never need a scan of questions
+'''
+class QuestionCount(db.Model):
+  __tablename__ = 'question_counts'
+
+  category = Column(Integer, primary_key=True, autoincrement=False)
+  difficulty = Column(Integer, primary_key=True, autoincrement=False)
+  total = Column(Integer, nullable=False, default=0)
+
+  @staticmethod
+  def adjust(deltas):
+    '''
+    Adds {(category, difficulty): delta} to the counts within the current
+    transaction; the caller commits. The upsert keeps concurrent writers
+    from racing on a new key.
+    '''
+    params = [{'category': key[0], 'difficulty': key[1], 'delta': delta}
+              for key, delta in deltas.items() if delta]
+    if not params:
+      return
+    db.session.execute(text(
+      'INSERT INTO question_counts (category, difficulty, total) '
+      'VALUES (:category, :difficulty, :delta) '
+      'ON CONFLICT (category, difficulty) '
+      'DO UPDATE SET total = question_counts.total + excluded.total'), params)
+
+  @staticmethod
+  def tally(rows):
+    '''Deltas for inserting rows given as dicts or (category, difficulty, n).'''
+    deltas = Counter()
+    for row in rows:
+      if isinstance(row, dict):
+        deltas[count_key(row['category'], row['difficulty'])] += 1
+      else:
+        deltas[count_key(row[0], row[1])] += row[2]
+    return deltas
+
+  @staticmethod
+  def rebuild():
+    '''
+    Recomputes every count from the questions table as absolute values,
+    not deltas. On Postgres the table is locked first, so writers adjusting
+    counts wait for the rebuild and two rebuilds cannot both add a tally.
+    '''
+    if db.engine.dialect.name == 'postgresql':
+      db.session.execute(text('LOCK TABLE question_counts IN EXCLUSIVE MODE'))
+    groups = db.session.query(
+      Question.category, Question.difficulty, func.count(Question.id)) \
+      .group_by(Question.category, Question.difficulty)
+    totals = QuestionCount.tally(groups)
+    db.session.query(QuestionCount).delete(synchronize_session=False)
+    if totals:
+      db.session.execute(QuestionCount.__table__.insert(), [
+        {'category': key[0], 'difficulty': key[1], 'total': total}
+        for key, total in totals.items()])
+    commit_writes('questions')
@@ -1,13 +1,77 @@
+import asyncio
+import gzip
 import os
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import json
+from unittest import mock
+from importlib.util import find_spec
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr.asgi import ASYNC_DRIVERS, AsgiApp, backend_name
+from flaskr.compression import ENCODERS
+from flaskr.grading import grade
+from flaskr.queries import QueryAssertions, track_queries
+from flaskr.quiz import RedisSessionStore, session_store
+from models import (setup_db, db, bump_version, normalize_answer, Question,
+                    Category, DataVersion)
 
 
-class TriviaTestCase(unittest.TestCase):
+class FakeRedis:
+    """The redis-py calls RedisSessionStore makes, on dicts."""
+
+    def __init__(self):
+        self.values = {}
+        self.ttls = {}
+        self.commands = None
+
+    def pipeline(self):
+        self.commands = []
+        return self
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, None
+        return [getattr(self, '_' + name)(*args, **kwargs)
+                for name, args, kwargs in commands]
+
+    def _set(self, key, value, ex=None):
+        self.values[key] = value
+        self.ttls[key] = ex
+        return True
+
+    def _rpush(self, key, *values):
+        self.values.setdefault(key, []).extend(
+            str(value).encode() for value in values)
+        return len(self.values[key])
+
+    def _lpop(self, key):
+        items = self.values.get(key)
+        return items.pop(0) if items else None
+
+    def _llen(self, key):
+        return len(self.values.get(key, []))
+
+    def _expire(self, key, seconds):
+        if key not in self.values:
+            return False
+        self.ttls[key] = seconds
+        return True
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+
+class TriviaTestCase(QueryAssertions, unittest.TestCase):
     """This class represents the trivia test case"""
 
     def setUp(self):
@@ -60,11 +124,539 @@ class TriviaTestCase(unittest.TestCase):
         response = self.client().get('/categories')
         self.assertEqual(response.status_code, 200)
 
+    def test_categories_served_from_cache(self):
+        self.client().get('/categories')
+        res = self.client().get('/internal/cache')
+        hits = json.loads(res.data)['categories']['hits']
+
+        self.client().get('/categories')
+        res = self.client().get('/internal/cache')
+        self.assertEqual(json.loads(res.data)['categories']['hits'], hits + 1)
+
+    def test_category_cache_invalidated_on_write(self):
+        self.client().get('/categories')
+        with self.app.app_context():
+            category = Category('Music')
+            category.insert()
+            category_id = category.id
+
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+        self.assertEqual(data['categories'][str(category_id)], 'Music')
+
+        with self.app.app_context():
+            Category.query.get(category_id).delete()
+
+    def test_304_get_questions_with_etag(self):
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+        self.assertIn('no-cache', res.headers['Cache-Control'])
+
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    def test_etag_changes_after_write(self):
+        res = self.client().get('/questions')
+        etag = res.headers['ETag']
+        self.client().post('/questions/add', json=self.new_question)
+
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': etag})
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers['ETag'], etag)
+
+    def test_etag_shared_between_workers(self):
+        res = self.client().get('/questions')
+        # another worker, or a restarted one, has its own table versions
+        bump_version('questions', 'categories')
+        res = self.client().get('/questions',
+                                headers={'If-None-Match': res.headers['ETag']})
+        self.assertEqual(res.status_code, 304)
+
+    def test_304_revalidation_skips_the_view(self):
+        self.client().post('/questions/add', json=self.new_question)
+        for path in ('/questions?page=1', '/categories/1/questions'):
+            etag = self.client().get(path).headers['ETag']
+            with self.assertMaxQueries(1):
+                res = self.client().get(path, headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 304)
+
+    def test_304_without_shared_versions(self):
+        # e.g. a database whose data_versions table has no rows yet
+        with self.app.app_context():
+            db.session.execute(text('DELETE FROM data_versions'))
+            db.session.commit()
+        try:
+            res = self.client().get('/questions')
+            res = self.client().get('/questions',
+                                    headers={'If-None-Match': res.headers['ETag']})
+            self.assertEqual(res.status_code, 304)
+        finally:
+            with self.app.app_context():
+                DataVersion.bump('questions', 'categories')
+                db.session.commit()
+
+    def test_etag_follows_writes_by_other_workers(self):
+        self.client().post('/questions/add', json=self.new_question)
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        category_id, name = next(iter(
+            json.loads(res.data)['categories'].items()))
+
+        # a write by another worker: the shared version moves, this
+        # process's table versions and category cache do not
+        with self.app.app_context():
+            db.session.execute(
+                text('UPDATE categories SET type = :type WHERE id = :id'),
+                {'type': name + ' (renamed)', 'id': int(category_id)})
+            DataVersion.bump('categories')
+            db.session.commit()
+        try:
+            res = self.client().get('/categories',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(json.loads(res.data)['categories'][category_id],
+                             name + ' (renamed)')
+        finally:
+            with self.app.app_context():
+                category = Category.query.get(int(category_id))
+                category.type = name
+                category.update()
+
+    def test_get_bootstrap(self):
+        res = self.client().get('/bootstrap')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('ETag', res.headers)
+
+        page = json.loads(self.client().get('/questions?page=1').data)
+        self.assertEqual(data['questions'], page['questions'])
+        self.assertEqual(data['categories'], page['categories'])
+        self.assertEqual(data['total_questions'], page['total_questions'])
+        self.assertEqual(sum(data['category_counts'].values()),
+                         data['total_questions'])
+
+        # the data_versions lookup only
+        with self.assertMaxQueries(1):
+            self.client().get('/bootstrap')
+
+        res = self.client().post('/questions/add', json=self.new_question)
+        with self.assertMaxQueries(3):
+            res = self.client().get('/bootstrap')
+        updated = json.loads(res.data)
+        self.assertNotEqual(updated['version'], data['version'])
+        self.assertEqual(updated['total_questions'],
+                         data['total_questions'] + 1)
+        self.assertEqual(updated['category_counts']['1'],
+                         data['category_counts']['1'] + 1)
+
+    def test_batch_requests(self):
+        requests = [
+            ('GET', '/categories/1/questions', None),
+            ('POST', '/questions', self.search),
+            ('GET', '/stats', None),
+            ('GET', '/categories/10000/questions', None),
+        ]
+        res = self.client().post('/batch', json={'requests': [
+            {'method': method, 'path': path, 'body': body}
+            for method, path, body in requests]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(len(data['responses']), len(requests))
+
+        for (method, path, body), response in zip(requests, data['responses']):
+            expected = self.client().open(path, method=method, json=body)
+            self.assertEqual(response['status'], expected.status_code, path)
+            self.assertEqual(response['body'], json.loads(expected.data), path)
+        self.assertIn('ETag', data['responses'][0]['headers'])
+
+        etag = data['responses'][0]['headers']['ETag']
+        res = self.client().post('/batch', json={'requests': [
+            {'path': '/categories/1/questions',
+             'headers': {'If-None-Match': etag}},
+            {'method': 'POST', 'path': '/quizzes', 'body': self.quiz}]})
+        first, second = json.loads(res.data)['responses']
+        self.assertEqual(first['status'], 304)
+        self.assertIsNone(first['body'])
+        self.assertTrue(second['body']['success'])
+
+    def test_422_batch_malformed(self):
+        for body in ({}, {'requests': []},
+                     {'requests': [{'path': '/batch', 'method': 'POST'}]},
+                     {'requests': [{'path': '/stats', 'method': 'PUT'}]},
+                     {'requests': [{'path': 'stats'}]},
+                     {'requests': [{'path': '/stats'}] * 21}):
+            res = self.client().post('/batch', json=body)
+            self.assertEqual(res.status_code, 422)
+
+    def test_compressed_responses(self):
+        path = '/questions?after=&limit=100'
+        plain = self.client().get(path)
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        res = self.client().get(path, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertEqual(int(res.headers['Content-Length']), len(res.data))
+
+        res = self.client().get(path, headers={
+            'Accept-Encoding': 'br;q=0, zstd;q=0, gzip;q=0'})
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+
+        res = self.client().get(path, headers={'Accept-Encoding': '*'})
+        self.assertEqual(res.headers['Content-Encoding'], list(ENCODERS)[0])
+
+        # below COMPRESS_MIN_SIZE
+        res = self.client().get('/categories',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+
+    def test_precompressed_variants_reused(self):
+        path = '/questions?after=&limit=100'
+        headers = {'Accept-Encoding': 'gzip'}
+        first = self.client().get(path, headers=headers)
+        stats = json.loads(self.client().get('/internal/cache').data)
+        second = self.client().get(path, headers=headers)
+        third = self.client().get(path, headers=headers)
+        after = json.loads(self.client().get('/internal/cache').data)
+
+        # the first repeat recompresses at the tighter level, once
+        self.assertEqual(gzip.decompress(first.data),
+                         gzip.decompress(second.data))
+        self.assertEqual(second.data, third.data)
+        self.assertEqual(after['compression']['hits'],
+                         stats['compression']['hits'] + 2)
+        self.assertEqual(after['compression']['upgrades'],
+                         stats['compression']['upgrades'] + 1)
+        self.assertEqual(after['compression']['misses'],
+                         stats['compression']['misses'])
+
+        # a batch entry is never compressed on its own
+        res = self.client().post('/batch', json={'requests': [
+            {'path': path, 'headers': headers}]})
+        entry = json.loads(res.data)['responses'][0]
+        self.assertNotIn('Content-Encoding', entry['headers'])
+        self.assertEqual(entry['body'], json.loads(gzip.decompress(first.data)))
+
+    def test_reads_routed_to_replica(self):
+        directory = tempfile.mkdtemp()
+        primary = 'sqlite:///' + os.path.join(directory, 'primary.db')
+        replica = os.path.join(directory, 'replica.db')
+        app = create_app({'SQLALCHEMY_DATABASE_URI': primary})
+        with app.app_context():
+            Category('Science').insert()
+            for number in range(3):
+                Question('Primary question %d' % number, 'A', 1, 1).insert()
+        shutil.copy(os.path.join(directory, 'primary.db'), replica)
+        with sqlite3.connect(replica) as connection:
+            connection.execute("UPDATE questions SET question = 'Replica'")
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': primary,
+            'DATABASE_REPLICAS': 'sqlite:///%s, sqlite:////missing/dir/r.db'
+                                 % replica})
+        client = app.test_client()
+        try:
+            bump_version('questions', 'categories')
+            # the round robin reaches the missing replica and skips it
+            for _ in range(3):
+                res = client.get('/categories/1/questions')
+                self.assertEqual(
+                    {q['question'] for q in json.loads(res.data)['questions']},
+                    {'Replica'})
+
+            # a write pins the rest of the request to the primary
+            res = client.post('/batch', json={'requests': [
+                {'method': 'POST', 'path': '/questions/add',
+                 'body': dict(self.new_question, category=1)},
+                {'path': '/categories/1/questions'}]})
+            added, page = json.loads(res.data)['responses']
+            self.assertEqual(added['status'], 200)
+            self.assertIn('Primary question 0',
+                          [q['question'] for q in page['body']['questions']])
+
+            res = client.get('/categories/1/questions')
+            self.assertIn('Replica', [q['question']
+                                      for q in json.loads(res.data)['questions']])
+
+            replicas = json.loads(client.get('/internal/pool').data)['replicas']
+            self.assertEqual([(r['name'], r['healthy']) for r in replicas],
+                             [('replica_0', True), ('replica_1', False)])
+        finally:
+            # the shared caches were filled from these databases
+            bump_version('questions', 'categories')
+
+    def test_get_pool_stats(self):
+        self.client().get('/questions')
+        res = self.client().get('/internal/pool')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('status', data['pool'])
+
+    def test_metrics_endpoint(self):
+        self.client().get('/questions?page=1')
+        self.client().get('/categories/1/questions')
+        res = self.client().get('/metrics')
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(res.content_type.startswith('text/plain'))
+
+        lines = dict(line.rsplit(' ', 1)
+                     for line in res.data.decode().splitlines()
+                     if not line.startswith('#'))
+        route = 'method="GET",route="/categories/<int:category_id>/questions"'
+        self.assertGreaterEqual(
+            int(lines['trivia_requests_total{%s,status="200"}' % route]), 1)
+        self.assertGreaterEqual(
+            int(lines['trivia_request_duration_seconds_count{%s}' % route]), 1)
+        self.assertGreaterEqual(float(lines[
+            'trivia_request_db_queries_sum{method="GET",route="/questions"}']), 1)
+        self.assertIn('trivia_response_size_bytes_bucket{%s,le="+Inf"}' % route,
+                      lines)
+
+    def test_server_timing_header(self):
+        res = self.client().get('/categories')
+        self.assertNotIn('Server-Timing', res.headers)
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                          'SERVER_TIMING': True})
+        res = app.test_client().get('/questions')
+        self.assertRegex(res.headers['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=[\d.]+$')
+
+    def test_hot_routes_query_budget(self):
+        quiz = {'previous_questions': [], 'quiz_category': {'id': 1}}
+        # warm the category, count and quiz id caches first
+        self.client().get('/questions')
+        self.client().get('/categories/1/questions')
+        self.client().post('/quizzes', json=quiz)
+
+        # plus one data_versions lookup for the conditional GET validators
+        with self.assertMaxQueries(2):
+            self.client().get('/categories')
+            self.client().get('/stats')
+        with self.assertMaxQueries(2):
+            self.client().get('/questions?page=1')
+        with self.assertMaxQueries(2):
+            self.client().get('/categories/1/questions')
+        with self.assertMaxQueries(1):
+            self.client().post('/quizzes', json=quiz)
+
+    def test_query_tracker_flags_repeats(self):
+        with self.app.app_context():
+            ids = [q.id for q in Question.query.limit(3)]
+            db.session.expunge_all()
+            with track_queries() as log:
+                for question_id in ids:
+                    Question.query.get(question_id)
+                for _ in range(2):
+                    db.session.execute(text('SELECT :n'), {'n': 1})
+        self.assertEqual(len(log), len(ids) + 2)
+        self.assertEqual([times for _, times in log.repeated()], [len(ids)])
+        self.assertEqual([times for _, times in log.duplicates()], [2])
+
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                          'QUERY_TRACKER': True, 'SLOW_QUERY_MS': 0})
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            app.test_client().get('/questions?page=1')
+        self.assertTrue(any('slow query on GET /questions' in line
+                            for line in logs.output))
+
+    def assertUsesIndex(self, query):
+        """Asserts the planner answers `query` from a questions index."""
+        compiled = query.statement.compile()
+        if db.engine.dialect.name == 'sqlite':
+            rows = db.session.execute(
+                text('EXPLAIN QUERY PLAN ' + str(compiled)), compiled.params)
+            plan = '\n'.join(row[-1] for row in rows)
+        else:
+            # the test tables are small enough for a seq scan to win on cost
+            db.session.execute(text('SET LOCAL enable_seqscan = off'))
+            rows = db.session.execute(
+                text('EXPLAIN ' + str(compiled)), compiled.params)
+            plan = '\n'.join(row[0] for row in rows)
+        db.session.rollback()
+        self.assertIn('ix_questions_', plan)
+        return plan
+
+    def test_migrations_upgrade(self):
+        runner = self.app.test_cli_runner()
+        res = runner.invoke(args=['db', 'upgrade'])
+        self.assertEqual(res.exit_code, 0)
+
+        res = runner.invoke(args=['db', 'status'])
+        self.assertIn('applied 0002_question_indexes', res.output)
+        self.assertIn('applied 0003_question_category_fk', res.output)
+        self.assertIn('applied 0004_question_answer_normalized', res.output)
+        self.assertIn('applied 0005_question_counts', res.output)
+        self.assertIn('applied 0006_data_versions', res.output)
+        self.assertNotIn('pending', res.output)
+
+        res = runner.invoke(args=['db', 'check'])
+        self.assertEqual(res.exit_code, 0)
+
+        res = runner.invoke(args=['questions', 'normalize'])
+        self.assertEqual(res.exit_code, 0)
+        with self.app.app_context():
+            self.assertEqual(Question.query.filter(
+                Question.answer_normalized.is_(None)).count(), 0)
+
+    def test_new_schema_stamps_model_migrations(self):
+        directory = tempfile.mkdtemp()
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///'
+                          + os.path.join(directory, 'new.db')})
+        runner = app.test_cli_runner()
+        res = runner.invoke(args=['db', 'status'])
+        self.assertNotIn('pending', res.output)
+
+        res = runner.invoke(args=['db', 'upgrade'])
+        self.assertIn('0 migration(s) applied', res.output)
+        with app.app_context():
+            Category('Science').insert()
+            question = Question('Who wrote Hamlet?', 'Shakespeare', 1, 1)
+            question.insert()
+            self.assertEqual(Question.query.get(question.id).answer_normalized,
+                             'shakespeare')
+        shutil.rmtree(directory)
+
+    def test_hot_queries_use_indexes(self):
+        self.app.test_cli_runner().invoke(args=['db', 'upgrade'])
+        with self.app.app_context():
+            self.assertUsesIndex(
+                Question.query.filter_by(category=1).order_by(Question.id)
+                .limit(10))
+            self.assertUsesIndex(
+                db.session.query(Question.id).filter_by(category=1)
+                .order_by(Question.id))
+            self.assertUsesIndex(
+                Question.query.filter_by(category=1, difficulty=2)
+                .order_by(Question.id))
+            self.assertUsesIndex(Question.query.filter_by(difficulty=2))
+
+    def test_category_filter_is_sargable(self):
+        self.app.test_cli_runner().invoke(args=['db', 'upgrade'])
+        with self.app.app_context():
+            plan = self.assertUsesIndex(
+                Question.query.filter_by(category=1).order_by(Question.id))
+        # the index condition compares the column itself, with no cast
+        self.assertRegex(plan, r'\(category ?= ?(\?|\$?\d+)\)')
+        self.assertNotIn('::', plan)
+
+    def test_get_stats(self):
+        res = self.client().get('/stats')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(
+            data['total_questions'],
+            sum(c['total_questions'] for c in data['categories'].values()))
+        self.assertEqual(data['total_questions'],
+                         sum(data['difficulties'].values()))
+
+    def test_stats_follow_writes(self):
+        res = self.client().get('/stats')
+        before = json.loads(res.data)['categories']['1']['difficulties']
+        self.client().post('/questions/add', json=self.new_question)
+
+        res = self.client().get('/stats')
+        after = json.loads(res.data)['categories']['1']['difficulties']
+        self.assertEqual(after['1'], before.get('1', 0) + 1)
+
+        res = self.client().get('/categories/1/questions')
+        self.assertEqual(json.loads(res.data)['total_questions'],
+                         sum(after.values()))
+
+    def test_stats_rebuild_is_absolute(self):
+        runner = self.app.test_cli_runner()
+        for _ in range(2):
+            res = runner.invoke(args=['stats', 'rebuild'])
+            self.assertEqual(res.exit_code, 0)
+
+        res = self.client().get('/stats')
+        with self.app.app_context():
+            self.assertEqual(json.loads(res.data)['total_questions'],
+                             Question.query.count())
+
     def test_200_add_question(self):
         res = self.client().post('/questions/add', json=self.new_question)
         data = json.loads(res.data)
         self.assertEqual(res.status_code, 200)
 
+    def test_add_question_category_stored_as_integer(self):
+        question = dict(self.new_question, question='Category as text?',
+                        category='2')
+        res = self.client().post('/questions/add', json=question)
+        self.assertEqual(res.status_code, 200)
+
+        res = self.client().post('/questions',
+                                 json={'searchTerm': 'Category as text'})
+        questions = json.loads(res.data)['questions']
+        self.assertTrue(questions)
+        self.assertTrue(all(q['category'] == 2 for q in questions))
+
+    def test_422_add_question_unknown_category(self):
+        question = dict(self.new_question, category=10000)
+        res = self.client().post('/questions/add', json=question)
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_add_question_bad_difficulty(self):
+        for difficulty in ('hard', 6, -1):
+            res = self.client().post('/questions/add', json=dict(
+                self.new_question, difficulty=difficulty))
+            self.assertEqual(res.status_code, 422)
+
+    def test_add_question_category_added_by_another_worker(self):
+        self.client().get('/categories')
+        with self.app.app_context():
+            # inserted behind the cache's back, as psql or another worker would
+            category_id = db.session.execute(Category.__table__.insert()
+                .values(type='Elsewhere')).inserted_primary_key[0]
+            db.session.commit()
+        try:
+            res = self.client().post('/questions/add', json=dict(
+                self.new_question, category=category_id))
+            self.assertEqual(res.status_code, 200)
+        finally:
+            with self.app.app_context():
+                for question in Question.query.filter_by(category=category_id):
+                    question.delete()
+                Category.query.get(category_id).delete()
+
+    def test_import_questions(self):
+        lines = [
+            json.dumps(self.new_question),
+            json.dumps(dict(self.new_question, difficulty=9)),
+            '{not json'
+        ]
+        res = self.client().post('/questions/import', data='\n'.join(lines),
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+        self.assertEqual(data['inserted'], 1)
+        self.assertEqual(data['failed'], 2)
+        self.assertEqual([e['line'] for e in data['errors']], [2, 3])
+
+    def test_export_questions_by_category(self):
+        res = self.client().get('/questions/export?category=2')
+        rows = [json.loads(line) for line in res.data.splitlines()]
+        total = json.loads(
+            self.client().get('/categories/2/questions').data)['total_questions']
+
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), total)
+        self.assertEqual({int(row['category']) for row in rows}, {2})
+
+    def test_export_questions_csv(self):
+        res = self.client().get('/questions/export?format=csv&difficulty=1')
+        lines = res.data.decode('utf-8').splitlines()
+        self.assertEqual(lines[0], 'id,question,answer,category,difficulty')
+        self.assertTrue(all(line.endswith(',1') for line in lines[1:]))
+
+    def test_422_export_questions_bad_filter(self):
+        for query in ('category=abc', 'difficulty=hard', 'format=xml'):
+            res = self.client().get('/questions/export?' + query)
+            self.assertEqual(res.status_code, 422)
+
     def test_422_add_question(self):
        bad_question = {
            'question': 'What is the difference between orange and blue?',
@@ -85,6 +677,35 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTrue(len(data['categories']))
 
+    def test_get_questions_second_page(self):
+        res = self.client().get('/questions?page=2')
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(0 < len(data['questions']) <= 10)
+        self.assertGreater(data['total_questions'], 10)
+
+    def test_get_questions_cursor_walk(self):
+        seen = []
+        res = self.client().get('/questions?after=&limit=5')
+        data = json.loads(res.data)
+        seen.extend(q['id'] for q in data['questions'])
+        while data['next_cursor']:
+            res = self.client().get(
+                '/questions?after={}&limit=5'.format(data['next_cursor']))
+            data = json.loads(res.data)
+            seen.extend(q['id'] for q in data['questions'])
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(seen, sorted(set(seen)))
+        self.assertEqual(len(seen), data['total_questions'])
+
+    def test_400_get_questions_bad_cursor(self):
+        res = self.client().get('/questions?after=not-a-cursor')
+        self.assertEqual(res.status_code, 400)
+
+    def test_404_get_questions_beyond_last_page(self):
+        res = self.client().get('/questions?page=1000')
+        self.assertEqual(res.status_code, 404)
 
     def test_get_question_by_categories(self):
         res = self.client().get('/categories/1/questions')
@@ -97,12 +718,89 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['questions'])
         self.assertTrue(data['total_questions'])
 
+    def test_search_questions_including_answers(self):
+        res = self.client().post('/questions', json={"searchTerm": "escher"})
+        self.assertEqual(json.loads(res.data)['total_questions'], 0)
+
+        res = self.client().post(
+            '/questions', json={"searchTerm": "escher", "searchAnswers": True})
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'][0]['answer'], 'Escher')
+
+    def test_search_questions_matches_word_prefixes(self):
+        res = self.client().post('/questions', json={"searchTerm": "penicil"})
+        data = json.loads(res.data)
+        self.assertEqual(data['questions'][0]['answer'], 'Alexander Fleming')
+
+    def test_search_questions_paginated(self):
+        res = self.client().post('/questions?limit=2', json={"searchTerm": "what"})
+        data = json.loads(res.data)
+        self.assertEqual(len(data['questions']), 2)
+        self.assertGreater(data['total_questions'], 2)
+        self.assertFalse(data['total_is_estimate'])
+
+        res = self.client().post('/questions?limit=2&page=2',
+                                 json={"searchTerm": "what"})
+        second = json.loads(res.data)['questions']
+        self.assertNotIn(second[0]['id'], [q['id'] for q in data['questions']])
+
+    def test_422_search_without_term(self):
+        res = self.client().post('/questions', json={})
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_search_term_not_a_string(self):
+        res = self.client().post('/questions', json={'searchTerm': 123})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
     def test_delete_question(self):
         res = self.client().delete('/questions/1')
         data = json.loads(res.data)
         self.assertEqual(data['message'], 'Question ID 1 has been deleted')
         self.assertEqual(data['success'], True)
 
+    def test_bulk_update_and_delete_questions(self):
+        bulk = dict(self.new_question, question='Bulk question?')
+        lines = '\n'.join(json.dumps(bulk) for _ in range(3))
+        self.client().post('/questions/import', data=lines)
+        res = self.client().post('/questions', json={'searchTerm': 'Bulk'})
+        ids = [q['id'] for q in json.loads(res.data)['questions']]
+
+        before = json.loads(self.client().get('/stats').data)['categories']
+
+        res = self.client().patch('/questions', json={
+            'ids': ids, 'set': {'difficulty': 5, 'category': 2}})
+        self.assertEqual(json.loads(res.data)['updated'], len(ids))
+        after = json.loads(self.client().get('/stats').data)['categories']
+        self.assertEqual(after['2']['difficulties'].get('5', 0),
+                         before['2']['difficulties'].get('5', 0) + len(ids))
+        self.assertEqual(after['1']['total_questions'],
+                         before['1']['total_questions'] - len(ids))
+
+        res = self.client().delete('/questions', json={
+            'ids': ids, 'category': 2, 'difficulty': 5})
+        self.assertEqual(json.loads(res.data)['deleted'], len(ids))
+        after = json.loads(self.client().get('/stats').data)['categories']
+        self.assertEqual(after['2']['difficulties'].get('5', 0),
+                         before['2']['difficulties'].get('5', 0))
+
+    def test_422_bulk_delete_without_filter(self):
+        res = self.client().delete('/questions', json={})
+        self.assertEqual(res.status_code, 422)
+
+    def test_422_bulk_body_not_an_object(self):
+        for body in ([1], 'ids'):
+            res = self.client().delete('/questions', json=body)
+            self.assertEqual(res.status_code, 422)
+            res = self.client().patch('/questions', json=body)
+            self.assertEqual(res.status_code, 422)
+
+    def test_422_bulk_update_unknown_field(self):
+        res = self.client().patch('/questions', json={
+            'ids': [1], 'set': {'answer': 'nope'}})
+        self.assertEqual(res.status_code, 422)
+
     def test_404_get_questions(self):
         res = self.client().delete('/questions/10000')
         self.assertEqual(res.status_code, 404)
@@ -115,6 +813,260 @@ class TriviaTestCase(unittest.TestCase):
         res = self.client().post('/quizzes', json=self.quiz)
         self.assertEqual(res.status_code, 200)
     
+    def test_post_quiz_skips_previous_questions(self):
+        res = self.client().get('/categories/1/questions')
+        ids = [q['id'] for q in json.loads(res.data)['questions']]
+        quiz = {'previous_questions': ids[1:], 'quiz_category': {'id': 1}}
+
+        res = self.client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+        self.assertEqual(data['question']['id'], ids[0])
+
+    def test_post_quiz_exhausted_category(self):
+        res = self.client().get('/categories/1/questions')
+        ids = [q['id'] for q in json.loads(res.data)['questions']]
+        quiz = {'previous_questions': ids, 'quiz_category': {'id': '1'}}
+
+        res = self.client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertIsNone(data['question'])
+
+    def test_quiz_session_walks_category(self):
+        res = self.client().post('/quizzes/sessions',
+                                 json={'quiz_category': {'id': 1}})
+        data = json.loads(res.data)
+        session_id = data['session_id']
+
+        seen = []
+        for _ in range(data['total_questions']):
+            res = self.client().get(
+                '/quizzes/sessions/{}/next'.format(session_id))
+            seen.append(json.loads(res.data)['question']['id'])
+        res = self.client().get('/quizzes/sessions/{}/next'.format(session_id))
+
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertIsNone(json.loads(res.data)['question'])
+
+    def test_422_quiz_session_bad_question_count(self):
+        for count in (-1, 0, 'five'):
+            res = self.client().post('/quizzes/sessions', json={
+                'quiz_category': {'id': 1}, 'questions': count})
+            self.assertEqual(res.status_code, 422)
+
+    def test_422_quiz_session_body_not_an_object(self):
+        for body in ([1], 'quiz'):
+            res = self.client().post('/quizzes/sessions', json=body)
+            self.assertEqual(res.status_code, 422)
+
+    def test_quiz_session_length_is_capped(self):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                          'QUIZ_SESSION_QUESTIONS': 2})
+        for body in ({'quiz_category': {'id': 0}},
+                     {'quiz_category': {'id': 0}, 'questions': 1000}):
+            res = app.test_client().post('/quizzes/sessions', json=body)
+            self.assertEqual(json.loads(res.data)['total_questions'], 2)
+
+    def test_quiz_session_store_settings(self):
+        os.environ['quiz_session_max'] = '2'
+        try:
+            store = session_store(create_app())
+        finally:
+            del os.environ['quiz_session_max']
+        self.assertEqual(store.max_sessions, 2)
+
+    def test_redis_session_store(self):
+        client = FakeRedis()
+        store = RedisSessionStore(client, ttl=60)
+        store.create('s1', [3, 1, 2])
+        self.assertEqual(client.ttls['quiz:s1'], 60)
+        self.assertEqual(client.ttls['quiz:s1:ids'], 60)
+
+        popped = [store.pop('s1') for _ in range(4)]
+        self.assertEqual(popped, [(3, 2), (1, 1), (2, 0), (None, 0)])
+        # an exhausted session still exists, a deleted one does not
+        store.delete('s1')
+        with self.assertRaises(KeyError):
+            store.pop('s1')
+        with self.assertRaises(KeyError):
+            store.pop('missing')
+
+    def test_404_quiz_session_unknown(self):
+        res = self.client().get('/quizzes/sessions/missing/next')
+        self.assertEqual(res.status_code, 404)
+
+    def test_grade_answer(self):
+        with self.app.app_context():
+            question = Question('Who wrote Hamlet?', 'William Shakespeare', 1, 1)
+            question.insert()
+            question_id = question.id
+            self.assertEqual(question.answer_normalized, 'william shakespeare')
+
+        res = self.client().post('/quizzes/answer', json={
+            'question_id': question_id, 'answer': 'shakespear, William!'})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data['correct'])
+        self.assertEqual(data['answer'], 'William Shakespeare')
+
+        res = self.client().post('/quizzes/answer', json={
+            'question_id': question_id, 'answer': 'Marlowe'})
+        self.assertFalse(json.loads(res.data)['correct'])
+
+        with self.app.app_context():
+            Question.query.get(question_id).delete()
+        res = self.client().post('/quizzes/answer', json={
+            'question_id': question_id, 'answer': 'Shakespeare'})
+        self.assertEqual(res.status_code, 404)
+
+    def test_grade_answer_batch(self):
+        with self.app.app_context():
+            questions = Question.query.order_by(Question.id).limit(2).all()
+            answers = [(question.id, question.answer) for question in questions]
+        res = self.client().post('/quizzes/answer', json={'answers': [
+            {'question_id': answers[0][0], 'answer': answers[0][1].upper()},
+            {'question_id': answers[1][0], 'answer': 'not even close'},
+            {'question_id': 0, 'answer': 'anything'}]})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([r['correct'] for r in data['results']],
+                         [True, False, False])
+        self.assertIsNone(data['results'][2]['answer'])
+        self.assertEqual((data['correct'], data['total']), (1, 3))
+
+    def test_422_grade_answer_malformed(self):
+        for body in ({'question_id': 1}, {'answer': 'x'}, {'answers': []},
+                     {'answers': [{'question_id': 'one', 'answer': 'x'}]},
+                     'answers', ['answers']):
+            res = self.client().post('/quizzes/answer', json=body)
+            self.assertEqual(res.status_code, 422)
+
+    def test_grading_rules(self):
+        expected = normalize_answer('The Beatles')
+        self.assertEqual(expected, 'beatles')
+        self.assertTrue(grade('beatles', expected))
+        self.assertTrue(grade('The Beetles', expected))
+        self.assertTrue(grade('Spider man', normalize_answer('Spiderman')))
+        self.assertTrue(grade('Jose', normalize_answer('José')))
+        self.assertTrue(grade("the duke's", normalize_answer('Dukes')))
+        self.assertFalse(grade('1991', normalize_answer('1990')))
+        self.assertFalse(grade('', expected))
+        self.assertFalse(grade('beatles stones who kinks doors zeppelin',
+                               expected))
+        self.assertEqual(normalize_answer('The'), 'the')
+
+    def asgi_requests(self, *requests):
+        """Runs (method, path, json body, headers) requests on the ASGI app."""
+        url = self.app.config['SQLALCHEMY_DATABASE_URI']
+        if find_spec(ASYNC_DRIVERS[backend_name(url)]) is None:
+            self.skipTest('async driver not installed')
+
+        async def call(app, method, path, body, headers):
+            path, _, query = path.partition('?')
+            headers = [(k.lower().encode(), v.encode()) for k, v in headers]
+            data = b''
+            if body is not None:
+                data = json.dumps(body).encode()
+                headers.append((b'content-type', b'application/json'))
+            scope = {'type': 'http', 'method': method, 'path': path,
+                     'query_string': query.encode(), 'headers': headers}
+            response = {'body': b''}
+
+            async def receive():
+                return {'type': 'http.request', 'body': data}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    response['status'] = message['status']
+                    response['headers'] = {k.decode(): v.decode()
+                                           for k, v in message['headers']}
+                else:
+                    response['body'] += message.get('body', b'')
+            await app(scope, receive, send)
+            return response
+
+        async def run():
+            app = AsgiApp(self.app)
+            try:
+                return [await call(app, method, path, body, headers)
+                        for method, path, body, headers in requests]
+            finally:
+                await app.close()
+        return asyncio.run(run())
+
+    def test_asgi_unhandled_error_returns_json(self):
+        async def broken(asgi, request):
+            raise RuntimeError('broken handler')
+
+        with mock.patch.object(AsgiApp, 'get_stats', broken), \
+                self.assertLogs(self.app.logger, 'ERROR'):
+            res, = self.asgi_requests(('GET', '/stats', None, []))
+        self.assertEqual(res['status'], 500)
+        self.assertEqual(json.loads(res['body']), {
+            'success': False, 'error': 500,
+            'message': 'Internal Server Error'})
+
+        metrics = self.client().get('/metrics').data.decode()
+        self.assertIn('trivia_requests_total{method="GET",route="/stats",'
+                      'status="500"}', metrics)
+
+    def test_asgi_responses_match_wsgi(self):
+        requests = [
+            ('GET', '/categories', None),
+            ('GET', '/questions?page=2', None),
+            ('GET', '/questions?after=&limit=5', None),
+            ('GET', '/questions?page=1000', None),
+            ('GET', '/categories/1/questions', None),
+            ('GET', '/categories/10000/questions', None),
+            ('GET', '/stats', None),
+            ('GET', '/bootstrap', None),
+            ('POST', '/quizzes', {'previous_questions': [],
+                                  'quiz_category': {'id': 'nope'}}),
+            ('POST', '/questions', {'searchTerm': 'title'}),
+            ('PATCH', '/questions', {}),
+        ]
+        responses = self.asgi_requests(
+            *[(method, path, body, []) for method, path, body in requests])
+
+        for (method, path, body), response in zip(requests, responses):
+            expected = self.client().open(path, method=method, json=body)
+            self.assertEqual(response['status'], expected.status_code, path)
+            self.assertEqual(json.loads(response['body']),
+                             json.loads(expected.data), path)
+            self.assertEqual(response['headers']['access-control-allow-origin'],
+                             expected.headers['Access-Control-Allow-Origin'])
+
+    def test_asgi_compression_matches_wsgi(self):
+        path = '/questions?after=&limit=100'
+        headers = [('Accept-Encoding', 'gzip')]
+        response, = self.asgi_requests(('GET', path, None, headers))
+        expected = self.client().get(path, headers=dict(headers))
+        self.assertEqual(response['headers']['content-encoding'], 'gzip')
+        self.assertEqual(int(response['headers']['content-length']),
+                         len(response['body']))
+        self.assertEqual(gzip.decompress(response['body']),
+                         gzip.decompress(expected.data))
+
+    def test_asgi_quiz_and_conditional_get(self):
+        with self.app.app_context():
+            category_ids = [q.id for q in Question.query.filter_by(category=1)]
+        quiz = {'previous_questions': category_ids[1:],
+                'quiz_category': {'id': 1}}
+        exhausted = dict(quiz, previous_questions=category_ids)
+
+        quiz_res, exhausted_res, categories_res = self.asgi_requests(
+            ('POST', '/quizzes', quiz, []),
+            ('POST', '/quizzes', exhausted, []),
+            ('GET', '/categories', None, []))
+        self.assertEqual(json.loads(quiz_res['body'])['question']['id'],
+                         category_ids[0])
+        self.assertIsNone(json.loads(exhausted_res['body'])['question'])
+
+        etag = categories_res['headers']['etag']
+        res, = self.asgi_requests(
+            ('GET', '/categories', None, [('If-None-Match', etag)]))
+        self.assertEqual(res['status'], 304)
+
     def test_post_quizzes_error(self):
         error_data = {
             'previous_questions':[0, 0],
@@ -127,6 +1079,18 @@ class TriviaTestCase(unittest.TestCase):
         data = json.loads(res.data.decode('utf-8'))
         self.assertEqual(res.status_code, 422)
 
+    def test_422_post_quiz_malformed_previous_questions(self):
+        quiz = dict(self.quiz, previous_questions=[{'id': 1}])
+        res = self.client().post('/quizzes', json=quiz)
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+    def test_422_post_quiz_body_not_an_object(self):
+        for body in ([1], 'quiz', 5):
+            res = self.client().post('/quizzes', json=body)
+            self.assertEqual(res.status_code, 422)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
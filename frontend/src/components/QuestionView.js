@@ -14,11 +14,33 @@ class QuestionView extends Component {
       totalQuestions: 0,
       categories: {},
       currentCategory: null,
+      categoryId: null,
+      searchTerm: null,
     }
   }
 
   componentDidMount() {
-    this.getQuestions();
+    this.getBootstrap();
+  }
+
+  getBootstrap = () => {
+    $.ajax({
+      url: `/bootstrap`,
+      type: "GET",
+      success: (result) => {
+        this.setState({
+          searchTerm: null,
+          questions: result.questions,
+          totalQuestions: result.total_questions,
+          categories: result.categories,
+          currentCategory: null })
+        return;
+      },
+      error: (error) => {
+        alert('Unable to load questions. Please try your request again')
+        return;
+      }
+    })
   }
 
   getQuestions = () => {
@@ -27,6 +49,8 @@ class QuestionView extends Component {
       type: "GET",
       success: (result) => {
         this.setState({
+          searchTerm: null,
+          categoryId: null,
           questions: result.questions,
           totalQuestions: result.total_questions,
           categories: result.categories,
@@ -41,7 +65,13 @@ class QuestionView extends Component {
   }
 
   selectPage(num) {
-    this.setState({page: num}, () => this.getQuestions());
+    if (this.state.searchTerm) {
+      this.setState({page: num}, () => this.submitSearch(this.state.searchTerm, num));
+    } else if (this.state.categoryId) {
+      this.setState({page: num}, () => this.getByCategory(this.state.categoryId, num));
+    } else {
+      this.setState({page: num}, () => this.getQuestions());
+    }
   }
 
   createPagination(){
@@ -58,15 +88,18 @@ class QuestionView extends Component {
     return pageNumbers;
   }
 
-  getByCategory= (id) => {
+  getByCategory= (id, page=1) => {
     $.ajax({
-      url: `/categories/${id}/questions`, //TODO: update request URL
+      url: `/categories/${id}/questions?page=${page}`,
       type: "GET",
       success: (result) => {
         this.setState({
+          searchTerm: null,
+          categoryId: id,
           questions: result.questions,
           totalQuestions: result.total_questions,
-          currentCategory: result.current_category })
+          currentCategory: result.current_category,
+          page: page })
         return;
       },
       error: (error) => {
@@ -76,9 +109,9 @@ class QuestionView extends Component {
     })
   }
 
-  submitSearch = (searchTerm) => {
+  submitSearch = (searchTerm, page=1) => {
     $.ajax({
-      url: `/questions`, //TODO: update request URL
+      url: `/questions?page=${page}`,
       type: "POST",
       dataType: 'json',
       contentType: 'application/json',
@@ -91,7 +124,10 @@ class QuestionView extends Component {
         this.setState({
           questions: result.questions,
           totalQuestions: result.total_questions,
-          currentCategory: result.current_category })
+          currentCategory: result.current_category,
+          searchTerm: searchTerm,
+          categoryId: null,
+          page: page })
         return;
       },
       error: (error) => {
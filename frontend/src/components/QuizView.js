@@ -10,12 +10,14 @@ class QuizView extends Component {
     super();
     this.state = {
         quizCategory: null,
+        quizSession: null,
         previousQuestions: [], 
         showAnswer: false,
         categories: {},
         numCorrect: 0,
         currentQuestion: {},
         guess: '',
+        correct: false,
         forceEnd: false
     }
   }
@@ -36,7 +38,28 @@ class QuizView extends Component {
   }
 
   selectCategory = ({type, id=0}) => {
-    this.setState({quizCategory: {type, id}}, this.getNextQuestion)
+    $.ajax({
+      url: '/quizzes/sessions',
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        quiz_category: {type, id},
+        questions: questionsPerPlay
+      }),
+      xhrFields: {
+        withCredentials: true
+      },
+      crossDomain: true,
+      success: (result) => {
+        this.setState({quizCategory: {type, id}, quizSession: result.session_id}, this.getNextQuestion)
+        return;
+      },
+      error: (error) => {
+        alert('Unable to start the quiz. Please try your request again')
+        return;
+      }
+    })
   }
 
   handleChange = (event) => {
@@ -48,14 +71,8 @@ class QuizView extends Component {
     if(this.state.currentQuestion.id) { previousQuestions.push(this.state.currentQuestion.id) }
 
     $.ajax({
-      url: '/quizzes', //TODO: update request URL
-      type: "POST",
-      dataType: 'json',
-      contentType: 'application/json',
-      data: JSON.stringify({
-        previous_questions: previousQuestions,
-        quiz_category: this.state.quizCategory
-      }),
+      url: `/quizzes/sessions/${this.state.quizSession}/next`,
+      type: "GET",
       xhrFields: {
         withCredentials: true
       },
@@ -79,22 +96,44 @@ class QuizView extends Component {
 
   submitGuess = (event) => {
     event.preventDefault();
-    const formatGuess = this.state.guess.replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g,"").toLowerCase()
-    let evaluate =  this.evaluateAnswer()
-    this.setState({
-      numCorrect: !evaluate ? this.state.numCorrect : this.state.numCorrect + 1,
-      showAnswer: true,
+    $.ajax({
+      url: '/quizzes/answer',
+      type: "POST",
+      dataType: 'json',
+      contentType: 'application/json',
+      data: JSON.stringify({
+        question_id: this.state.currentQuestion.id,
+        answer: this.state.guess
+      }),
+      xhrFields: {
+        withCredentials: true
+      },
+      crossDomain: true,
+      success: (result) => {
+        this.setState({
+          numCorrect: !result.correct ? this.state.numCorrect : this.state.numCorrect + 1,
+          correct: result.correct,
+          showAnswer: true,
+        })
+        return;
+      },
+      error: (error) => {
+        alert('Unable to check your answer. Please try your request again')
+        return;
+      }
     })
   }
 
   restartGame = () => {
     this.setState({
       quizCategory: null,
+      quizSession: null,
       previousQuestions: [], 
       showAnswer: false,
       numCorrect: 0,
       currentQuestion: {},
       guess: '',
+      correct: false,
       forceEnd: false
     })
   }
@@ -130,15 +169,8 @@ class QuizView extends Component {
     )
   }
 
-  evaluateAnswer = () => {
-    const formatGuess = this.state.guess.replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g,"").toLowerCase()
-    const answerArray = this.state.currentQuestion.answer.toLowerCase().split(' ');
-    return answerArray.every(el => formatGuess.includes(el));
-  }
-
   renderCorrectAnswer(){
-    const formatGuess = this.state.guess.replace(/[.,\/#!$%\^&\*;:{}=\-_`~()]/g,"").toLowerCase()
-    let evaluate =  this.evaluateAnswer()
+    let evaluate = this.state.correct
     return(
       <div className="quiz-play-holder">
         <div className="quiz-question">{this.state.currentQuestion.question}</div>